@@ -0,0 +1,196 @@
+"""
+End-to-end harvest benchmark: starts the OAI-PMH stand-in (benchmarks/oai_server.py) and crawls it with each
+spider/pipeline combination in turn, each in its own process, and reports records/s, peak RSS and the time
+spent per stage: downloading pages, parse_record and each item pipeline, as measured by the StageMetrics extension
+(feed2html/extensions.py). Pipelines which return a Deferred (XSLT workers, the OCFL writer queue, file downloads)
+are timed until the Deferred fires. The deepest each queue got and the bytes each pipeline wrote are reported too.
+
+Usage: python benchmarks/harvest.py [--records 2000] [--page-size 100] [--latency 0.0] [--combinations dc-ocfl mets-full]
+    [--server-args="--fail-rate 0.01 --overload 8"] [--set CONCURRENT_REQUESTS=32] [--json results.json]
+"""
+import argparse
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, REPOSITORY)
+
+TRANSFORM = 'feed2html.pipelines.TransformXmlPipeline'
+OCFL = 'feed2html.pipelines.WriteToOCFLPipeline'
+FILES = 'feed2html.pipelines.FilesRelativePipeline'
+MARKDOWN = 'feed2html.pipelines.ExportMarkdownPipeline'
+SEARCH = 'feed2html.pipelines.SearchIndexPipeline'
+
+# output/xoai2html.xsl does not compile yet, so xoai records are rendered with the default oaidc2html.xsl
+XOAI_DATES = ".//doc:element[@name='dc']/doc:element[@name='date']//doc:field[@name='value']/text()"
+
+# Spider, metadataPrefix, item pipelines and spider arguments of each combination
+COMBINATIONS = {
+    'dc-parse': ('oaipmh_dc_xml', 'oai_dc', {}, {}),
+    'dc-xslt': ('oaipmh_dc_xml', 'oai_dc', {TRANSFORM: 200}, {}),
+    'dc-ocfl': ('oaipmh_dc_xml', 'oai_dc', {TRANSFORM: 200, OCFL: 900}, {}),
+    'dc-search': ('oaipmh_dc_xml', 'oai_dc', {TRANSFORM: 200, OCFL: 900, SEARCH: 950}, {}),
+    'xoai-ocfl': ('oaipmh_dc_xml', 'xoai', {TRANSFORM: 200, OCFL: 900},
+                  {'mapping': 'feed2html.mapping.XOAI', 'publication_date_xpath': XOAI_DATES}),
+    'mets-files': ('mets', 'mets', {FILES: 300, MARKDOWN: 400}, {}),
+    'mets-full': ('mets', 'mets', {TRANSFORM: 200, FILES: 300, MARKDOWN: 400, OCFL: 900}, {}),
+}
+
+
+def run_child(config):
+    """
+    Run one crawl in this process and write its results to config['result']
+    """
+    from scrapy import signals
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    # Above the spiders' custom_settings, which set their own pipelines and FILES_STORE
+    settings.setdict({'LOG_LEVEL': 'WARNING', 'TELNETCONSOLE_ENABLED': False, 'ITEM_PIPELINES': config['pipelines'],
+                      'STAGE_METRICS_ENABLED': True, **config['settings']}, priority='cmdline')
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(config['spider'])
+    clock = {}
+
+    def spider_opened(spider):
+        clock['start'] = time.perf_counter()
+
+    def spider_closed(spider):
+        clock['end'] = time.perf_counter()
+
+    # Signal handlers are weak references, so these are kept as locals until the crawl is over
+    crawler.signals.connect(spider_opened, signals.spider_opened)
+    crawler.signals.connect(spider_closed, signals.spider_closed)
+    process.crawl(crawler, **config['arguments'])
+    process.start()
+    stats = crawler.stats.get_stats()
+    stages = {}
+    for key in stats:
+        if key.startswith('metrics/') and key.endswith('/seconds'):
+            stage = key.split('/')[1]
+            stages[stage] = {name: stats[f'metrics/{stage}/{name}'] for name in ('count', 'seconds', 'p50_ms', 'p95_ms')}
+    with open(config['result'], 'w') as f:
+        json.dump({'seconds': clock['end'] - clock['start'], 'items': stats.get('item_scraped_count', 0),
+                   'errors': stats.get('log_count/ERROR', 0), 'finish_reason': stats.get('finish_reason'),
+                   'stages': stages,
+                   'queues': {key.split('/')[2]: value for key, value in stats.items()
+                              if key.startswith('metrics/queue/') and key.endswith('/max')},
+                   'bytes_written': {key.split('/', 1)[1]: value for key, value in stats.items()
+                                     if key.startswith('bytes_written/')}}, f)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args):
+    """
+    :return: (server process, base URL)
+    """
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS, 'oai_server.py'), '--port', str(port),
+                               '--records', str(args.records), '--page-size', str(args.page_size),
+                               '--latency', str(args.latency), *shlex.split(args.server_args)],
+                              stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, f"http://127.0.0.1:{port}/oai/request"
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                sys.exit("Could not start the OAI-PMH stand-in")
+            time.sleep(0.1)
+
+
+def run_combination(name, base_url, settings, directory):
+    """
+    Crawl the stand-in with one combination in a child process
+
+    :return: results dict, with the peak RSS of the child in MB
+    """
+    spider, prefix, pipelines, arguments = COMBINATIONS[name]
+    config = {
+        'spider': spider, 'pipelines': pipelines,
+        'settings': {'FILES_STORE': os.path.join(directory, 'files'),
+                     'SEARCH_INDEX_DIR': os.path.join(directory, 'search'), **settings},
+        'arguments': {'url': f"{base_url}?verb=ListRecords&metadataPrefix={prefix}",
+                      'path_to_ocfl': os.path.join(directory, 'ocfl'),
+                      **({'file_crawl_path': os.path.join(directory, 'files')} if spider == 'mets' else {}),
+                      **arguments},
+        'result': os.path.join(directory, 'result.json'),
+    }
+    env = {**os.environ, 'PYTHONPATH': REPOSITORY, 'SCRAPY_SETTINGS_MODULE': 'feed2html.settings'}
+    child = subprocess.Popen([sys.executable, __file__, '--child', json.dumps(config)], cwd=REPOSITORY, env=env)
+    # wait4 rather than wait, for the resource usage of this child alone
+    _, status, usage = os.wait4(child.pid, 0)
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode or not os.path.exists(config['result']):
+        return None
+    with open(config['result']) as f:
+        results = json.load(f)
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = usage.ru_maxrss / 1024
+    return results
+
+
+def report(name, results):
+    if results is None:
+        print(f"{name}: failed")
+        return
+    print(f"{name}: {results['items']} records in {results['seconds']:.2f}s "
+          f"({results['items'] / results['seconds']:.0f} records/s), peak RSS {results['peak_rss_mb']:.0f} MB, "
+          f"{results['errors']} errors, finished: {results['finish_reason']}")
+    for stage, metrics in results['stages'].items():
+        count = metrics['count'] or 1
+        print(f"    {stage:<24} {metrics['seconds'] / count * 1000:8.2f} ms x {metrics['count']:<6} "
+              f"{metrics['seconds']:8.2f}s  p50 {metrics['p50_ms']:.2f} ms  p95 {metrics['p95_ms']:.2f} ms")
+    print("    deepest queues: " + ", ".join(f"{name}={depth}" for name, depth in results['queues'].items()))
+    for pipeline, written in results['bytes_written'].items():
+        print(f"    {pipeline} wrote {written / 1024 / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every OAI-PMH response")
+    parser.add_argument('--combinations', nargs='+', choices=list(COMBINATIONS), default=list(COMBINATIONS))
+    parser.add_argument('--server-args', default='', help="more oai_server.py arguments, eg. '--fail-rate 0.01'")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help="Scrapy setting")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+
+    settings = dict(setting.split('=', 1) for setting in args.set)
+    server, base_url = start_server(args)
+    all_results = {}
+    try:
+        for name in args.combinations:
+            with tempfile.TemporaryDirectory(prefix=f'harvest-{name}-') as directory:
+                all_results[name] = run_combination(name, base_url, settings, directory)
+            report(name, all_results[name])
+    finally:
+        server.terminate()
+        server.wait()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""
+Local OAI-PMH stand-in for benchmarks and spider checks. It serves a synthetic repository of any size,
+built from template ListRecords pages: each template record is repeated with a new identifier
+(oai:bench:<n>) and datestamp, and {{n}}, {{base_url}}, {{file_size}} and {{file_md5}} in the record are
+filled in. oai_dc and METS/MODS templates are in benchmarks/templates, xoai uses test-xoai.xml.
+
+Verbs: Identify, ListMetadataFormats, ListSets, ListRecords (metadataPrefix, set, from, until and resumption
+tokens) and GetRecord. Bitstreams linked from the METS records are served at /bitstreams/<n>/<name>, with
+Range support. Latency, token expiry, deleted records and 503 responses (random, or above a number of
+concurrent requests) can be injected.
+
+Usage: python benchmarks/oai_server.py [--port 8000] [--records 10000] [--page-size 100] [--latency 0.05]
+    [--sets 10] [--fail-rate 0.01] [--overload 4] [--template prefix=page.xml]
+
+The ListRecords URL is then http://127.0.0.1:8000/oai/request?verb=ListRecords&metadataPrefix=oai_dc
+"""
+import argparse
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+OAI_NAMESPACE = 'http://www.openarchives.org/OAI/2.0/'
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TEMPLATES = {
+    'oai_dc': os.path.join(BENCHMARKS, 'templates', 'oai_dc.xml'),
+    'mets': os.path.join(BENCHMARKS, 'templates', 'mets.xml'),
+    'xoai': os.path.join(BENCHMARKS, '..', 'test-xoai.xml'),
+}
+# Datestamp of record 1, each record is --datestamp-step seconds later than the one before
+EARLIEST = datetime(2020, 1, 1, tzinfo=timezone.utc)
+DATESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+BITSTREAM_PATTERN = re.compile(r'/bitstreams/(\d+)/[^/]+$')
+RANGE_PATTERN = re.compile(r'bytes=(\d+)-(\d*)$')
+
+
+def load_templates(path):
+    """
+    Prepare the records of a template page for fast filling in: each record is serialised once, with
+    markers in place of the header identifier, datestamp and setSpecs
+
+    :param path: path to an OAI-PMH ListRecords page
+    :return: list of record strings
+    """
+    namespaces = {'oaipmh': OAI_NAMESPACE}
+    records = []
+    for record in etree.parse(path).iterfind('.//oaipmh:record', namespaces):
+        header = record.find('oaipmh:header', namespaces)
+        for spec in header.findall('oaipmh:setSpec', namespaces):
+            header.remove(spec)
+        header.find('oaipmh:identifier', namespaces).text = '{{identifier}}'
+        datestamp = header.find('oaipmh:datestamp', namespaces)
+        datestamp.text = '{{datestamp}}'
+        datestamp.tail = '{{sets}}'
+        records.append(etree.tostring(record, encoding='unicode'))
+    if not records:
+        raise ValueError(f"No records in template {path}")
+    return records
+
+
+class Repository:
+    """
+    The synthetic repository: records 1 to count, in datestamp order
+    """
+
+    def __init__(self, options, base_url):
+        self.options = options
+        self.base_url = base_url
+        self.templates = {prefix: load_templates(path) for prefix, path in options.templates.items()}
+        self.step = timedelta(seconds=options.datestamp_step)
+        self.file = random.Random(0).randbytes(options.file_size)
+        self.file_md5 = hashlib.md5(self.file).hexdigest()
+
+    def datestamp(self, n):
+        return (EARLIEST + self.step * (n - 1)).strftime(DATESTAMP_FORMAT)
+
+    def number(self, datestamp, last=False):
+        """
+        :param datestamp: from or until argument, day or seconds granularity
+        :param last: True for until (the last record on or before it), False for from (the first on or after it)
+        :return: record number, which may be outside 1 to count
+        """
+        if len(datestamp) == 10:
+            moment = datetime.strptime(datestamp, '%Y-%m-%d')
+            if last:
+                moment += timedelta(days=1) - timedelta(seconds=1)
+        else:
+            moment = datetime.strptime(datestamp, DATESTAMP_FORMAT)
+        offset = (moment.replace(tzinfo=timezone.utc) - EARLIEST) / self.step
+        return int(offset) + 1 if last else -int(-offset) + 1
+
+    def sets(self, n):
+        return [f"col_bench_{n % self.options.sets}"] if self.options.sets else []
+
+    def deleted(self, n):
+        # A cheap deterministic hash, so the same records are deleted on every run
+        return ((n * 2654435761) & 0xffffffff) / 2 ** 32 < self.options.deleted_rate
+
+    def select(self, set_spec=None, from_=None, until=None):
+        """
+        :return: range of the record numbers matching the list arguments
+        """
+        first, last = 1, self.options.records
+        if from_:
+            first = max(first, self.number(from_))
+        if until:
+            last = min(last, self.number(until, last=True))
+        if not set_spec:
+            return range(first, last + 1)
+        count = self.options.sets
+        match = re.fullmatch(r'col_bench_(\d+)', set_spec)
+        if not count or not match or int(match.group(1)) >= count:
+            return range(0)
+        remainder = int(match.group(1))
+        return range(first + (remainder - first) % count, last + 1, count)
+
+    def record(self, prefix, n):
+        """
+        :return: the record XML string of record n in the format of prefix
+        """
+        sets = ''.join(f'<setSpec>{spec}</setSpec>' for spec in self.sets(n))
+        if self.deleted(n):
+            return (f'<record><header status="deleted"><identifier>oai:bench:{n}</identifier>'
+                    f'<datestamp>{self.datestamp(n)}</datestamp>{sets}</header></record>')
+        templates = self.templates[prefix]
+        return templates[n % len(templates)] \
+            .replace('{{identifier}}', f'oai:bench:{n}') \
+            .replace('{{datestamp}}', self.datestamp(n)) \
+            .replace('{{sets}}', sets) \
+            .replace('{{n}}', str(n)) \
+            .replace('{{base_url}}', self.base_url) \
+            .replace('{{file_size}}', str(len(self.file))) \
+            .replace('{{file_md5}}', self.file_md5)
+
+
+class OaiHandler(BaseHTTPRequestHandler):
+    server_version = 'OaiStandIn/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            overloaded = server.options.overload and server.active > server.options.overload
+            failed = server.random.random() < server.options.fail_rate
+        try:
+            if overloaded or failed:
+                headers = {'Retry-After': str(server.options.retry_after)} if server.options.retry_after else {}
+                self.respond(503, b'', 'text/plain', headers)
+                return
+            path = urlsplit(self.path).path
+            match = BITSTREAM_PATTERN.search(path)
+            if match:
+                self.bitstream(int(match.group(1)))
+                return
+            if server.options.latency:
+                time.sleep(server.options.latency)
+            arguments = dict(parse_qsl(urlsplit(self.path).query))
+            self.respond(200, self.oai(arguments).encode('utf8'), 'text/xml; charset=utf-8')
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def bitstream(self, n):
+        repository = self.server.repository
+        if not 1 <= n <= self.server.options.records:
+            self.respond(404, b'', 'text/plain')
+            return
+        content = repository.file
+        match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+            if start >= len(content):
+                self.respond(416, b'', 'text/plain', {'Content-Range': f'bytes */{len(content)}'})
+                return
+            self.respond(206, content[start:end + 1], 'application/pdf',
+                         {'Content-Range': f'bytes {start}-{end}/{len(content)}', 'Accept-Ranges': 'bytes'})
+            return
+        self.respond(200, content, 'application/pdf', {'Accept-Ranges': 'bytes'})
+
+    def oai(self, arguments):
+        """
+        :param arguments: OAI-PMH request arguments
+        :return: response XML string
+        """
+        verb = arguments.get('verb')
+        handler = {
+            'Identify': self.identify,
+            'ListMetadataFormats': self.list_metadata_formats,
+            'ListSets': self.list_sets,
+            'ListRecords': self.list_records,
+            'GetRecord': self.get_record,
+        }.get(verb)
+        request = ''.join(f' {name}="{escape(value)}"' for name, value in arguments.items()
+                          if name in ('verb', 'metadataPrefix', 'set', 'from', 'until', 'identifier'))
+        content = handler(arguments) if handler else self.error('badVerb', f"Illegal OAI verb: {verb}")
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<OAI-PMH xmlns="{OAI_NAMESPACE}"><responseDate>{datetime.now(timezone.utc).strftime(DATESTAMP_FORMAT)}'
+                f'</responseDate><request{request}>{self.server.base_url}/oai/request</request>{content}</OAI-PMH>')
+
+    @staticmethod
+    def error(code, message):
+        return f'<error code="{code}">{escape(message)}</error>'
+
+    def identify(self, arguments):
+        repository = self.server.repository
+        return (f'<Identify><repositoryName>OAI-PMH stand-in</repositoryName>'
+                f'<baseURL>{self.server.base_url}/oai/request</baseURL><protocolVersion>2.0</protocolVersion>'
+                f'<adminEmail>bench@localhost</adminEmail><earliestDatestamp>{repository.datestamp(1)}'
+                f'</earliestDatestamp><deletedRecord>persistent</deletedRecord>'
+                f'<granularity>YYYY-MM-DDThh:mm:ssZ</granularity></Identify>')
+
+    def list_metadata_formats(self, arguments):
+        return '<ListMetadataFormats>' + ''.join(
+            f'<metadataFormat><metadataPrefix>{prefix}</metadataPrefix></metadataFormat>'
+            for prefix in self.server.repository.templates) + '</ListMetadataFormats>'
+
+    def list_sets(self, arguments):
+        count = self.server.options.sets
+        if not count:
+            return self.error('noSetHierarchy', "This repository does not support sets")
+        return '<ListSets>' + ''.join(f'<set><setSpec>col_bench_{i}</setSpec><setName>Collection {i}</setName></set>'
+                                      for i in range(count)) + '</ListSets>'
+
+    def get_record(self, arguments):
+        repository = self.server.repository
+        prefix = arguments.get('metadataPrefix')
+        if prefix not in repository.templates:
+            return self.error('cannotDisseminateFormat', f"Unknown metadataPrefix {prefix}")
+        match = re.fullmatch(r'oai:bench:(\d+)', arguments.get('identifier', ''))
+        if not match or not 1 <= int(match.group(1)) <= self.server.options.records:
+            return self.error('idDoesNotExist', f"No record {arguments.get('identifier')}")
+        return f'<GetRecord>{repository.record(prefix, int(match.group(1)))}</GetRecord>'
+
+    def list_records(self, arguments):
+        repository = self.server.repository
+        options = self.server.options
+        if 'resumptionToken' in arguments:
+            try:
+                prefix, set_spec, from_, until, offset, issued = arguments['resumptionToken'].split('!')
+                offset, issued = int(offset), float(issued)
+            except ValueError:
+                return self.error('badResumptionToken', "Invalid resumption token")
+            if options.token_ttl and time.time() - issued > options.token_ttl:
+                return self.error('badResumptionToken', "The resumption token has expired")
+        else:
+            prefix, set_spec = arguments.get('metadataPrefix'), arguments.get('set', '')
+            from_, until, offset = arguments.get('from', ''), arguments.get('until', ''), 0
+        if prefix not in repository.templates:
+            return self.error('cannotDisseminateFormat', f"Unknown metadataPrefix {prefix}")
+        try:
+            numbers = repository.select(set_spec, from_, until)
+        except ValueError:
+            return self.error('badArgument', "Invalid from or until datestamp")
+        if not numbers:
+            return self.error('noRecordsMatch', "No records match the request")
+        page = numbers[offset:offset + options.page_size]
+        records = ''.join(repository.record(prefix, n) for n in page)
+        token = ''
+        if offset + options.page_size < len(numbers):
+            value = '!'.join((prefix, set_spec, from_, until, str(offset + options.page_size), f"{time.time():.0f}"))
+            token = f'<resumptionToken completeListSize="{len(numbers)}" cursor="{offset}">{value}</resumptionToken>'
+        elif offset:
+            token = f'<resumptionToken completeListSize="{len(numbers)}" cursor="{offset}"/>'
+        return f'<ListRecords>{records}{token}</ListRecords>'
+
+
+class OaiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options):
+        super().__init__((options.host, options.port), OaiHandler)
+        self.options = options
+        self.base_url = f"http://{options.host}:{self.server_address[1]}"
+        self.repository = Repository(options, self.base_url)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.random = random.Random(options.seed)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every OAI-PMH response")
+    parser.add_argument('--sets', type=int, default=0, help="number of sets, records are spread evenly over them")
+    parser.add_argument('--datestamp-step', type=float, default=60.0, help="seconds between record datestamps")
+    parser.add_argument('--deleted-rate', type=float, default=0.0, help="fraction of records which are deleted")
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help="size of the bitstream of METS records")
+    parser.add_argument('--token-ttl', type=float, default=0, help="seconds a resumption token is valid (0: always)")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument('--overload', type=int, default=0,
+                        help="answer 503 when more than this many requests are being served (0: never)")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After of 503 responses (0: no header)")
+    parser.add_argument('--template', action='append', default=[], metavar='PREFIX=PATH',
+                        help="template page for a metadataPrefix, in addition to or instead of the defaults")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    options = parser.parse_args(argv)
+    options.templates = dict(DEFAULT_TEMPLATES)
+    for template in options.template:
+        prefix, path = template.split('=', 1)
+        options.templates[prefix] = path
+    return options
+
+
+def main():
+    options = parse_args()
+    server = OaiServer(options)
+    print(f"Serving {options.records} records at {server.base_url}/oai/request "
+          f"({', '.join(server.repository.templates)})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
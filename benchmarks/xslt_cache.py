@@ -0,0 +1,77 @@
+"""
+Before/after benchmark for compiled stylesheet caching in TransformXmlPipeline.
+Records are taken from an OAI-PMH ListRecords page (test-xoai.xml by default) and repeated
+to make up the requested number of records.
+
+Usage: python benchmarks/xslt_cache.py [--records 2000] [--xml test-xoai.xml] [--xsl output/oaidc2html.xsl]
+"""
+import argparse
+import os
+import sys
+import time
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from feed2html.xslt import StylesheetCache, spider_params, transform_record  # noqa: E402
+
+
+class BenchSpider:
+    website_title = 'OAI-PMH Feed'
+    website_subtitle = 'open access research'
+    path_to_assets = '/tmp'
+
+
+def load_records(path, count):
+    """
+    Serialise each oaipmh:record in the page and repeat them up to count records
+    """
+    tree = etree.parse(path)
+    records = [etree.tostring(r, encoding='unicode')
+               for r in tree.iterfind('.//{http://www.openarchives.org/OAI/2.0/}record')]
+    return [records[i % len(records)] for i in range(count)]
+
+
+def uncached(records, xsl):
+    """
+    The original per-record behaviour: parse and compile the stylesheet for every record
+    """
+    for xml in records:
+        transform = etree.XSLT(etree.parse(xsl))
+        root = etree.XML(xml)
+        transform(root,
+                  website_title=transform.strparam(BenchSpider.website_title),
+                  website_subtitle=transform.strparam(BenchSpider.website_subtitle),
+                  path_to_assets=transform.strparam(BenchSpider.path_to_assets),
+                  publication_date=transform.strparam('2020'))
+
+
+def cached(records, xsl):
+    """
+    Compile once, reuse the compiled stylesheet and prebuilt parameters
+    """
+    stylesheets = StylesheetCache()
+    params = spider_params(BenchSpider)
+    for xml in records:
+        transform_record(stylesheets.get(xsl), xml, params, '2020')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--xml', default='test-xoai.xml')
+    parser.add_argument('--xsl', default='output/oaidc2html.xsl')
+    args = parser.parse_args()
+
+    records = load_records(args.xml, args.records)
+    for name, bench in (('uncached', uncached), ('cached', cached)):
+        start = time.perf_counter()
+        bench(records, args.xsl)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10}: {len(records)} records in {elapsed:.3f}s "
+              f"({len(records) / elapsed:.0f} records/s, {elapsed / len(records) * 1e6:.0f} us/record)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Scaling benchmark for TransformXmlPipeline with XSLT_WORKERS worker threads.
+Each run feeds the same records through the pipeline on a Twisted reactor, as a crawl would.
+
+Usage: python benchmarks/xslt_workers.py [--records 4000] [--workers 0 1 2 4 8]
+"""
+import argparse
+import os
+import sys
+import time
+
+from twisted.internet import defer, task
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from xslt_cache import BenchSpider, load_records  # noqa: E402
+from feed2html.pipelines import TransformXmlPipeline  # noqa: E402
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    records = load_records(args.xml, args.records)
+    spider = BenchSpider()
+    spider.path_to_xsl = args.xsl
+    for workers in args.workers:
+        pipeline = TransformXmlPipeline(workers=workers)
+        pipeline.open_spider(spider)
+        start = time.perf_counter()
+        # Keep as many items in flight as Scrapy would with the default CONCURRENT_ITEMS
+        for offset in range(0, len(records), args.concurrent_items):
+            batch = [defer.maybeDeferred(pipeline.process_item, {'xml': xml, 'date_issued': '2020'}, spider)
+                     for xml in records[offset:offset + args.concurrent_items]]
+            yield defer.gatherResults(batch)
+        elapsed = time.perf_counter() - start
+        pipeline.close_spider(spider)
+        print(f"workers={workers:>2}: {len(records)} records in {elapsed:.3f}s "
+              f"({len(records) / elapsed:.0f} records/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=4000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8])
+    parser.add_argument('--concurrent-items', type=int, default=100)
+    parser.add_argument('--xml', default='test-xoai.xml')
+    parser.add_argument('--xsl', default='output/oaidc2html.xsl')
+    args = parser.parse_args()
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+# Custom scrapy commands for this project, enabled by COMMANDS_MODULE in settings.py
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/commands.html#custom-project-commands
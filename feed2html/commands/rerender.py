@@ -0,0 +1,66 @@
+import os
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from feed2html.render import PublicationDate, render_site
+
+
+class Command(ScrapyCommand):
+    """
+    Render the HTML pages again from the records stored in an OCFL repository, eg. after changing the XSLT,
+    without harvesting again. Runs across all CPU cores. Builds are incremental: only pages whose record,
+    stylesheet or parameters changed since the last build are rendered (see feed2html.render).
+    The publication date is found the way the spider which harvested the records (--spider) does
+
+    scrapy rerender --ocfl /tmp/site/repository --xsl output/oaidc2html.xsl -o /tmp/site/pages
+    """
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "INFO"}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Render HTML pages from the records in an OCFL repository"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--ocfl", dest="path_to_ocfl", default="/tmp/ocfl",
+                            help="OCFL repository path, as path_to_ocfl for the spiders (default: %(default)s)")
+        parser.add_argument("--xsl", dest="path_to_xsl", default="output/oaidc2html.xsl",
+                            help="XSL stylesheet (default: %(default)s)")
+        parser.add_argument("-o", "--output", dest="output",
+                            help="directory to write <object path>/page.html files to")
+        parser.add_argument("--website-title", dest="website_title", default="OAI-PMH Feed")
+        parser.add_argument("--website-subtitle", dest="website_subtitle", default="open access research")
+        parser.add_argument("--path-to-assets", dest="path_to_assets", default="/tmp")
+        parser.add_argument("--spider", dest="spider", default="oaipmh_dc_xml",
+                            help="spider the records were harvested with, for their publication date "
+                                 "(default: %(default)s)")
+        parser.add_argument("--publication-date-xpath", dest="publication_date_xpath",
+                            help="publication_date_xpath given to the spider, if it was not the spider's own")
+        parser.add_argument("--processes", dest="processes", type=int, default=os.cpu_count(),
+                            help="number of worker processes (default: number of CPUs)")
+        parser.add_argument("--force", dest="force", action="store_true",
+                            help="render every page, ignoring the build manifest")
+
+    def run(self, args, opts):
+        if not opts.output:
+            raise UsageError("An output directory is required (-o)")
+        params = {
+            'website_title': opts.website_title,
+            'website_subtitle': opts.website_subtitle,
+            'path_to_assets': opts.path_to_assets,
+        }
+        try:
+            spidercls = self.crawler_process.spider_loader.load(opts.spider)
+        except KeyError:
+            raise UsageError(f"Unknown spider: {opts.spider}")
+        publication_date = PublicationDate.from_spider(spidercls, opts.publication_date_xpath)
+        counts = render_site(opts.path_to_ocfl, opts.path_to_xsl, opts.output, params, processes=opts.processes,
+                             force=opts.force, publication_date=publication_date)
+        print(f"{counts['rebuilt']} pages rebuilt, {counts['skipped']} skipped, {counts['removed']} removed, "
+              f"{counts['failed']} failed")
+        if counts['failed']:
+            self.exitcode = 1
@@ -0,0 +1,74 @@
+"""
+Normalising the dates found in harvested records, to guess a publication date.
+Most dates in repository metadata are ISO 8601 or just a year, so those are parsed with compiled patterns,
+and dateutil (which is slow) is only used for anything else. Results are memoised, as the same
+date strings come up again and again in a harvest (accession dates of a batch import, years, ...)
+"""
+import logging
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from dateutil.parser import parse
+
+logger = logging.getLogger(__name__)
+
+# Number of distinct date strings to remember the normalised value of
+DATE_CACHE_SIZE = 8192
+
+YEAR_PATTERN = re.compile(r'[0-9]{4}')
+# 2019, 2019-05, 2019-05-03, 2019-05-03T10:22:01Z, 2019-05-03 10:22:01.123+10:00, ...
+ISO_PATTERN = re.compile(r'([0-9]{4})(?:-([0-9]{2})(?:-([0-9]{2})'
+                         r'(?:[T ]([0-9]{2}):([0-9]{2})(?::([0-9]{2})(?:\.[0-9]+)?)?)?)?)?'
+                         r'(?:Z|[+-][0-9]{2}(?::?[0-9]{2})?)?')
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def normalise_date(value):
+    """
+    Parse a date string. The time zone is ignored: dates are compared as written, in UTC
+
+    :param value: date string
+    :return: datetime, or None if no date could be found in the string
+    """
+    value = value.strip()
+    match = ISO_PATTERN.fullmatch(value)
+    if match:
+        with_defaults = [int(part) if part else default for part, default in zip(match.groups(), (1, 1, 1, 0, 0, 0))]
+        try:
+            return datetime(*with_defaults, tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    try:
+        return parse(value).replace(tzinfo=timezone.utc)
+    except (ValueError, OverflowError):
+        pass
+    # Hm, ok, we will just extract the first 4 consecutive numbers we see and call it a date
+    year = YEAR_PATTERN.search(value)
+    if year and int(year.group()) > 0:
+        return datetime(int(year.group()), 1, 1, tzinfo=timezone.utc)
+    return None
+
+
+def guess_date(dates, identifier=None):
+    """
+    Guess which of a record's dates might be the publication date: a date which is just a year
+    is probably what we are looking for, otherwise the earliest date is used
+
+    :param dates: list of date strings
+    :param identifier: record identifier, used for logging date errors which can be helpful in metadata validation
+    :return: year string, or None if none of the dates could be parsed
+    """
+    earliest = None
+    for date in dates or []:
+        if YEAR_PATTERN.fullmatch(date):
+            return date
+        parsed = normalise_date(date)
+        if parsed is None:
+            logger.error(f"Could not parse date '{date}' of {identifier}")
+        elif earliest is None or parsed < earliest:
+            earliest = parsed
+    if earliest is None:
+        return None
+    # Return just the year in this simple example
+    return earliest.strftime("%Y")
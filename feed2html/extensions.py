@@ -0,0 +1,489 @@
+# Define your extensions here
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+import cProfile
+import logging
+import os
+import pstats
+import random
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.utils.engine import get_engine_status
+from scrapy.utils.misc import create_instance, load_object
+from twisted.internet import task
+from twisted.internet.defer import Deferred
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets, from 100 microseconds (a small parse_record)
+# to a minute (a large file download). The last bucket is +Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with fixed buckets, as Prometheus histograms. Observing a value is a bisect and
+    a few additions, cheap enough to do for every item
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation within its bucket, as Prometheus histogram_quantile does
+
+        :param q: quantile, 0 to 1
+        :return: seconds, or 0.0 if nothing was observed
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+
+class PipelineWrapper:
+    """
+    Stands in for an item pipeline in ITEM_PIPELINES, so that an extension can wrap its process_item without
+    reaching into the engine. The wrapped pipeline is built as usual (from_crawler, from_settings or its
+    constructor), and everything but process_item is delegated to it. See wrap_pipelines
+    """
+    pipeline_class = None
+    wrap = None
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        # The pipeline from ITEM_PIPELINES, when several extensions wrap it
+        self.wrapped_pipeline = getattr(pipeline, 'wrapped_pipeline', pipeline)
+        if hasattr(pipeline, 'process_item'):
+            self.process_item = self.wrap(self.wrapped_pipeline, pipeline.process_item)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(create_instance(cls.pipeline_class, crawler.settings, crawler))
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+
+def wrap_pipelines(crawler, wrap):
+    """
+    Replace each pipeline of ITEM_PIPELINES with a PipelineWrapper. Extensions are built before the settings
+    are frozen, so this is called from the from_crawler of an extension
+
+    :param crawler: crawler
+    :param wrap: function of (pipeline, process_item), called as each pipeline with a process_item method is
+        built (in pipeline order), returning the function to call instead of process_item
+    :return: None
+    """
+    settings = crawler.settings
+    pipelines = {}
+    for path, order in settings.getwithbase('ITEM_PIPELINES').items():
+        if order is None:
+            continue
+        pipeline_class = load_object(path)
+        wrapper = type(f"{pipeline_class.__name__}Wrapper", (PipelineWrapper,),
+                       {'pipeline_class': pipeline_class, 'wrap': staticmethod(wrap)})
+        pipelines[wrapper] = order
+    settings.set('ITEM_PIPELINES_BASE', {}, priority=settings.getpriority('ITEM_PIPELINES_BASE'))
+    settings.set('ITEM_PIPELINES', pipelines, priority=settings.getpriority('ITEM_PIPELINES'))
+
+
+# Queue depths from the engine status report (as shown by the telnet console), as sums of its entries
+ENGINE_QUEUES = {
+    'scheduler': ('len(engine.slot.scheduler.dqs or [])', 'len(engine.slot.scheduler.mqs)'),
+    'downloader': ('len(engine.downloader.active)',),
+    'responses': ('len(engine.scraper.slot.queue)', 'len(engine.scraper.slot.active)'),
+}
+
+
+class StageMetrics:
+    """
+    Per-stage instrumentation of a crawl: a latency histogram, item count and error count for downloads, the
+    spider's parse_record and the process_item of every item pipeline, and the depth of the queues between the
+    downloader and the pipelines. Pipelines which return a Deferred are timed until it fires.
+    Stages are published as metrics/<stage>/* stats, queue depths (sampled every STAGE_METRICS_SAMPLE_INTERVAL
+    seconds) as metrics/queue/<queue> and metrics/queue/<queue>/max, and pipelines add the bytes they write to
+    the bytes_written/<pipeline> stats. Every STAGE_METRICS_INTERVAL seconds the stages are logged, and written
+    to STAGE_METRICS_PROMETHEUS_FILE (if set) in the Prometheus text format, eg. for the node_exporter textfile
+    collector.
+    Spiders and pipelines can report queues of their own by implementing queue_depths(), returning a dict of
+    queue name to depth
+    """
+
+    def __init__(self, crawler, interval=60.0, sample_interval=1.0, prometheus_file=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.prometheus_file = prometheus_file
+        self.stages = {}
+        self.queues = {}
+        self.pipelines = []
+        # Items which reached the first pipeline and have not yet been scraped, dropped or failed
+        self.items_in_pipelines = 0
+        self.previous_counts = {}
+        self.tasks = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('STAGE_METRICS_ENABLED'):
+            raise NotConfigured
+        o = cls(crawler, interval=crawler.settings.getfloat('STAGE_METRICS_INTERVAL', 60.0),
+                sample_interval=crawler.settings.getfloat('STAGE_METRICS_SAMPLE_INTERVAL', 1.0),
+                prometheus_file=crawler.settings.get('STAGE_METRICS_PROMETHEUS_FILE'))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.response_received, signal=signals.response_received)
+        for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+            crawler.signals.connect(o.item_done, signal=signal)
+        wrap_pipelines(crawler, o.time_pipeline)
+        return o
+
+    def stage(self, name):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = LatencyHistogram()
+        return histogram
+
+    def timed(self, name, function):
+        """
+        :param name: stage name
+        :param function: function to time
+        :return: function which observes its run time in the stage, until the Deferred fires if it returns one
+        """
+        histogram = self.stage(name)
+        perf_counter = time.perf_counter
+
+        def failed(failure, start):
+            histogram.observe(perf_counter() - start)
+            if not failure.check(DropItem):
+                histogram.errors += 1
+            return failure
+
+        def done(result, start):
+            histogram.observe(perf_counter() - start)
+            return result
+
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except DropItem:
+                histogram.observe(perf_counter() - start)
+                raise
+            except Exception:
+                histogram.observe(perf_counter() - start)
+                histogram.errors += 1
+                raise
+            if isinstance(result, Deferred):
+                return result.addCallbacks(done, failed, callbackArgs=(start,), errbackArgs=(start,))
+            histogram.observe(perf_counter() - start)
+            return result
+        return timed_function
+
+    def time_pipeline(self, pipeline, process_item):
+        """
+        Time the process_item of a pipeline, see wrap_pipelines. The first pipeline also counts the items
+        going into the pipelines
+        """
+        self.pipelines.append(pipeline)
+        timed = self.timed(type(pipeline).__name__, process_item)
+        if len(self.pipelines) > 1:
+            return timed
+
+        def first_process_item(item, spider):
+            self.items_in_pipelines += 1
+            return timed(item, spider)
+        return first_process_item
+
+    def item_done(self, item, spider, **kwargs):
+        if self.items_in_pipelines:
+            self.items_in_pipelines -= 1
+
+    def spider_opened(self, spider):
+        """
+        Wrap the spider's parse_record with a timer, and start sampling
+        """
+        if callable(getattr(spider, 'parse_record', None)):
+            spider.parse_record = self.timed('parse_record', spider.parse_record)
+        self.tasks = [task.LoopingCall(self.sample_queues, spider)]
+        if self.interval:
+            self.tasks.append(task.LoopingCall(self.report, spider))
+        self.tasks[0].start(self.sample_interval)
+        if self.interval:
+            self.tasks[1].start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        for looping_call in self.tasks:
+            if looping_call.running:
+                looping_call.stop()
+        self.publish()
+        self.write_prometheus()
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.stage('download').observe(latency)
+
+    def queue_depths(self, spider):
+        """
+        :return: dict of queue name to the number of requests, responses or items in it now
+        """
+        status = dict(get_engine_status(self.crawler.engine))
+        depths = {}
+        for name, entries in ENGINE_QUEUES.items():
+            values = [status.get(entry) for entry in entries]
+            # Entries the engine could not report (eg. before the spider is open) are exception names
+            if all(isinstance(value, int) for value in values):
+                depths[name] = sum(values)
+        depths['items'] = self.items_in_pipelines
+        for component in [spider] + self.pipelines:
+            if hasattr(component, 'queue_depths'):
+                depths.update(component.queue_depths())
+        return depths
+
+    def sample_queues(self, spider):
+        for name, depth in self.queue_depths(spider).items():
+            self.queues[name] = depth
+            self.stats.set_value(f'metrics/queue/{name}', depth)
+            self.stats.max_value(f'metrics/queue/{name}/max', depth)
+
+    def publish(self):
+        """
+        Set the metrics/<stage>/* stats
+        """
+        for name, histogram in self.stages.items():
+            self.stats.set_value(f'metrics/{name}/count', histogram.count)
+            self.stats.set_value(f'metrics/{name}/errors', histogram.errors)
+            self.stats.set_value(f'metrics/{name}/seconds', round(histogram.sum, 3))
+            self.stats.set_value(f'metrics/{name}/p50_ms', round(histogram.quantile(0.5) * 1000, 2))
+            self.stats.set_value(f'metrics/{name}/p95_ms', round(histogram.quantile(0.95) * 1000, 2))
+            self.stats.set_value(f'metrics/{name}/max_ms', round(histogram.max * 1000, 2))
+
+    def report(self, spider):
+        """
+        Publish the stats, log a line per stage and the queue depths, and write the Prometheus file
+        """
+        self.publish()
+        for name, histogram in self.stages.items():
+            rate = (histogram.count - self.previous_counts.get(name, 0)) / self.interval
+            self.previous_counts[name] = histogram.count
+            logger.info(f"Stage {name}: {histogram.count} ({rate:.1f}/s), p50 {histogram.quantile(0.5) * 1000:.1f} ms, "
+                        f"p95 {histogram.quantile(0.95) * 1000:.1f} ms, max {histogram.max * 1000:.1f} ms, "
+                        f"{histogram.errors} errors", extra={'spider': spider})
+        logger.info("Queues: " + ", ".join(f"{name}={depth}" for name, depth in self.queues.items()),
+                    extra={'spider': spider})
+        self.write_prometheus()
+
+    def write_prometheus(self):
+        """
+        Write the metrics to STAGE_METRICS_PROMETHEUS_FILE, via a temporary file so that a scraper never
+        reads a half written file
+        """
+        if not self.prometheus_file:
+            return
+        lines = ['# HELP feed2html_stage_seconds Time spent on each item, response or record in a crawl stage',
+                 '# TYPE feed2html_stage_seconds histogram']
+        for name, histogram in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'feed2html_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'feed2html_stage_seconds_sum{{stage="{name}"}} {histogram.sum}')
+            lines.append(f'feed2html_stage_seconds_count{{stage="{name}"}} {histogram.count}')
+        lines += ['# HELP feed2html_stage_errors_total Failures in each crawl stage',
+                  '# TYPE feed2html_stage_errors_total counter']
+        lines += [f'feed2html_stage_errors_total{{stage="{name}"}} {histogram.errors}'
+                  for name, histogram in self.stages.items()]
+        lines += ['# HELP feed2html_queue_depth Requests, responses or items waiting in each queue',
+                  '# TYPE feed2html_queue_depth gauge']
+        lines += [f'feed2html_queue_depth{{queue="{name}"}} {depth}' for name, depth in self.queues.items()]
+        lines += ['# HELP feed2html_bytes_written_total Bytes written by each pipeline',
+                  '# TYPE feed2html_bytes_written_total counter']
+        lines += [f'feed2html_bytes_written_total{{pipeline="{key.split("/", 1)[1]}"}} {value}'
+                  for key, value in self.stats.get_stats().items() if key.startswith('bytes_written/')]
+        lines += ['# HELP feed2html_items_scraped_total Items which went through every pipeline',
+                  '# TYPE feed2html_items_scraped_total counter',
+                  f'feed2html_items_scraped_total {self.stats.get_value("item_scraped_count", 0)}']
+        tmp_path = f"{self.prometheus_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prometheus_file)
+
+
+def frame_label(function):
+    """
+    :param function: pstats function key, (file name, line number, function name)
+    :return: frame name for collapsed stacks, eg. pipelines.py:process_item:360
+    """
+    filename, line, name = function
+    if filename == '~':
+        # Built-in function, eg. <method 'xpath' of 'lxml.etree._Element' objects>
+        return name.replace(';', ',').replace(' ', '_')
+    return f"{os.path.basename(filename)}:{name}:{line}"
+
+
+def collapsed_stacks(stats, min_seconds=1e-6):
+    """
+    Turn a profile into collapsed stacks ('frame;frame;frame microseconds' lines), the input format of
+    flamegraph.pl and speedscope, and what py-spy record --format raw writes.
+    cProfile only records caller/callee pairs, not whole stacks, so the time of a function called from several
+    places is split between its callers in proportion to the time spent in each call
+
+    :param stats: pstats.Stats
+    :param min_seconds: stacks with less time than this are left out
+    :return: list of lines
+    """
+    callees = defaultdict(dict)
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][function] = edge
+    stacks = Counter()
+
+    def walk(function, stack, share):
+        _, _, self_time, total_time, _ = stats.stats[function]
+        stack = stack + (frame_label(function),)
+        stacks[stack] += self_time * share
+        for callee, (_, _, _, edge_time) in callees[function].items():
+            callee_time = stats.stats[callee][3]
+            if edge_time * share < min_seconds or not callee_time or frame_label(callee) in stack:
+                continue
+            walk(callee, stack, edge_time * share / callee_time)
+
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            walk(function, (), 1.0)
+    return [f"{';'.join(stack)} {round(seconds * 1e6)}" for stack, seconds in sorted(stacks.items())
+            if seconds >= min_seconds]
+
+
+class ItemProfiler:
+    """
+    Profile a sample of the items of a crawl with cProfile: PROFILE_SAMPLE_RATE is the fraction of items profiled,
+    decided per item when parse_record creates it (or when it reaches the first pipeline, for spiders without
+    parse_record). For a sampled item, parse_record (including guess_date) and the process_item of every pipeline
+    are profiled. Pipeline work done in other threads (XSLT_WORKERS, OCFL_WRITER_QUEUE_SIZE) is not seen.
+    At the end of the crawl the merged profile is written to PROFILE_OUTPUT, as pstats ('pstats', for
+    python -m pstats or snakeviz) or collapsed stacks ('collapsed', for flamegraph.pl or speedscope)
+    """
+
+    def __init__(self, crawler, sample_rate, output, output_format='pstats'):
+        if output_format not in ('pstats', 'collapsed'):
+            raise NotConfigured(f"Unknown PROFILE_FORMAT '{output_format}', use 'pstats' or 'collapsed'")
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.sample_rate = sample_rate
+        self.output = output
+        self.output_format = output_format
+        self.profiler = cProfile.Profile()
+        # Profiled calls in progress, so that a pipeline called while another is being profiled does not
+        # turn the profiler off early
+        self.depth = 0
+        # id() of the sampled items on their way through the pipelines
+        self.sampled = set()
+        self.decide_in_pipelines = False
+        self.pipelines = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        sample_rate = crawler.settings.getfloat('PROFILE_SAMPLE_RATE', 0.0)
+        if sample_rate <= 0:
+            raise NotConfigured
+        output_format = crawler.settings.get('PROFILE_FORMAT', 'pstats')
+        o = cls(crawler, sample_rate, crawler.settings.get('PROFILE_OUTPUT') or f"profile.{output_format}",
+                output_format)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+            crawler.signals.connect(o.item_done, signal=signal)
+        wrap_pipelines(crawler, o.profile_pipeline)
+        return o
+
+    def profiled(self, function, *args, **kwargs):
+        if self.depth == 0:
+            self.profiler.enable()
+        self.depth += 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profiler.disable()
+
+    def mark_sampled(self, item):
+        self.sampled.add(id(item))
+        self.stats.inc_value('profile/sampled_items')
+
+    def profile_parse_record(self, function):
+        def parse_record(*args, **kwargs):
+            if random.random() >= self.sample_rate:
+                return function(*args, **kwargs)
+            item = self.profiled(function, *args, **kwargs)
+            if item is not None:
+                self.mark_sampled(item)
+            return item
+        return parse_record
+
+    def profile_pipeline(self, pipeline, function):
+        """
+        Profile the process_item of a pipeline for sampled items, see wrap_pipelines. Items are sampled in the
+        first pipeline if the spider has no parse_record
+        """
+        self.pipelines += 1
+        first = self.pipelines == 1
+
+        def process_item(item, spider):
+            if id(item) not in self.sampled:
+                if not (first and self.decide_in_pipelines and random.random() < self.sample_rate):
+                    return function(item, spider)
+                self.mark_sampled(item)
+            return self.profiled(function, item, spider)
+        return process_item
+
+    def spider_opened(self, spider):
+        if callable(getattr(spider, 'parse_record', None)):
+            spider.parse_record = self.profile_parse_record(spider.parse_record)
+        else:
+            self.decide_in_pipelines = True
+
+    def item_done(self, item, spider, **kwargs):
+        self.sampled.discard(id(item))
+
+    def spider_closed(self, spider, reason):
+        if not self.stats.get_value('profile/sampled_items'):
+            logger.info("No items were profiled", extra={'spider': spider})
+            return
+        if self.output_format == 'pstats':
+            self.profiler.dump_stats(self.output)
+        else:
+            lines = collapsed_stacks(pstats.Stats(self.profiler))
+            with open(self.output, 'w', encoding='utf8') as f:
+                f.write('\n'.join(lines) + '\n')
+        logger.info(f"Wrote the profile of {self.stats.get_value('profile/sampled_items')} items to {self.output}",
+                    extra={'spider': spider})
@@ -0,0 +1,154 @@
+"""
+Helpers for downloading bitstreams: checking files already on disk against the size and MD5
+published in the metadata, and writing partial downloads which can be resumed with HTTP Range requests
+"""
+import hashlib
+import os
+import re
+from contextlib import suppress
+
+# Content-Range: bytes 1000-1999/5000
+CONTENT_RANGE_PATTERN = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+def file_hashes(path, chunk_size=1024 * 1024):
+    """
+    Read a file once and compute both the checksums we keep for downloaded files
+
+    :param path: file path
+    :param chunk_size: read size
+    :return: tuple of (MD5 hex digest, SHA-512 hex digest)
+    """
+    md5 = hashlib.md5()
+    sha512 = hashlib.sha512()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+            sha512.update(chunk)
+    return md5.hexdigest(), sha512.hexdigest()
+
+
+def expected_file(files_to_download, url):
+    """
+    Find the size and MD5 published for a file in the record metadata (PREMIS or METS fileSec)
+
+    :param files_to_download: item['files_to_download'], a list of dicts with uri, size and md5
+    :param url: file URL
+    :return: tuple of (size as int or None, lower case MD5 or None)
+    """
+    for file in files_to_download or []:
+        if file.get('uri') == url:
+            size = file.get('size')
+            md5 = file.get('md5')
+            return (int(size) if size and size.strip().isdigit() else None,
+                    md5.strip().lower() if md5 and md5.strip() else None)
+    return None, None
+
+
+def parse_content_range(value):
+    """
+    :param value: Content-Range header value
+    :return: tuple of (first byte position, total size or None if not given), or None if the header
+        is not a byte range
+    """
+    match = CONTENT_RANGE_PATTERN.match(value or '')
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(3)) if match.group(3) != '*' else None
+
+
+class PartialDownload:
+    """
+    A file being downloaded to <path>.part. Chunks are written as they arrive and hashed on the way,
+    so the checksums are ready when the download finishes and an interrupted download leaves its data on disk
+    to be resumed from. A download may take several responses, each continuing where the last one stopped
+    """
+
+    def __init__(self, path, total=None):
+        """
+        :param path: final path of the file
+        :param total: expected size of the file, if known
+        """
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.total = total
+        # Whether the server accepts range requests for the file
+        self.ranges = False
+        # Bytes in the part file, and bytes written from the current response
+        self.size = 0
+        self.received = 0
+        self._file = None
+        self._md5 = None
+        self._sha512 = None
+
+    def existing_size(self):
+        """
+        :return: number of bytes already downloaded
+        """
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            return 0
+
+    def start(self, offset):
+        """
+        Start writing a response at offset: 0 for a full response, or the first byte of a range response.
+        The data already downloaded before offset is hashed once, to continue the checksums from there,
+        unless this response continues the one before
+
+        :param offset: position of the first byte of the response body in the file
+        :return: None
+        """
+        self.close()
+        self.received = 0
+        if self._md5 is not None and offset == self.size:
+            self._file = open(self.part_path, 'r+b')
+            self._file.seek(offset)
+            self._file.truncate()
+            return
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+        self._md5 = hashlib.md5()
+        self._sha512 = hashlib.sha512()
+        self._file = open(self.part_path, 'r+b' if offset and os.path.exists(self.part_path) else 'w+b')
+        self._file.truncate(offset)
+        for chunk in iter(lambda: self._file.read(1024 * 1024), b''):
+            self._md5.update(chunk)
+            self._sha512.update(chunk)
+        self.size = offset
+
+    @property
+    def started(self):
+        return self._file is not None
+
+    def write(self, data):
+        self._file.write(data)
+        self._md5.update(data)
+        self._sha512.update(data)
+        self.size += len(data)
+        self.received += len(data)
+
+    def finish(self):
+        """
+        Close the part file
+
+        :return: tuple of (size, MD5 hex digest, SHA-512 hex digest)
+        """
+        self.close()
+        return self.size, self._md5.hexdigest(), self._sha512.hexdigest()
+
+    def complete(self):
+        """
+        Move the finished part file to the final path
+        """
+        os.replace(self.part_path, self.path)
+
+    def discard(self):
+        self.close()
+        with suppress(FileNotFoundError):
+            os.remove(self.part_path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
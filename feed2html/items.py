@@ -50,4 +50,10 @@ class Feed2HtmlItem(scrapy.Item):
     # Special unique hash
     hash = scrapy.Field()
 
+    # Deleted upstream (OAI header status="deleted")
+    deleted = scrapy.Field()
+
+    # Source name of a multi-endpoint harvest, keeps the output of each source apart
+    source = scrapy.Field()
+
     pass
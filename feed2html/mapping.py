@@ -0,0 +1,186 @@
+"""
+Declarative field mappings from metadata records to item fields.
+
+A mapping spec is plain data: a dict with
+- 'fields': item field -> XPath string (first value), or a dict with 'xpath' and the options
+  'many' (keep all values as a list) and 'attribute' (take this attribute of the matched elements)
+- 'context' (optional): XPath of the element the field XPaths are relative to, eg. the root element of
+  the metadata. Only its subtree is searched, and a record without one gets None for every field
+- 'namespaces' (optional): prefix -> namespace URI, added to the spider's namespaces
+
+Specs are compiled once into lxml XPath evaluators (FieldMapping), which run directly on lxml elements.
+A new metadata format only needs a new spec, passed to a spider with -a mapping=<import path of the spec>
+"""
+from lxml import etree
+
+OAI_DC_NAMESPACE = 'http://www.openarchives.org/OAI/2.0/oai_dc/'
+DC_NAMESPACE = 'http://purl.org/dc/elements/1.1/'
+
+
+class Field:
+    """
+    One compiled field of a mapping
+    """
+
+    def __init__(self, name, xpath, many=False, attribute=None, namespaces=None):
+        """
+        :param name: item field name
+        :param xpath: XPath relative to the context element, selecting text or attribute values
+        :param many: keep all values as a list, otherwise the first value (None if there is none)
+        :param attribute: take this attribute of the elements selected by xpath
+        :param namespaces: prefix -> namespace URI
+        """
+        self.name = name
+        self.many = many
+        if attribute:
+            xpath = f"{xpath}/@{attribute}"
+        # smart_strings off: plain str results, which do not keep the parsed tree alive
+        self.xpath = etree.XPath(xpath, namespaces=namespaces, smart_strings=False)
+
+    @classmethod
+    def from_spec(cls, name, spec, namespaces=None):
+        if isinstance(spec, str):
+            return cls(name, spec, namespaces=namespaces)
+        return cls(name, spec['xpath'], many=spec.get('many', False), attribute=spec.get('attribute'),
+                   namespaces=namespaces)
+
+
+class FieldMapping:
+    """
+    A compiled mapping spec. See the module documentation for the spec format
+    """
+
+    def __init__(self, fields, context=None, namespaces=None):
+        """
+        :param fields: item field -> XPath string or field options dict
+        :param context: XPath of the element the fields are relative to (the first match is used)
+        :param namespaces: prefix -> namespace URI
+        """
+        self.fields = [Field.from_spec(name, spec, namespaces) for name, spec in fields.items()]
+        self.names = [field.name for field in self.fields]
+        self.context = etree.XPath(context, namespaces=namespaces) if context else None
+
+    def extract(self, element):
+        """
+        :param element: lxml element of a record (or HTML document)
+        :return: dict of item field -> value
+        """
+        if self.context is not None:
+            matches = self.context(element)
+            if not matches:
+                return dict.fromkeys(self.names)
+            element = matches[0]
+        values = {}
+        for field in self.fields:
+            results = field.xpath(element)
+            values[field.name] = results if field.many else (results[0] if results else None)
+        return values
+
+
+# Mapping specs for the formats the spiders harvest
+
+# Simple Dublin Core (metadataPrefix=oai_dc). The record XML is still kept whole for the stylesheet
+OAI_DC = {
+    'context': 'oaipmh:metadata/oai_dc:dc',
+    'namespaces': {'oai_dc': OAI_DC_NAMESPACE, 'dc': DC_NAMESPACE},
+    'fields': {
+        'title': 'dc:title/text()',
+        'author': {'xpath': 'dc:creator/text()', 'many': True},
+        'abstract': 'dc:description/text()',
+        'identifier': {'xpath': 'dc:identifier/text()', 'many': True},
+        'language': 'dc:language/text()',
+        'subject': {'xpath': 'dc:subject/text()', 'many': True},
+        'publication_type': 'dc:type/text()',
+        'access_condition': 'dc:rights/text()',
+    },
+}
+
+# DSpace XOAI (metadataPrefix=xoai), where each value is a field nested in elements named after the
+# schema, element, qualifier and language. Use with the oaipmh_dc_xml spider
+XOAI_NAMESPACE = 'http://www.lyncode.com/xoai'
+XOAI = {
+    'context': "oaipmh:metadata/doc:metadata/doc:element[@name='dc']",
+    'namespaces': {'doc': XOAI_NAMESPACE},
+    'fields': {
+        'title': "doc:element[@name='title']/doc:element/doc:field[@name='value']/text()",
+        'author': {'xpath': "doc:element[@name='contributor']/doc:element[@name='author']"
+                            "/doc:element/doc:field[@name='value']/text()", 'many': True},
+        'abstract': "doc:element[@name='description']/doc:element[@name='abstract']"
+                    "/doc:element/doc:field[@name='value']/text()",
+        'identifier': {'xpath': "doc:element[@name='identifier']//doc:field[@name='value']/text()", 'many': True},
+        'language': "doc:element[@name='language']//doc:field[@name='value']/text()",
+        'subject': {'xpath': "doc:element[@name='subject']//doc:field[@name='value']/text()", 'many': True},
+        'publication_type': "doc:element[@name='type']/doc:element/doc:field[@name='value']/text()",
+        'access_condition': "doc:element[@name='rights']/doc:element/doc:field[@name='value']/text()",
+    },
+}
+
+# METS record fields, outside the MODS metadata
+METS = {
+    'fields': {
+        'agent_name': './/mets:agent/mets:name/text()',
+    },
+}
+
+# MODS metadata in a METS record. Relative to mods:mods, so only the MODS subtree is searched
+MODS = {
+    'context': './/mods:mods',
+    'fields': {
+        'title': './/mods:title/text()',
+        'date_issued': './/mods:dateIssued/text()',
+        'abstract': './/mods:abstract/text()',
+        'identifier': {'xpath': './/mods:identifier/text()', 'many': True},
+        'language': './/mods:language/mods:languageTerm/text()',
+        'publication_type': './/mods:genre/text()',
+        'access_condition': './/mods:accessCondition/text()',
+    },
+}
+
+# Files to download, from each premis:object of a METS record
+PREMIS_OBJECT = {
+    'fields': {
+        'uri': './/premis:objectIdentifierValue/text()',
+        'size': './/premis:size/text()',
+        'md5': './/premis:fixity/premis:messageDigest/text()',
+        'format': './/premis:format/premis:formatDesignation/premis:formatName/text()',
+    },
+}
+
+# Files to download, from each mets:file of a METS fileSec (when there is no PREMIS)
+METS_FILE = {
+    'namespaces': {'xlink': 'http://www.w3.org/1999/xlink'},
+    'fields': {
+        'uri': {'xpath': "mets:FLocat[@LOCTYPE='URL']", 'attribute': 'xlink:href'},
+        'size': '@SIZE',
+        'md5': '@CHECKSUM',
+        'format': '@MIMETYPE',
+    },
+}
+
+# DSpace item pages, from the Dublin Core and Highwire meta tags in the HTML head
+DSPACE_HTML = {
+    'fields': {
+        'title': {'xpath': '//meta[@name="DC.title"]', 'attribute': 'content'},
+        'author': {'xpath': '//meta[@name="DC.creator"]', 'attribute': 'content'},
+        'issueDate': {'xpath': '//meta[@name="DCTERMS.issued"]', 'attribute': 'content'},
+        'bibliographicCitation': {'xpath': '//meta[@name="DCTERMS.bibliographicCitation"]', 'attribute': 'content'},
+        'identifier': {'xpath': '//meta[@name="DC.identifier"]', 'attribute': 'content'},
+        'abstract': {'xpath': '//meta[@name="DCTERMS.abstract"]', 'attribute': 'content'},
+        'language': {'xpath': '//meta[@name="DC.language"]', 'attribute': 'content'},
+        'subject': {'xpath': '//meta[@name="DC.subject"]', 'attribute': 'content'},
+        'type': {'xpath': '//meta[@name="DC.type"]', 'attribute': 'content'},
+        'bitstream': {'xpath': '//meta[@name="citation_pdf_url"]', 'attribute': 'content'},
+    },
+}
+
+
+def compile_mapping(spec, namespaces=None):
+    """
+    Compile a mapping spec
+
+    :param spec: mapping spec dict
+    :param namespaces: default namespaces (eg. the spider's), the spec's own namespaces are added to them
+    :return: FieldMapping
+    """
+    return FieldMapping(spec['fields'], context=spec.get('context'),
+                        namespaces={**(namespaces or {}), **spec.get('namespaces', {})})
@@ -3,11 +3,20 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+import time
+from email.utils import parsedate_to_datetime
+
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+logger = logging.getLogger(__name__)
+
 
 class Feed2HtmlSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +110,231 @@ class Feed2HtmlDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+def parse_retry_after(value, now=None):
+    """
+    :param value: Retry-After header value, a number of seconds or an HTTP date
+    :param now: current time as a UNIX timestamp (default: now)
+    :return: seconds to wait, or None if the value cannot be parsed
+    """
+    if not value:
+        return None
+    value = value.decode('latin1') if isinstance(value, bytes) else value
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at - (time.time() if now is None else now), 0.0)
+
+
+class SlotThrottle:
+    """
+    Throttle state of one downloader slot (usually one host).
+    Concurrency is adjusted like a TCP congestion window: it grows by about one request per round trip while the
+    server latency stays within ADAPTIVE_THROTTLE_LATENCY_TOLERANCE times the lowest latency seen, shrinks
+    slowly when the latency rises above that, and is halved when the server reports it is overloaded
+    """
+    # Weight of the latest response in the latency average
+    latency_weight = 0.3
+    # Seconds over which the response rate is measured
+    rate_interval = 5.0
+
+    def __init__(self, concurrency, max_concurrency, min_delay, max_delay, tolerance, randomize_delay=False):
+        self.concurrency = float(min(concurrency, max_concurrency))
+        self.max_concurrency = max_concurrency
+        # The configured delay of the slot (DOWNLOAD_DELAY or the per-slot delay) is the lowest delay used
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.tolerance = tolerance
+        # RANDOMIZE_DOWNLOAD_DELAY of the slot, turned off during a Retry-After pause
+        self.randomize_delay = randomize_delay
+        self.latency = None
+        self.base_latency = None
+        # Until when the server asked us to wait (Retry-After), and when the concurrency was last halved
+        self.paused_until = 0.0
+        self.backed_off = 0.0
+        # Whether the slot was last set up for a pause (which holds the requests already in its queue), so it is
+        # set back once the pause is over
+        self.pause_applied = False
+        # Responses per second over the last rate_interval
+        self.rate = 0.0
+        self._rate_start = time.time()
+        self._rate_count = 0
+
+    def response_received(self, now):
+        self._rate_count += 1
+        elapsed = now - self._rate_start
+        if elapsed >= self.rate_interval:
+            self.rate = self._rate_count / elapsed
+            self._rate_start = now
+            self._rate_count = 0
+
+    def latency_measured(self, latency):
+        """
+        Adjust to the latency of a successful response
+        """
+        self.latency = latency if self.latency is None else \
+            self.latency + self.latency_weight * (latency - self.latency)
+        # The lowest latency seen, drifting slowly up so that one unusually fast response does not stick
+        self.base_latency = latency if self.base_latency is None else \
+            min(latency, self.base_latency + 0.01 * (latency - self.base_latency))
+        if self.latency <= self.base_latency * self.tolerance:
+            self.concurrency = min(self.concurrency + 1 / self.concurrency, self.max_concurrency)
+            self.delay = max(self.delay / 2, self.min_delay)
+            if self.delay < self.min_delay + 0.01:
+                self.delay = self.min_delay
+        else:
+            self.concurrency = max(self.concurrency - 1 / self.concurrency, 1.0)
+
+    def back_off(self, now, retry_after=None):
+        """
+        Halve the concurrency after an overload response or a network error. With a Retry-After the slot waits
+        that long before its next request, otherwise the delay between requests doubles
+        """
+        # Responses to requests sent before the last back off do not count again, halve at most once per round trip
+        if now - self.backed_off < (self.latency or 1.0) or now < self.paused_until:
+            return
+        self.backed_off = now
+        self.concurrency = max(self.concurrency / 2, 1.0)
+        if retry_after is not None:
+            self.paused_until = now + min(retry_after, self.max_delay)
+        else:
+            self.delay = min(max(self.delay * 2, 1.0), self.max_delay)
+
+    def paused(self, now):
+        return now < self.paused_until
+
+    def slot_delay(self, now, lastseen):
+        """
+        :param now: current time
+        :param lastseen: when the slot last sent a request. The downloader waits the delay from then
+        :return: delay for the downloader slot
+        """
+        if self.paused(now):
+            return max(self.paused_until - lastseen, self.delay)
+        return self.delay
+
+
+class AdaptiveThrottleMiddleware:
+    """
+    Throttle each downloader slot to the rate the server tolerates: concurrency follows the server latency
+    (see SlotThrottle), 429/503 responses and network errors halve it, and Retry-After headers are obeyed.
+    Retrying the failed requests is left to RetryMiddleware. The current concurrency, delay and rate
+    (responses per second) of each slot are kept in the stats as throttle/<name>/<slot>.
+    Enable with ADAPTIVE_THROTTLE_ENABLED. It is not used together with AutoThrottle (AUTOTHROTTLE_ENABLED)
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        if settings.getbool('AUTOTHROTTLE_ENABLED'):
+            logger.warning("AUTOTHROTTLE_ENABLED is set, so AdaptiveThrottleMiddleware is disabled")
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        # None starts each slot at its own concurrency, so a server is never harvested slower than without the
+        # throttle until it shows it is overloaded
+        self.start_concurrency = settings.getint('ADAPTIVE_THROTTLE_START_CONCURRENCY') or None
+        self.max_concurrency = settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 8)
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 300.0)
+        self.tolerance = settings.getfloat('ADAPTIVE_THROTTLE_LATENCY_TOLERANCE', 2.0)
+        self.backoff_codes = {int(code) for code in settings.getlist('ADAPTIVE_THROTTLE_HTTP_CODES', [429, 503])}
+        # Network errors are overload signals too: the exceptions RetryMiddleware retries
+        self.backoff_exceptions = tuple(load_object(exception) if isinstance(exception, str) else exception
+                                        for exception in settings.getlist('RETRY_EXCEPTIONS'))
+        # SlotThrottle by slot key
+        self.throttles = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def _throttle(self, key):
+        """
+        :param key: downloader slot key
+        :return: tuple of (SlotThrottle, downloader Slot), or (None, None) if the slot does not exist yet
+        """
+        downloader = self.crawler.engine.downloader
+        slot = downloader.slots.get(key)
+        if slot is None:
+            return None, None
+        throttle = self.throttles.get(key)
+        if throttle is None:
+            # Concurrency configured for the slot (eg. for an endpoint) is the most it is allowed to reach
+            max_concurrency = downloader.per_slot_settings.get(key, {}).get('concurrency', self.max_concurrency)
+            if self.start_concurrency is None:
+                max_concurrency = max(max_concurrency, slot.concurrency)
+            throttle = self.throttles[key] = SlotThrottle(self.start_concurrency or slot.concurrency,
+                                                          max_concurrency, slot.delay,
+                                                          self.max_delay, self.tolerance, slot.randomize_delay)
+        return throttle, slot
+
+    def _apply(self, key, throttle, slot, now):
+        slot.concurrency = int(throttle.concurrency)
+        slot.delay = throttle.slot_delay(now, slot.lastseen)
+        # A randomized delay (0.5 to 1.5 times slot.delay) would send requests before a Retry-After pause is over
+        throttle.pause_applied = throttle.paused(now)
+        slot.randomize_delay = throttle.randomize_delay and not throttle.pause_applied
+        self.stats.set_value(f'throttle/concurrency/{key}', slot.concurrency)
+        self.stats.set_value(f'throttle/delay/{key}', round(slot.delay, 3))
+        self.stats.set_value(f'throttle/rate/{key}', round(throttle.rate, 2))
+
+    def process_request(self, request, spider):
+        # The slot is created by the downloader for the first request, later requests start it at
+        # ADAPTIVE_THROTTLE_START_CONCURRENCY (if set). After a Retry-After pause the normal delay is set back
+        key = request.meta.get('download_slot', urlparse_cached(request).hostname or '')
+        throttle, slot = self._throttle(key)
+        if throttle is None:
+            return None
+        now = time.time()
+        if throttle.paused(now):
+            # Held here until the pause is over: in the slot it would wait the pause delay again after the
+            # first request, as the downloader counts the delay from the last request sent
+            from twisted.internet import reactor, task
+            return task.deferLater(reactor, throttle.paused_until - now, self._resume, key, throttle, slot)
+        if throttle.latency is None or throttle.pause_applied:
+            self._apply(key, throttle, slot, now)
+        return None
+
+    def _resume(self, key, throttle, slot):
+        self._apply(key, throttle, slot, time.time())
+        return None
+
+    def process_response(self, request, response, spider):
+        key = request.meta.get('download_slot')
+        throttle, slot = self._throttle(key)
+        if throttle is None:
+            return response
+        now = time.time()
+        throttle.response_received(now)
+        if response.status in self.backoff_codes:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'), now)
+            throttle.back_off(now, retry_after)
+            self.stats.inc_value(f'throttle/backoff_count/{key}')
+            logger.info(f"Backing off {key} after HTTP {response.status}: concurrency {int(throttle.concurrency)}, "
+                        f"waiting {throttle.slot_delay(now, now):.1f}s" + (f" (Retry-After {retry_after:.0f}s)"
+                                                                      if retry_after is not None else ""))
+        elif 'download_latency' in request.meta:
+            throttle.latency_measured(request.meta['download_latency'])
+        self._apply(key, throttle, slot, now)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if not isinstance(exception, self.backoff_exceptions):
+            return None
+        key = request.meta.get('download_slot')
+        throttle, slot = self._throttle(key)
+        if throttle is not None:
+            now = time.time()
+            throttle.back_off(now)
+            self.stats.inc_value(f'throttle/backoff_count/{key}')
+            logger.info(f"Backing off {key} after {exception.__class__.__name__}: "
+                        f"concurrency {int(throttle.concurrency)}, delay {throttle.delay:.1f}s")
+            self._apply(key, throttle, slot, now)
+        return None
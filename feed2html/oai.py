@@ -0,0 +1,304 @@
+"""
+OAI-PMH protocol helpers shared by the OAI spiders: request URL building, harvest identification
+and streaming response parsing
+"""
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from xml.sax.saxutils import unescape
+
+from lxml import etree
+
+OAI_NAMESPACE = 'http://www.openarchives.org/OAI/2.0/'
+
+# Responses come from endpoints we do not control: never expand entities (billion laughs) or load external
+# entities and DTDs (XXE), whether from the network or the local filesystem
+SAFE_PARSER_OPTIONS = {'resolve_entities': False, 'no_network': True, 'load_dtd': False}
+# Shared by the helpers parsing whole responses; lxml parsers are not thread safe, they run on the reactor thread
+SAFE_PARSER = etree.XMLParser(**SAFE_PARSER_OPTIONS)
+
+
+def split_url(url):
+    """
+    Split an OAI-PMH request URL into the base endpoint URL and its query parameters
+
+    :param url: OAI-PMH request URL, eg. https://host/oai/request?verb=ListRecords&metadataPrefix=oai_dc
+    :return: tuple of (base URL, dict of query parameters)
+    """
+    parts = urlsplit(url)
+    base_url = urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+    return base_url, dict(parse_qsl(parts.query))
+
+
+def with_params(url, **params):
+    """
+    Return the URL with query parameters added or replaced. Parameters with a value of None are removed.
+    Use from_ for the OAI 'from' argument, as from is a reserved word in Python
+
+    :param url: OAI-PMH request URL
+    :param params: query parameters to set
+    :return: URL
+    """
+    base_url, query = split_url(url)
+    for name, value in params.items():
+        name = name.rstrip('_')
+        if value is None:
+            query.pop(name, None)
+        else:
+            query[name] = value
+    return f"{base_url}?{urlencode(query)}"
+
+
+def harvest_key(url):
+    """
+    Identify a harvest by its endpoint, set and metadataPrefix, so that state can be kept per harvest
+
+    :param url: OAI-PMH ListRecords URL
+    :return: string key
+    """
+    base_url, query = split_url(url)
+    return f"{base_url}|{query.get('set', '')}|{query.get('metadataPrefix', '')}"
+
+
+def source_name(name):
+    """
+    :param name: source name, eg. from the endpoints file
+    :return: the name made safe to use as a directory name
+    """
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+class Harvest:
+    """
+    One list request and its resumption token chain: which endpoint, set and source it belongs to,
+    how far it has got, and the page ordering state used for prefetching.
+    A spider can run several harvests at once, each page request carries the key of its harvest.
+    A partitioned harvest is split into several harvests of the same endpoint (one per set, or per
+    from/until window), which have the key of the harvest they were split from as their parent
+    """
+
+    def __init__(self, url, source=None, harvest_from=None, parent=None, window=None):
+        """
+        :param url: OAI-PMH ListRecords URL, with set and metadataPrefix
+        :param source: name of the source the records are stored under, None for a single-source crawl
+        :param harvest_from: 'from' datestamp of this harvest, None for a full harvest
+        :param parent: key of the harvest this one is a partition of
+        :param window: (from, until) datestamps of a date window partition, until None for an open window
+        """
+        self.url = url
+        self.source = source
+        self.parent = parent
+        # Harvest state is kept per endpoint, set and metadataPrefix. The windows of a harvest share its state
+        self.state_key = harvest_key(url)
+        self.key = self.state_key
+        self.harvest_from = harvest_from
+        self.window = window
+        if window is not None:
+            self.harvest_from, until = window
+            self.url = with_params(url, until=until)
+            self.key = f"{self.state_key}|{self.harvest_from}/{until or ''}"
+        # Highest datestamp seen in this harvest
+        self.high_water = None
+        # True once the last page of the chain has been processed
+        self.complete = False
+        # Number of pages requested and not yet processed, the chain has ended when this drops to 0
+        self.outstanding = 0
+        # Page prefetching: the next page number to hand to the pipelines, pages which arrived early,
+        # pages whose next page has already been requested, and a next page request held back
+        self.next_page = 0
+        self.waiting_pages = {}
+        self.requested_pages = set()
+        self.held_request = None
+        # Checkpointing (with a job ID): per page still in the pipelines, the items not yet through them, whether
+        # the page has been parsed, its record count and highest datestamp; the resumption token of each page
+        self.pages = {}
+        self.tokens = {}
+        # The next page to checkpoint, and as of the last checkpoint: the token to continue from, the number of
+        # records through the pipelines and their highest datestamp
+        self.checkpoint_page = 0
+        self.resume_token = None
+        self.completed = 0
+        self.checkpoint_high_water = None
+        # False once a record came with a lower datestamp than one before it, then a 'from' datestamp cannot
+        # stand in for an expired resumption token
+        self.ordered = True
+        self.restarts = 0
+        # Items of this harvest which failed in a pipeline (item_error)
+        self.errors = 0
+
+    @property
+    def start_url(self):
+        """
+        The first request of the harvest, from the high-water mark of the last one if there is one
+        """
+        return with_params(self.url, from_=self.harvest_from) if self.harvest_from else self.url
+
+    def page_progress(self, page):
+        """
+        :param page: page number
+        :return: checkpoint progress of the page: dict of outstanding items, parsed, records, high_water and
+            failed (a pipeline failed on one of its items)
+        """
+        progress = self.pages.get(page)
+        if progress is None:
+            progress = self.pages[page] = {'outstanding': 0, 'parsed': False, 'records': 0, 'high_water': None,
+                                           'failed': False}
+        return progress
+
+
+def load_endpoints(path):
+    """
+    Read the endpoints file of a multi-endpoint harvest. This is a JSON list of endpoints (or an object
+    with an "endpoints" list), each with
+    - "url": ListRecords URL with metadataPrefix (required)
+    - "name": source name, used to keep each source's output apart (default: the endpoint host)
+    - "sets": list of sets to harvest, each as its own resumption chain (default: the set in the URL, if any)
+    - "concurrency", "delay": politeness limits for the endpoint host (default: the crawl settings)
+    - "partition": 'sets' or 'dates' to split the harvest into parallel resumption chains (default: the spider's)
+
+    :param path: path to the endpoints file
+    :return: list of endpoint dicts, with name and sets filled in
+    """
+    with open(path, 'r', encoding='utf8') as f:
+        endpoints = json.load(f)
+    if isinstance(endpoints, dict):
+        endpoints = endpoints['endpoints']
+    for endpoint in endpoints:
+        endpoint['name'] = source_name(endpoint.get('name') or urlsplit(endpoint['url']).hostname)
+        endpoint.setdefault('sets', [])
+    names = [endpoint['name'] for endpoint in endpoints]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Endpoint names must be unique in {path}: {names}")
+    return endpoints
+
+
+def resumption_url(url, token):
+    """
+    Build the request URL for the next page of a list request. The resumptionToken argument is exclusive,
+    so metadataPrefix, set, from and until are not repeated
+
+    :param url: the original OAI-PMH list request URL
+    :param token: resumption token from the previous page
+    :return: URL
+    """
+    base_url, query = split_url(url)
+    return f"{base_url}?{urlencode({'verb': query.get('verb', 'ListRecords'), 'resumptionToken': token})}"
+
+
+def iterparse_page(body):
+    """
+    Stream the records of an OAI-PMH list response one at a time, without building the DOM of the whole page.
+    Yields ('record', element) for each record, then ('resumptionToken', element) and ('error', element)
+    if present. Each element is cleared once the consumer moves on, so only do work with it (parse and
+    serialise) before asking for the next one.
+
+    :param body: response body bytes
+    :return: generator of (local tag name, lxml element)
+    """
+    tags = [f"{{{OAI_NAMESPACE}}}{name}" for name in ('record', 'resumptionToken', 'error')]
+    context = etree.iterparse(BytesIO(body), events=('end',), tag=tags, **SAFE_PARSER_OPTIONS)
+    for _, element in context:
+        yield etree.QName(element).localname, element
+        # Free the finished element and the records before it, so memory use does not grow with the page
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+# Matches a resumptionToken element with or without a namespace prefix, including the empty <resumptionToken/>
+RESUMPTION_TOKEN_PATTERN = re.compile(
+    rb'<(?:[\w.-]+:)?resumptionToken\b[^>]*?(?:/>|>([^<]*)</(?:[\w.-]+:)?resumptionToken\s*>)')
+
+
+def sniff_resumption_token(body, tail=64 * 1024):
+    """
+    Find the resumption token of a page without parsing it. The token is the last element of a list
+    response, so only the end of the body is searched
+
+    :param body: response body bytes
+    :param tail: number of bytes at the end of the body to search
+    :return: the token, '' for the empty token of the last page, or None if no resumptionToken was found
+    """
+    matches = RESUMPTION_TOKEN_PATTERN.findall(body[-tail:])
+    if not matches:
+        return None
+    return unescape(matches[-1].decode('utf8')).strip()
+
+
+def top_level_sets(set_specs):
+    """
+    Drop the sets whose parent set is also listed: a set contains the records of its subsets
+    (setSpec 'a:b' is a subset of 'a'), so they would only be harvested twice
+
+    :param set_specs: list of setSpec strings
+    :return: list of setSpec strings, in the same order
+    """
+    listed = set(set_specs)
+    top_level = []
+    for spec in set_specs:
+        parts = spec.split(':')
+        if not any(':'.join(parts[:end]) in listed for end in range(1, len(parts))):
+            top_level.append(spec)
+    return top_level
+
+
+def parse_list_sets(body):
+    """
+    :param body: ListSets response body bytes
+    :return: tuple of (list of setSpec strings, resumption token or None)
+    """
+    root = etree.fromstring(body, SAFE_PARSER)
+    namespaces = {'oaipmh': OAI_NAMESPACE}
+    set_specs = [spec.strip() for spec in root.xpath('//oaipmh:set/oaipmh:setSpec/text()', namespaces=namespaces)]
+    token = root.xpath('string(//oaipmh:resumptionToken)', namespaces=namespaces).strip()
+    return set_specs, token or None
+
+
+def parse_identify(body):
+    """
+    :param body: Identify response body bytes
+    :return: tuple of (earliestDatestamp, granularity), None for either if the response does not have it
+    """
+    root = etree.fromstring(body, SAFE_PARSER)
+    namespaces = {'oaipmh': OAI_NAMESPACE}
+    earliest = root.xpath('string(//oaipmh:Identify/oaipmh:earliestDatestamp)', namespaces=namespaces).strip()
+    granularity = root.xpath('string(//oaipmh:Identify/oaipmh:granularity)', namespaces=namespaces).strip()
+    return earliest or None, granularity or None
+
+
+def date_windows(start, end, count, granularity='YYYY-MM-DD'):
+    """
+    Split a datestamp range into from/until windows. OAI from and until are inclusive, so each window
+    ends one unit (a day or a second) before the next one starts. The last window is open, so records
+    changed while the harvest runs are still picked up
+
+    :param start: first datestamp, eg. the earliestDatestamp of the repository or the last high-water mark
+    :param end: datetime the range ends at (usually now)
+    :param count: number of windows
+    :param granularity: datestamp granularity of the repository, 'YYYY-MM-DD' or 'YYYY-MM-DDThh:mm:ssZ'
+    :return: list of (from, until) datestamp strings, until None for the last window
+    """
+    seconds = granularity == 'YYYY-MM-DDThh:mm:ssZ'
+    unit = timedelta(seconds=1) if seconds else timedelta(days=1)
+    datestamp_format = '%Y-%m-%dT%H:%M:%SZ' if seconds else '%Y-%m-%d'
+    first = datetime.strptime(start[:10], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    if seconds and len(start) >= 19:
+        first = datetime.strptime(start[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    step = max((end - first) / max(count, 1), unit)
+    # Window boundaries, rounded down to the granularity of the repository
+    boundaries = []
+    for i in range(max(count, 1)):
+        boundary = first + step * i
+        boundary = boundary.replace(microsecond=0) if seconds else boundary.replace(hour=0, minute=0, second=0,
+                                                                                      microsecond=0)
+        if boundary > end:
+            break
+        if not boundaries or boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    windows = []
+    for i, boundary in enumerate(boundaries):
+        until = (boundaries[i + 1] - unit).strftime(datestamp_format) if i + 1 < len(boundaries) else None
+        windows.append((boundary.strftime(datestamp_format), until))
+    return windows
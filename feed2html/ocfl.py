@@ -0,0 +1,385 @@
+"""
+Helpers for the parts of OCFL that the ocflcore library does not implement yet: reading an existing
+object back from its inventory, adding a version to it, a hashed storage layout, and the index
+of stored objects and their content
+"""
+import ctypes
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from contextlib import suppress
+from datetime import datetime
+from io import BytesIO
+from types import SimpleNamespace
+
+from ocflcore import FileSystemStorage, OCFLObject, OCFLVersion, StorageLayout, TopLevelLayout
+from ocflcore.persistence.inventory import Inventory, InventoryContent
+
+logger = logging.getLogger(__name__)
+
+
+class HashedNTupleLayout(StorageLayout):
+    """
+    OCFL storage layout extension 0004: objects are stored under directories made from the first tuples
+    of the SHA-256 digest of their ID, eg. 7d4/bb2/de9/7d4bb2de9..., so no directory in the storage root
+    grows to more than 4096 entries however many objects there are
+    See https://ocfl.github.io/extensions/0004-hashed-n-tuple-storage-layout.html
+    """
+    description = "Hashed N-tuple storage layout"
+    extension = "0004-hashed-n-tuple-storage-layout"
+
+    def __init__(self, tuple_size=3, number_of_tuples=3):
+        self.tuple_size = tuple_size
+        self.number_of_tuples = number_of_tuples
+
+    @property
+    def config(self):
+        """
+        Extension configuration, written to extensions/<extension>/config.json in the storage root
+        """
+        return {
+            "extensionName": self.extension,
+            "digestAlgorithm": "sha256",
+            "tupleSize": self.tuple_size,
+            "numberOfTuples": self.number_of_tuples,
+            "shortObjectRoot": False,
+        }
+
+    def path_for(self, obj):
+        digest = hashlib.sha256(obj.id.encode('utf8')).hexdigest()
+        tuples = [digest[i * self.tuple_size:(i + 1) * self.tuple_size] for i in range(self.number_of_tuples)]
+        return '/'.join(tuples + [digest])
+
+
+# Storage layouts by OCFL_STORAGE_LAYOUT setting value
+STORAGE_LAYOUTS = {
+    'flat': TopLevelLayout,
+    'hashed': HashedNTupleLayout,
+}
+
+
+def object_path(layout, object_id):
+    """
+    :param layout: storage layout
+    :param object_id: OCFL object ID
+    :return: path of the object root, relative to the storage root
+    """
+    return layout.path_for(SimpleNamespace(id=object_id))
+
+
+def iter_object_roots(storage_root):
+    """
+    Walk a storage root and yield the root directory of every object in it, whatever the layout.
+    Object roots are recognised by their conformance declaration
+
+    :param storage_root: path to the storage root
+    :return: generator of object root paths
+    """
+    directories = [storage_root]
+    while directories:
+        directory = directories.pop()
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+        if any(entry.name.startswith('0=ocfl_object_') for entry in entries):
+            yield directory
+            continue
+        directories.extend(entry.path for entry in entries if entry.is_dir() and entry.name != 'extensions')
+
+
+def read_inventory(object_root):
+    """
+    :param object_root: path to the object root directory
+    :return: the parsed inventory.json of the object
+    """
+    with open(os.path.join(object_root, 'inventory.json'), 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def head_file(inventory, logical_path):
+    """
+    Find a file in the head version of an object
+
+    :param inventory: parsed inventory of the object
+    :param logical_path: logical path of the file, eg. record.xml
+    :return: tuple of (digest, content path relative to the object root), or None if the head version
+        has no such file
+    """
+    for digest, logical_paths in inventory['versions'][inventory['head']]['state'].items():
+        if logical_path in logical_paths:
+            return digest, inventory['manifest'][digest][0]
+    return None
+
+
+def scan_objects(storage_root):
+    """
+    Find the IDs of all objects in a storage root by walking it, whatever the layout.
+    The ID is read from the inventory of each object
+
+    :param storage_root: path to the storage root
+    :return: set of object IDs
+    """
+    return {read_inventory(object_root)['id'] for object_root in iter_object_roots(storage_root)}
+
+
+class FileStream:
+    """
+    Read-only file stream which is only opened when first read and is closed as soon as it is read
+    to the end, so building versions with many files does not hold a file handle per file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def read(self, size=-1):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        chunk = self._file.read(size)
+        if not chunk:
+            self.close()
+        return chunk
+
+    def seek(self, offset, whence=0):
+        if self._file is not None:
+            self._file.seek(offset, whence)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LinkingFileSystemStorage(FileSystemStorage):
+    """
+    File system storage which writes FileStreams (files already on disk, eg. downloaded bitstreams)
+    without reading them through Python: by hard link, by reflink (copy-on-write clone, on filesystems
+    such as btrfs and XFS), or by a kernel-side copy. Anything else is written as usual
+
+    link_mode is one of:
+    - 'copy': shutil.copyfile, which uses sendfile/copy_file_range on Linux
+    - 'reflink': clone the file if the filesystem supports it, otherwise copy
+    - 'hardlink': hard link the file if it is on the same filesystem, otherwise copy. Only safe if
+      the source files are never modified in place afterwards, as the OCFL content is the same inode
+    """
+
+    def __init__(self, root_path, link_mode='copy'):
+        super().__init__(root_path)
+        self.link_mode = link_mode
+
+    def write(self, file_path, stream):
+        if not isinstance(stream, FileStream):
+            return super().write(file_path, stream)
+        file_path = self._p(file_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if self.link_mode == 'hardlink':
+            with suppress(OSError):
+                os.link(stream.path, file_path)
+                return
+        elif self.link_mode == 'reflink':
+            with suppress(OSError):
+                _reflink(stream.path, file_path)
+                return
+        shutil.copyfile(stream.path, file_path)
+
+
+# ioctl request number to clone a file (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """
+    Clone src to dst with the Linux FICLONE ioctl. Raises OSError if the filesystem does not support it
+    """
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def load_object(object_root):
+    """
+    Rebuild an OCFL object from the inventory of an object on disk. Files are FileStreams
+    on the existing content files, so nothing is read unless the content is written again
+
+    :param object_root: path to the object root directory
+    :return: OCFLObject with all of its versions
+    """
+    inventory = read_inventory(object_root)
+    obj = OCFLObject(inventory['id'],
+                     content_directory=inventory.get('contentDirectory', 'content'),
+                     digest_algorithm=inventory['digestAlgorithm'])
+    # Content path -> [(algorithm, digest)], so fixity survives adding a version
+    fixity = {}
+    for algorithm, digests in inventory.get('fixity', {}).items():
+        for fixity_digest, content_paths in digests.items():
+            for content_path in content_paths:
+                fixity.setdefault(content_path, []).append((algorithm, fixity_digest))
+    for name in sorted(inventory['versions'], key=lambda v: int(v[1:])):
+        version_inventory = inventory['versions'][name]
+        version = OCFLVersion(datetime.fromisoformat(version_inventory['created']))
+        for digest, logical_paths in version_inventory['state'].items():
+            content_path = inventory['manifest'][digest][0]
+            for logical_path in logical_paths:
+                version.files.add(logical_path, FileStream(os.path.join(object_root, content_path)), digest,
+                                  fixity=fixity.get(content_path))
+        obj.versions.append(version)
+    return obj
+
+
+def _sorted_state(version):
+    return {digest: sorted(paths) for digest, paths in version.state.items()}
+
+
+def add_version(object_root, workspace_root, version, link_mode='copy'):
+    """
+    Add a version to an existing object. Only content new in this version is written: it is assembled in
+    the workspace, moved into the object, and then the inventories are replaced
+
+    :param object_root: path to the object root directory
+    :param workspace_root: path to the workspace directory used to assemble the version
+    :param version: the new OCFLVersion
+    :param link_mode: how files already on disk are written, see LinkingFileSystemStorage
+    :return: False if the version has the same state as the head version and was not added, otherwise True
+    """
+    obj = load_object(object_root)
+    if _sorted_state(obj.head) == _sorted_state(version):
+        return False
+    obj.versions.append(version)
+    version_dir = f"v{len(obj.versions)}"
+
+    staging_root = os.path.join(workspace_root, f"{os.path.basename(object_root)}-{version_dir}")
+    staging = LinkingFileSystemStorage(staging_root, link_mode)
+    for content_path, f in obj.content_files():
+        if content_path.startswith(f"{version_dir}/"):
+            staging.write(content_path, f.stream)
+    content = InventoryContent(Inventory(obj))
+    for path in (content.name, f"{version_dir}/{content.name}"):
+        staging.write(path, BytesIO(content.bytes))
+    for path in (content.sidecar_name, f"{version_dir}/{content.sidecar_name}"):
+        staging.write(path, BytesIO(content.sidecar_bytes))
+
+    # The version directory goes in first, the inventory that refers to it last
+    shutil.move(os.path.join(staging_root, version_dir), os.path.join(object_root, version_dir))
+    os.replace(os.path.join(staging_root, content.sidecar_name), os.path.join(object_root, content.sidecar_name))
+    os.replace(os.path.join(staging_root, content.name), os.path.join(object_root, content.name))
+    shutil.rmtree(staging_root, ignore_errors=True)
+    return True
+
+
+def sync_filesystem(path):
+    """
+    Flush everything written to the filesystem holding path to stable storage: one syncfs call
+    for a whole batch of writes instead of an fsync per file. Falls back to sync where syncfs is not available
+
+    :param path: a path on the filesystem to sync
+    :return: None
+    """
+    try:
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (AttributeError, OSError):
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if syncfs(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+def content_digest(*digests):
+    """
+    Combine the digests of everything stored for an object into one digest, used to tell whether
+    an object has changed since it was last written
+
+    :param digests: digest strings
+    :return: hex digest
+    """
+    return hashlib.sha256('\n'.join(digests).encode('utf8')).hexdigest()
+
+
+class ObjectIndex:
+    """
+    Persistent index of the objects in a storage root, mapping each OCFL object ID to the content digest
+    of the object when it was last written (None if unknown). Stored as JSON next to the storage root,
+    so checking whether an object exists does not touch the storage root at all.
+    A marker file is kept while a crawl has the index open. If it is still there when the index is
+    loaded, the last crawl did not save the index and it must be rebuilt from the storage root.
+    The OCFL writer thread updates the index while the reactor thread reads it, so access is locked
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the JSON index file. It is created on the first save
+        """
+        self.path = path
+        self.open_path = f"{path}.open"
+        self.objects = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as f:
+                self.objects = json.load(f)
+        # True if the index is known to match the storage root
+        self.clean = os.path.exists(path) and not os.path.exists(self.open_path)
+
+    def __contains__(self, object_id):
+        with self._lock:
+            return object_id in self.objects
+
+    def __len__(self):
+        with self._lock:
+            return len(self.objects)
+
+    def get(self, object_id):
+        with self._lock:
+            return self.objects.get(object_id)
+
+    def set(self, object_id, digest):
+        with self._lock:
+            self.objects[object_id] = digest
+
+    def remove(self, object_id):
+        with self._lock:
+            self.objects.pop(object_id, None)
+
+    def rebuild(self, object_ids):
+        """
+        Make the index match the objects found in the storage root. The digests are all unknown: the crawl which
+        left the index open may have written new versions of any object since the digests were saved, so an
+        object is only skipped again once it has been written (or found unchanged by add_version)
+
+        :param object_ids: IDs of the objects in the storage root
+        :return: None
+        """
+        objects = dict.fromkeys(object_ids)
+        with self._lock:
+            self.objects = objects
+            self.clean = True
+
+    def open(self):
+        """
+        Mark the index as in use, until it is saved
+        """
+        with open(self.open_path, 'w'):
+            pass
+
+    def save(self):
+        """
+        Write the index file, via a temporary file so that a crash never leaves a truncated index
+        """
+        with self._lock:
+            objects = dict(self.objects)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(objects, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        with suppress(FileNotFoundError):
+            os.remove(self.open_path)
+        logger.info(f"Saved OCFL object index of {len(objects)} objects to {self.path}")
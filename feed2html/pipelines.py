@@ -3,13 +3,18 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 import hashlib
+import json
 import logging
 import mimetypes
+import queue
 import shutil
+import threading
+import time
 from contextlib import suppress
 from pathlib import Path
 
-from scrapy import settings
+from scrapy import settings, signals
+from scrapy.exceptions import StopDownload
 from scrapy.utils.python import to_bytes
 
 import scrapy.pipelines.files
@@ -32,11 +37,24 @@ from ocflcore import (
     OCFLVersion,
     StorageRoot,
     StreamDigest,
-    TopLevelLayout,
 )
 from scrapy.utils.request import referer_str
 
 from feed2html.exporters import MarkdownItemExporter
+from feed2html.files import PartialDownload, expected_file, file_hashes, parse_content_range
+from feed2html.ocfl import (
+    STORAGE_LAYOUTS,
+    FileStream,
+    LinkingFileSystemStorage,
+    ObjectIndex,
+    add_version,
+    content_digest,
+    object_path,
+    scan_objects,
+    sync_filesystem,
+)
+from feed2html.search import SearchIndexBuilder
+from feed2html.xslt import StylesheetCache, spider_params, transform_record
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +64,9 @@ def get_file_paths(item):
         prefix = item['hash'][:2]
 
     file_path = f"{prefix}/{item['hash']}"
+    if item.get('source'):
+        # Keep the files of each source of a multi-endpoint harvest apart
+        file_path = f"{item['source']}/{file_path}"
     return file_path
 
 class Feed2HtmlPipeline:
@@ -53,43 +74,59 @@ class Feed2HtmlPipeline:
         return item
 
 class ExportMarkdownPipeline(object):
+    """
+    Write a metadata.md file with YAML frontmatter for each item, next to its downloaded files.
+    One exporter is used for the whole crawl, each file is written to a temporary name, closed,
+    and renamed into place, and the shard directories already created are remembered
+    """
+    fields_to_export = ['hash', 'id', 'title',
+                        'identifier',
+                        'publication_type',
+                        'abstract',
+                        'date_issued',
+                        'subject',
+                        'language',
+                        'files',
+                        ]
+
     def __init__(self):
         self.exporter = None
+        # Shard (hash prefix) directories known to exist
+        self.directories = set()
 
     def open_spider(self, spider):
-        print('Custom export spider opened')
+        # The exporter is only given a file when an item is exported
+        self.exporter = MarkdownItemExporter(None, fields_to_export=self.fields_to_export)
+        self.exporter.start_exporting()
 
     def process_item(self, item, spider):
-        if item is not None:
+        if item is not None and item.get('deleted'):
+            # Record was deleted upstream, so remove its metadata and downloaded files
+            shutil.rmtree(f"{spider.file_crawl_path}/{get_file_paths(item)}", ignore_errors=True)
+        elif item is not None:
             base_path = spider.file_crawl_path
             file_path = f"{base_path}/{get_file_paths(item)}"
-            # Opening file in binary-write mode
-            os.makedirs(file_path, exist_ok=True)
-            file = open(f"{file_path}/metadata.md", 'wb')
-            #file = open(f"crawls/test.md", 'wb')
-            self.file_handle = file
-
-            # Creating a FanItemExporter object and initiating export
-            self.exporter = MarkdownItemExporter(file, fields_to_export=['hash', 'id', 'title',
-                                                                         'identifier',
-                                                                         'publication_type',
-                                                                         'abstract',
-                                                                         'date_issued',
-                                                                         'subject',
-                                                                         'language',
-                                                                         'files',
-                                                                         ],
-                                                 )
-            self.exporter.start_exporting()
-            logger.info(f"ABOUT TO EXPORT FOR {item['hash']}")
-            self.exporter.export_item(item)
-            # Ending the export to file from FanItemExport object
-            self.exporter.finish_exporting()
+            shard_path = os.path.dirname(file_path)
+            if shard_path not in self.directories:
+                os.makedirs(shard_path, exist_ok=True)
+                self.directories.add(shard_path)
+            with suppress(FileExistsError):
+                os.mkdir(file_path)
+
+            # Write to a temporary file and rename it, so metadata.md is never seen half written
+            tmp_path = f"{file_path}/.metadata.md.tmp"
+            with open(tmp_path, 'wb') as file:
+                self.exporter.file = file
+                logger.debug(f"Exporting {item['hash']} to markdown")
+                self.exporter.export_item(item)
+                self.exporter.file = None
+                spider.crawler.stats.inc_value(f'bytes_written/{type(self).__name__}', file.tell())
+            os.replace(tmp_path, f"{file_path}/metadata.md")
 
         return item
 
     def close_spider(self, spider):
-        print('Custom Exporter closed')
+        self.exporter.finish_exporting()
 
 
 
@@ -97,28 +134,148 @@ class TransformXmlPipeline:
     """
     Simple pipeline that handles XSLT. The initial use case was generating HTML pages for a static
     website but this pipeline could easily be repurposed or extended to do XML-to-XML, etc...
+
+    By default the transform runs inline on the reactor thread. Setting XSLT_WORKERS runs it in a pool
+    of worker threads instead (lxml releases the GIL while parsing and transforming), and process_item
+    returns a Deferred so the reactor keeps downloading while records are rendered.
     """
 
-    def process_item(self, item, spider):
-        # Transform the XML record to HTML
-        xslt_root = etree.parse(spider.path_to_xsl)
-        transform = etree.XSLT(xslt_root)
-        root = etree.XML(item['xml'])
-        result = transform(root,
-                           website_title=transform.strparam(spider.website_title),
-                           website_subtitle=transform.strparam(spider.website_subtitle),
-                           path_to_assets=transform.strparam(spider.path_to_assets),
-                           publication_date=transform.strparam(str(item['date_issued']))
-                           )
-
-        # logging.info("text=%s", result.getroot().text)
-        # logging.info(str(result))
+    def __init__(self, reload_interval=1.0, workers=0):
+        self.reload_interval = reload_interval
+        self.workers = workers
+        # Worker thread pool, only started when workers > 0
+        self.threadpool = None
+        # Compiled stylesheets are per thread, as lxml XSLT objects should not be shared between threads
+        self._local = threading.local()
+        # Quoted XSLT parameters that are the same for every record
+        self.params = None
+        # Records waiting for or being transformed by a worker thread
+        self.pending = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(reload_interval=crawler.settings.getfloat('XSLT_RELOAD_INTERVAL', 1.0),
+                   workers=crawler.settings.getint('XSLT_WORKERS', 0))
+
+    def open_spider(self, spider):
+        """
+        Compile the stylesheet once for the whole crawl and prepare the spider-level parameters.
+        Compiling here also means a broken stylesheet fails before any records are harvested.
+        :param spider: the spider supplying items to this pipeline
+        :return: None
+        """
+        self._stylesheets().get(spider.path_to_xsl)
+        self.params = spider_params(spider)
+        if self.workers > 0:
+            from twisted.python.threadpool import ThreadPool
+            self.threadpool = ThreadPool(minthreads=self.workers, maxthreads=self.workers,
+                                         name='TransformXmlPipeline')
+            self.threadpool.start()
+
+    def close_spider(self, spider):
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
 
+    def _stylesheets(self):
+        """
+        Get the stylesheet cache for the current thread, creating it on first use
+        """
+        stylesheets = getattr(self._local, 'stylesheets', None)
+        if stylesheets is None:
+            stylesheets = StylesheetCache(self.reload_interval)
+            self._local.stylesheets = stylesheets
+        return stylesheets
+
+    def _transform(self, path_to_xsl, xml, publication_date):
+        # Transform the XML record to HTML with the cached stylesheet (recompiled only if the file changed)
+        transform = self._stylesheets().get(path_to_xsl)
+        return transform_record(transform, xml, self.params, publication_date)
+
+    def _store_html(self, result, item):
         # Save HTML output to the item
         item['html'] = result
-
         return item
 
+    def _transformed(self, result):
+        self.pending -= 1
+        return result
+
+    def queue_depths(self):
+        return {'xslt_workers': self.pending} if self.threadpool is not None else {}
+
+    def process_item(self, item, spider):
+        if item.get('deleted'):
+            # Deleted records have no metadata to transform
+            return item
+
+        if self.threadpool is None:
+            result = self._transform(spider.path_to_xsl, item['xml'], item['date_issued'])
+            return self._store_html(result, item)
+
+        from twisted.internet import reactor, threads
+        self.pending += 1
+        d = threads.deferToThreadPool(reactor, self.threadpool, self._transform,
+                                      spider.path_to_xsl, item['xml'], item['date_issued'])
+        d.addBoth(self._transformed)
+        d.addCallback(self._store_html, item)
+        return d
+
+
+class SourceRepository:
+    """
+    The OCFL repository of one source: storage root, workspace and object index under one directory
+    """
+
+    def __init__(self, path, layout, link_mode):
+        """
+        Initialise the OCFL repository (this only rewrites the storage root declaration and layout files,
+        so it is safe on an existing repository) and load the object index. If the index was not saved
+        by the last crawl it is rebuilt by scanning the storage root
+
+        :param path: repository directory, created if it does not exist
+        :param layout: storage layout name, see feed2html.ocfl.STORAGE_LAYOUTS
+        :param link_mode: how downloaded files are written into objects, see feed2html.ocfl.LinkingFileSystemStorage
+        """
+        self.path = path
+        self.root_path = f"{path}/root"
+        self.workspace_path = f"{path}/workspace"
+        # Create OCFL repo directory if necessary
+        os.makedirs(path, exist_ok=True)
+        storage_layout = STORAGE_LAYOUTS[layout]()
+        self._check_layout(layout, storage_layout)
+
+        # OCFL properties
+        ocfl_root = StorageRoot(storage_layout)
+        storage = FileSystemStorage(self.root_path)
+        workspace_storage = LinkingFileSystemStorage(self.workspace_path, link_mode)
+        # Instantiate and initialize the OCFL repository
+        self.repository = OCFLRepository(ocfl_root, storage, workspace_storage=workspace_storage)
+        self.repository.initialize()
+        if hasattr(storage_layout, 'config'):
+            storage.write(f"extensions/{storage_layout.extension}/config.json",
+                          BytesIO(json.dumps(storage_layout.config, indent=2).encode('utf8')))
+
+        self.index = ObjectIndex(f"{path}/index.json")
+        if not self.index.clean:
+            logger.info(f"Rebuilding OCFL object index from {self.root_path}")
+            self.index.rebuild(scan_objects(self.root_path))
+        self.index.open()
+
+    def _check_layout(self, layout, storage_layout):
+        """
+        Refuse to write objects with a different layout into an existing storage root
+        """
+        with suppress(FileNotFoundError):
+            with open(f"{self.root_path}/ocfl_layout.json", 'r', encoding='utf8') as f:
+                existing = json.load(f).get('extension')
+            if existing != storage_layout.extension:
+                raise ValueError(f"OCFL storage root {self.root_path} uses layout {existing or 'top-level'}, "
+                                 f"not {storage_layout.extension or 'top-level'} (OCFL_STORAGE_LAYOUT={layout})")
+
+    def object_root(self, object_id):
+        return f"{self.root_path}/{object_path(self.repository.root.layout, object_id)}"
+
 
 class WriteToOCFLPipeline:
     """
@@ -126,73 +283,339 @@ class WriteToOCFLPipeline:
     Make sure this pipeline is processed after all files have been transformed and saved
     to the item
     OCFL module documentation: https://ocflcore.readthedocs.io/
+
+    The repository is kept between runs. An index of the content digest of every object is stored
+    next to the storage root: unchanged records are skipped, and changed records get a new OCFL version.
+    Repository writes can be moved off the reactor thread to a writer thread with OCFL_WRITER_QUEUE_SIZE. An item
+    is passed on once its object has been written, and fails if the write does.
+    Items with a source (multi-endpoint harvests) are written to a repository per source, <path_to_ocfl>/<source>
     """
-    # OCFL repository
-    repository = None
+    # OCFL repositories (SourceRepository) by source, None for items without one
+    repositories = None
+
+    def __init__(self, layout='flat', link_mode='copy', queue_size=0, batch_size=50, fsync=False, stats=None):
+        # Storage layout name, see feed2html.ocfl.STORAGE_LAYOUTS
+        self.layout = layout
+        # How downloaded files are written into objects, see feed2html.ocfl.LinkingFileSystemStorage
+        self.link_mode = link_mode
+        # Background writer: queue size (0 writes on the reactor thread), batch size and group fsync
+        self.queue_size = queue_size
+        self.batch_size = max(batch_size, 1)
+        self.fsync = fsync
+        self.queue = None
+        self.writer = None
+        # With a writer thread: caps the jobs queued or being written, and fires when the thread has finished
+        self.slots = None
+        self.finished = None
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(layout=crawler.settings.get('OCFL_STORAGE_LAYOUT', 'flat'),
+                   link_mode=crawler.settings.get('OCFL_FILE_LINK_MODE', 'copy'),
+                   queue_size=crawler.settings.getint('OCFL_WRITER_QUEUE_SIZE', 0),
+                   batch_size=crawler.settings.getint('OCFL_WRITER_BATCH_SIZE', 50),
+                   fsync=crawler.settings.getbool('OCFL_FSYNC', False),
+                   stats=crawler.stats)
 
     def open_spider(self, spider):
         """
-        When the spider is opened, initialise the OCFL repository
-        TODO: Investigate if calling initialize on existing repository is dangerous
+        When the spider is opened, open the OCFL repository of items without a source. The repositories
+        of sources are opened when their first item arrives
         :param spider: the spider supplying items to this pipeline
         :return: None
         """
-        # Create OCFL repo directory if necessary
-        shutil.rmtree(spider.path_to_ocfl)
-        os.makedirs(spider.path_to_ocfl, exist_ok=True)
+        self.repositories = {}
+        if not getattr(spider, 'endpoints', None):
+            self.repository_for(spider, None)
+        if self.stats is None:
+            self.stats = spider.crawler.stats
+        if self.queue_size > 0:
+            from twisted.internet.defer import Deferred, DeferredSemaphore
+            # Bounded by the semaphore rather than the queue, so a job is never put from the reactor thread
+            # into a full queue
+            self.queue = queue.Queue()
+            self.slots = DeferredSemaphore(self.queue_size)
+            self.finished = Deferred()
+            self.writer = threading.Thread(target=self._write_loop, name='WriteToOCFLPipeline', daemon=True)
+            self.writer.start()
+
+    def repository_for(self, spider, source):
+        """
+        :param spider: the spider supplying items to this pipeline
+        :param source: item source, or None
+        :return: the SourceRepository the items of the source are written to, opened on first use
+        """
+        repository = self.repositories.get(source)
+        if repository is None:
+            path = f"{spider.path_to_ocfl}/{source}" if source else spider.path_to_ocfl
+            repository = self.repositories[source] = SourceRepository(path, self.layout, self.link_mode)
+        return repository
 
-        # OCFL properties
-        ocfl_root = StorageRoot(TopLevelLayout())
-        storage = FileSystemStorage(f"{spider.path_to_ocfl}/root")
-        workspace_storage = FileSystemStorage(f"{spider.path_to_ocfl}/workspace")
-        # Instantiate and initialize the OCFL repository
-        self.repository = OCFLRepository(ocfl_root, storage, workspace_storage=workspace_storage)
-        self.repository.initialize()
+    def queue_depths(self):
+        return {'ocfl_writer': self.queue.qsize()} if self.queue is not None else {}
+
+    def _save_indexes(self):
+        for repository in self.repositories.values():
+            repository.index.save()
+
+    def close_spider(self, spider):
+        if self.writer is None:
+            self._save_indexes()
+            return None
+        # Queue the end of the writes like any other job, and save the indexes once the writer thread is done
+        d = self.slots.acquire()
+        d.addCallback(lambda _: self.queue.put_nowait(None))
+        d.addCallback(lambda _: self.finished)
+        d.addCallback(lambda _: self._save_indexes())
+        return d
 
     def process_item(self, item, spider):
         """
         Process the item. Byte streams of the file contents and digests are
-        created and added to a new object, unless it exists.
-        TODO: Versioning (not yet impl in ocfl module)
-        TODO: Proper "get object by ID" check (not yet impl in ocfl module)
+        created and added to a new object. If the object exists and its content has changed
+        since it was written, a new version is added instead, otherwise the item is skipped.
+        With OCFL_WRITER_QUEUE_SIZE set, the repository write is queued for the writer thread, and a Deferred
+        is returned which fires once the object is written (and synced), or fails with the error of the write.
+        At most OCFL_WRITER_QUEUE_SIZE writes are queued, further items wait so the crawl slows down to the
+        write rate.
         :param item: the item being processed
         :param spider: spider (access to per-spider settings and objects)
-        :return: item
+        :return: item, or a Deferred firing with the item
         """
-        logging.error("PROCESSING OCFL PIPELINE")
-        # Only add if the ID does not already exist.
-        # To add versioning, we should compare digests? Or inspect how
-        # this is implemented elsewhere.
-        # It turns out ocflcore module has not implemented repository.get() or
-        # repository.add_version()!! Perhaps look back to zimeon/ocfl-py instead
-        # So for now we'll just do a quick directory check instead of
-        if not os.path.exists(f"{spider.path_to_ocfl}/root/{item['ocfl_id']}"):
-            # Write file contents and digest to new OCFL object and add
-            # to the repository
+        logger.debug(f"Writing {item['ocfl_id']} to OCFL")
+        repository = self.repository_for(spider, item.get('source'))
+        object_root = repository.object_root(item['ocfl_id'])
+        if item.get('deleted'):
+            # Record was deleted upstream. ocflcore cannot delete objects, so remove the object directory
+            d = self._submit(self._delete_object, repository, item['ocfl_id'], object_root)
+        else:
             ocfl_html_file = StreamDigest(BytesIO(item['html']))
             ocfl_xml_file = StreamDigest(BytesIO(bytes(item['xml'], encoding='utf8')))
-            v = OCFLVersion(datetime.now(timezone.utc))
-            v.files.add("page.html", ocfl_html_file.stream, ocfl_html_file.digest)
-            v.files.add("record.xml", ocfl_xml_file.stream, ocfl_xml_file.digest)
-
-            # Handle downloaded files
-            for file_added in item['files']:
-                full_path = f"{spider.file_crawl_path}/{file_added['path']}"
-                bin_file = StreamDigest(open(full_path, 'rb'))
-                filepath, filename = os.path.split(file_added['path'])
-                logger.warning(f"Adding {filename} file")
-                v.files.add(filename, bin_file.stream, bin_file.digest)
-
-            o = OCFLObject(item['ocfl_id'])
-            o.versions.append(v)
-            self.repository.add(o)
+            files = item.get('files', [])
+            # The downloaded files are compared by the checksum the files pipeline already computed,
+            # so an unchanged object is skipped without reading its files
+            digest = content_digest(ocfl_html_file.digest, ocfl_xml_file.digest,
+                                    *sorted(f"{file_added['path']} {file_added['checksum']}" for file_added in files))
+            d = None
+            if item['ocfl_id'] in repository.index and repository.index.get(item['ocfl_id']) == digest:
+                spider.crawler.stats.inc_value('ocfl/unchanged')
+            else:
+                d = self._submit(self._write_object, repository, spider, item['ocfl_id'], object_root,
+                                 ocfl_html_file, ocfl_xml_file, files, digest)
 
         item.pop('xml', None)
         item.pop('html', None)
 
+        if d is not None:
+            d.addCallback(lambda _: item)
+            return d
         return item
 
+    def _submit(self, job, *args):
+        """
+        Run a repository job now, or queue it for the writer thread once one of the OCFL_WRITER_QUEUE_SIZE
+        slots is free
+        :return: None, or a Deferred firing when the writer thread has run the job
+        """
+        if self.writer is None:
+            job(*args)
+            return None
+        d = self.slots.acquire()
+        d.addCallback(self._enqueue, job, args)
+        return d
+
+    def _enqueue(self, _, job, args):
+        from twisted.internet.defer import Deferred
+        done = Deferred()
+        done.addBoth(self._release)
+        self.queue.put_nowait((job, args, done))
+        return done
+
+    def _release(self, result):
+        self.slots.release()
+        return result
+
+    def _write_loop(self):
+        """
+        Writer thread: take jobs off the queue and run them in batches of up to OCFL_WRITER_BATCH_SIZE,
+        syncing the storage filesystem once per batch (OCFL_FSYNC) rather than once per file. The Deferred of
+        each job fires on the reactor thread after the batch is synced, with the error if the job failed
+        """
+        from twisted.internet import reactor
+        from twisted.python.failure import Failure
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Storage roots written to in this batch, and the outcome of each job
+            root_paths = set()
+            results = []
+            for job in batch:
+                if job is None:
+                    running = False
+                    continue
+                function, args, done = job
+                root_paths.add(args[0].root_path)
+                try:
+                    function(*args)
+                    results.append((done, None))
+                except Exception:
+                    self.stats.inc_value('ocfl/errors')
+                    results.append((done, Failure()))
+            if self.fsync:
+                for root_path in root_paths:
+                    sync_filesystem(root_path)
+            for done, failure in results:
+                if failure is None:
+                    reactor.callFromThread(done.callback, None)
+                else:
+                    reactor.callFromThread(done.errback, failure)
+        reactor.callFromThread(self.finished.callback, None)
+
+    def _delete_object(self, repository, object_id, object_root):
+        if object_id in repository.index:
+            shutil.rmtree(object_root, ignore_errors=True)
+            repository.index.remove(object_id)
+
+    def _write_object(self, repository, spider, object_id, object_root, ocfl_html_file, ocfl_xml_file, files, digest):
+        # Write file contents and digest to a new OCFL version
+        v = OCFLVersion(datetime.now(timezone.utc))
+        v.files.add("page.html", ocfl_html_file.stream, ocfl_html_file.digest)
+        v.files.add("record.xml", ocfl_xml_file.stream, ocfl_xml_file.digest)
+
+        # Handle downloaded files. They are written by path (linked or copied by the kernel), and the
+        # SHA-512 from the files pipeline is used when it has one, so a file is not read through Python
+        # at all. The MD5 checksum is kept as OCFL fixity
+        streams = []
+        size = len(ocfl_html_file.stream.getbuffer()) + len(ocfl_xml_file.stream.getbuffer())
+        try:
+            for file_added in files:
+                bin_file = FileStream(f"{spider.file_crawl_path}/{file_added['path']}")
+                streams.append(bin_file)
+                size += os.path.getsize(bin_file.path)
+                digest_sha512 = file_added.get('sha512') or StreamDigest(bin_file).digest
+                filepath, filename = os.path.split(file_added['path'])
+                logger.debug(f"Adding {filename} file")
+                v.files.add(filename, bin_file, digest_sha512, fixity=[('md5', file_added['checksum'])])
+
+            if object_id in repository.index:
+                # Add the version to the existing object (unless its content is the same as the head version)
+                if add_version(object_root, repository.workspace_path, v, self.link_mode):
+                    self.stats.inc_value('ocfl/versioned')
+                    self.stats.inc_value(f'bytes_written/{type(self).__name__}', size)
+                else:
+                    self.stats.inc_value('ocfl/unchanged')
+            else:
+                o = OCFLObject(object_id)
+                o.versions.append(v)
+                repository.repository.add(o)
+                self.stats.inc_value('ocfl/added')
+                self.stats.inc_value(f'bytes_written/{type(self).__name__}', size)
+        finally:
+            for stream in streams:
+                stream.close()
+        repository.index.set(object_id, digest)
+
+
+def search_key(item):
+    """
+    :param item: item
+    :return: key of the item in the search index: its export path if it has a hash, otherwise its OCFL object ID,
+        under its source for a multi-endpoint harvest
+    """
+    if item.get('hash'):
+        return get_file_paths(item)
+    key = item.get('ocfl_id') or item.get('id')
+    if isinstance(key, list):
+        key = key[0] if key else None
+    return f"{item['source']}/{key}" if item.get('source') else key
+
+
+class SearchIndexPipeline:
+    """
+    Build a static search index of the crawled items, for client-side search of the site (see feed2html.search).
+    Terms of the SEARCH_INDEX_FIELDS of each item are collected as it passes and written to run files, and the
+    sharded index in SEARCH_INDEX_DIR (default <path_to_assets>/search) is updated when the crawl closes, so
+    there is no second pass over the OCFL repository. Deleted records are removed from the index
+    """
+
+    def __init__(self, path=None, fields=None, prefix_length=2, documents_per_shard=1000, buffer_size=100000):
+        self.path = path
+        self.fields = fields
+        self.prefix_length = prefix_length
+        self.documents_per_shard = documents_per_shard
+        self.buffer_size = buffer_size
+        self.builder = None
+        self.stats = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(path=crawler.settings.get('SEARCH_INDEX_DIR'),
+                       fields=crawler.settings.getdict('SEARCH_INDEX_FIELDS') or None,
+                       prefix_length=crawler.settings.getint('SEARCH_INDEX_PREFIX_LENGTH', 2),
+                       documents_per_shard=crawler.settings.getint('SEARCH_INDEX_DOCUMENTS_PER_SHARD', 1000),
+                       buffer_size=crawler.settings.getint('SEARCH_INDEX_BUFFER', 100000))
+        pipeline.stats = crawler.stats
+        return pipeline
+
+    def open_spider(self, spider):
+        path = self.path or f"{spider.path_to_assets}/search"
+        self.builder = SearchIndexBuilder(path, fields=self.fields, prefix_length=self.prefix_length,
+                                          documents_per_shard=self.documents_per_shard, buffer_size=self.buffer_size)
+
+    def process_item(self, item, spider):
+        key = search_key(item)
+        if key is None:
+            return item
+        if item.get('deleted'):
+            self.builder.delete(key)
+            return item
+        title = item.get('title')
+        if isinstance(title, list):
+            title = title[0] if title else None
+        self.builder.add(key, title or key, item)
+        return item
+
+    def close_spider(self, spider):
+        # Merging into the index reads and writes every shard the crawl touched, off the reactor thread
+        from twisted.internet import threads
+        d = threads.deferToThread(self.builder.build)
+        d.addCallback(self._built)
+        return d
+
+    def _built(self, result):
+        logger.info(f"Search index in {self.builder.path}: {result['documents']} documents, "
+                    f"{result['changed']} added, updated or deleted, {result['shards']} term shards")
+        self.stats.set_value('search_index/documents', result['documents'])
+        self.stats.set_value('search_index/shards', result['shards'])
+        self.stats.inc_value(f'bytes_written/{type(self).__name__}', result['bytes'])
+
+
 class FilesRelativePipeline(scrapy.pipelines.files.FilesPipeline):
+    """
+    Files pipeline storing each file under the directory of its item (see get_file_paths), and checking files
+    against the size and MD5 published in the record metadata (item['files_to_download']):
+    - a file already on disk with the published size and MD5 is not downloaded again
+    - files of known size, and files above FILES_STREAM_THRESHOLD, are written to <path>.part as they arrive
+      and hashed on the way, so an interrupted download is resumed with an HTTP Range request on the next run
+    - where the server accepts range requests, large files are downloaded FILES_STREAM_THRESHOLD bytes at a time,
+      so memory use per download stays bounded whatever the size of the file
+    - a download which does not match the published size or MD5 fails, rather than being stored
+    This applies to a local FILES_STORE. Files in other stores are downloaded as by FilesPipeline
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.stream_threshold = crawler.settings.getint('FILES_STREAM_THRESHOLD', 16 * 1024 * 1024)
+        crawler.signals.connect(pipeline.headers_received, signal=signals.headers_received)
+        crawler.signals.connect(pipeline.bytes_received, signal=signals.bytes_received)
+        return pipeline
 
     def file_path(self, request, response=None, info=None, *, item=None):
         media_guid = hashlib.sha1(to_bytes(request.url)).hexdigest()
@@ -208,11 +631,119 @@ class FilesRelativePipeline(scrapy.pipelines.files.FilesPipeline):
         return f"{get_file_paths(item)}/contents/{media_guid}{media_ext}"
         #return f"{item['ocfl_id']}/contents/{media_guid}{media_ext}"
 
+    def get_media_requests(self, item, info):
+        requests = super().get_media_requests(item, info)
+        for request in requests:
+            request.meta['file_expected'] = expected_file(item.get('files_to_download'), request.url)
+        return requests
+
+    def media_to_download(self, request, info, *, item=None):
+        """
+        Check the file on disk against the published size and MD5 (or its age, without them, as FilesPipeline
+        does), and set up a streamed download
+        (resuming from the part file, if there is one) if it has to be downloaded
+
+        :return: the file_added result if the file is up to date, None to download it
+        """
+        if not isinstance(self.store, scrapy.pipelines.files.FSFilesStore):
+            return super().media_to_download(request, info, item=item)
+        size, md5 = request.meta.get('file_expected', (None, None))
+        path = self.file_path(request, info=info, item=item)
+        absolute_path = os.path.join(self.store.basedir, path)
+        download = PartialDownload(absolute_path, total=size)
+        request.meta['file_download'] = download
+        # The part file is written as the body arrives, so it must not be compressed in transit
+        request.headers['Accept-Encoding'] = 'identity'
+        offset = download.existing_size()
+        if offset and (size is None or offset < size):
+            logger.info(f"Resuming download of {request.url} at byte {offset}")
+            request.headers['Range'] = f"bytes={offset}-"
+            request.meta['file_resumed'] = True
+        elif offset:
+            download.discard()
+        with suppress(FileNotFoundError):
+            if size is None and md5 is None:
+                # Nothing to check the file against, so it is up to date until FILES_EXPIRES as in FilesPipeline
+                if (time.time() - os.path.getmtime(absolute_path)) / 86400 > self.expires:
+                    return None
+                checksum, sha512 = file_hashes(absolute_path)
+                self.inc_stats(info.spider, "uptodate")
+                return self.file_added(item, request.url, path, checksum, sha512, "uptodate")
+            if size is None or os.path.getsize(absolute_path) == size:
+                checksum, sha512 = file_hashes(absolute_path)
+                if md5 is None or checksum == md5:
+                    self.inc_stats(info.spider, "uptodate")
+                    return self.file_added(item, request.url, path, checksum, sha512, "uptodate")
+            logger.info(f"File {absolute_path} does not match the size or MD5 in the metadata, downloading again")
+        return None
+
+    def headers_received(self, headers, body_length, request, spider):
+        """
+        Start streaming a download to its part file once the headers show that the body is the expected
+        file, the expected range of it, or a file of unknown size above FILES_STREAM_THRESHOLD.
+        Anything else (errors, redirects, small files) is left to media_downloaded. The signal does not
+        carry the response status, so media_downloaded discards the part file of an error response
+        """
+        download = request.meta.get('file_download')
+        if download is None:
+            return
+        content_range = parse_content_range(headers.get('Content-Range', b'').decode('latin1'))
+        download.ranges = content_range is not None or headers.get('Accept-Ranges') == b'bytes'
+        if content_range is not None:
+            offset, total = content_range
+            if download.total is None:
+                download.total = total
+            if total == download.total and offset <= download.existing_size():
+                download.start(offset)
+        elif body_length == download.total or (download.total is None and body_length > self.stream_threshold):
+            download.total = body_length
+            download.start(0)
+        if download.started and download.ranges:
+            # No more than FILES_STREAM_THRESHOLD of the body is held in memory (see bytes_received),
+            # so the download size limits do not apply
+            request.meta['download_maxsize'] = 0
+            request.meta['download_warnsize'] = 0
+
+    def bytes_received(self, data, request, spider):
+        """
+        Write each chunk of a streamed download to its part file. The downloader keeps the whole body
+        in memory, so once a response has brought FILES_STREAM_THRESHOLD bytes it is stopped, and
+        media_downloaded requests the rest of the file as a range
+        """
+        download = request.meta.get('file_download')
+        if download is not None and download.started:
+            download.write(data)
+            self.crawler.stats.inc_value(f'bytes_written/{type(self).__name__}', len(data))
+            if download.ranges and download.received >= self.stream_threshold and download.size < download.total:
+                raise StopDownload(fail=False)
+
     def media_downloaded(self, response, request, info, *, item=None):
+        # MediaPipeline only sends download errors to media_failed, not errors raised here, so the part file
+        # (which holds whatever the failed response wrote) is discarded here
+        try:
+            return self._media_downloaded(response, request, info, item=item)
+        except Exception:
+            download = request.meta.get('file_download')
+            if download is not None:
+                download.discard()
+            raise
+
+    def _media_downloaded(self, response, request, info, *, item=None):
         referer = referer_str(request)
 
+        download = request.meta.get('file_download')
+        if download is not None and download.started and response.status in (200, 206):
+            if 'download_stopped' in response.flags:
+                return self.next_range(download, request, info, item=item)
+            return self.part_downloaded(download, response, request, info, item=item)
+        if download is not None:
+            # Either the whole file arrived and was not streamed (a small file of unknown size), not the range
+            # we asked for, or an error response, which may have been streamed into the part file.
+            # Either way the part file is of no more use
+            download.discard()
+
         if response.status != 200:
-            scrapy.logger.warning(
+            logger.warning(
                 "File (code: %(status)s): Error downloading file from "
                 "%(request)s referred in <%(referer)s>",
                 {"status": response.status, "request": request, "referer": referer},
@@ -227,7 +758,7 @@ class FilesRelativePipeline(scrapy.pipelines.files.FilesPipeline):
                 {"request": request, "referer": referer},
                 extra={"spider": info.spider},
             )
-            raise scrapy.FileException("empty-content")
+            raise scrapy.pipelines.files.FileException("empty-content")
 
         status = "cached" if "cached" in response.flags else "downloaded"
         logger.debug(
@@ -241,6 +772,7 @@ class FilesRelativePipeline(scrapy.pipelines.files.FilesPipeline):
         try:
             path = self.file_path(request, response=response, info=info, item=item)
             checksum = self.file_downloaded(response, request, info, item=item)
+            self.crawler.stats.inc_value(f'bytes_written/{type(self).__name__}', len(response.body))
         except scrapy.pipelines.files.FileException as exc:
             logger.warning(
                 "File (error): Error processing file from %(request)s "
@@ -260,16 +792,85 @@ class FilesRelativePipeline(scrapy.pipelines.files.FilesPipeline):
             )
             raise scrapy.pipelines.files.FileException(str(exc))
 
+        size, md5 = request.meta.get('file_expected', (None, None))
+        if md5 is not None and checksum != md5:
+            self.discard_file(path)
+            logger.warning(f"File (checksum-mismatch): {request.url} has MD5 {checksum}, expected {md5}")
+            raise scrapy.pipelines.files.FileException("checksum-mismatch")
+
         # If we made it here, we got OK right?
+        # The OCFL digest is computed here while the body is in memory, so WriteToOCFLPipeline
+        # does not have to read the file again
+        return self.file_added(item, request.url, path, checksum, hashlib.sha512(response.body).hexdigest(), status)
+
+    def next_range(self, download, request, info, *, item=None):
+        """
+        Request the rest of a file whose download was stopped after FILES_STREAM_THRESHOLD bytes
+
+        :return: Deferred firing with the file_added result
+        """
+        download.close()
+        next_request = request.copy()
+        next_request.headers['Range'] = f"bytes={download.size}-"
+        logger.debug(f"Downloading {request.url} from byte {download.size} of {download.total}")
+        dfd = self.crawler.engine.download(next_request)
+        dfd.addCallbacks(
+            callback=self.media_downloaded,
+            callbackArgs=(next_request, info),
+            callbackKeywords={"item": item},
+            errback=self.media_failed,
+            errbackArgs=(next_request, info),
+        )
+        return dfd
+
+    def part_downloaded(self, download, response, request, info, *, item=None):
+        """
+        Finish a download which was streamed to its part file: check it against the published size and MD5,
+        and move it into place
+
+        :return: file_added result
+        """
+        size, checksum, sha512 = download.finish()
+        expected_md5 = request.meta['file_expected'][1]
+        if size != download.total or (expected_md5 is not None and checksum != expected_md5):
+            download.discard()
+            logger.warning(f"File (checksum-mismatch): {request.url} is {size} bytes with MD5 {checksum}, "
+                           f"expected {download.total} bytes with MD5 {expected_md5}")
+            raise scrapy.pipelines.files.FileException("checksum-mismatch")
+        download.complete()
+        status = "resumed" if request.meta.get('file_resumed') else "downloaded"
+        self.inc_stats(info.spider, status)
+        path = self.file_path(request, response=response, info=info, item=item)
+        return self.file_added(item, request.url, path, checksum, sha512, status)
+
+    def media_failed(self, failure, request, info):
+        # Keep what was downloaded of the file, to resume from next time
+        download = request.meta.get('file_download')
+        if download is not None:
+            download.close()
+            if not download.existing_size():
+                download.discard()
+        return super().media_failed(failure, request, info)
+
+    def discard_file(self, path):
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(self.store.basedir, path))
+
+    def file_added(self, item, url, path, checksum, sha512, status):
+        """
+        Record a stored file in item['files_added']
+
+        :param sha512: SHA-512 of the file, used as the OCFL digest by WriteToOCFLPipeline
+        :return: the file_added result, which also goes into item['files']
+        """
         file_added = {
-            "url": request.url,
+            "url": url,
             "path": path,
             "checksum": checksum,
+            "sha512": sha512,
             "status": status,
         }
-
         item['files_added'].append(file_added)
-
         return file_added
 
     def item_completed(self, results, item, info):
@@ -0,0 +1,297 @@
+"""
+Offline rendering: apply a stylesheet to the records already stored in an OCFL repository,
+so a template change does not need another harvest.
+Builds are incremental, like make: a manifest next to the output tree records a hash of the inputs
+of every page, and only pages whose inputs changed are rendered again
+"""
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+from contextlib import suppress
+from multiprocessing import Pool
+from types import SimpleNamespace
+
+from lxml import etree
+
+from feed2html.dates import guess_date
+from feed2html.ocfl import head_file, iter_object_roots, read_inventory
+from feed2html.xslt import StylesheetCache, publication_date_param, spider_params
+
+logger = logging.getLogger(__name__)
+
+# Where the publication date passed to the stylesheet is taken from by default: a guess from the simple Dublin Core
+# dates, as the oaipmh_dc_xml spider does. The rerender command takes the spider's own (see PublicationDate)
+DC_DATE_XPATH = './/dc:date/text()'
+DC_NAMESPACES = {'dc': 'http://purl.org/dc/elements/1.1/'}
+
+# Part of the input hash of every page. Change it when the rendering itself changes (eg. how the
+# publication date is found), so that the next build renders every page again
+RENDERER_VERSION = '2'
+
+# Build manifest, in the output directory
+MANIFEST_NAME = '.render-manifest.json'
+
+# Per-process rendering state, set up by _init_worker
+_worker = None
+
+
+def find_records(storage_root):
+    """
+    Find the record.xml of the head version of every object in a storage root
+
+    :param storage_root: path to the OCFL storage root
+    :return: generator of (object ID, object path relative to the storage root, path to record.xml,
+        digest of record.xml)
+    """
+    for object_root in iter_object_roots(storage_root):
+        inventory = read_inventory(object_root)
+        record = head_file(inventory, 'record.xml')
+        if record is None:
+            logger.warning(f"Object {inventory['id']} has no record.xml, skipping")
+            continue
+        digest, content_path = record
+        yield inventory['id'], os.path.relpath(object_root, storage_root), os.path.join(object_root, content_path), \
+            f"{inventory['digestAlgorithm']}:{digest}"
+
+
+def storage_roots(path_to_ocfl):
+    """
+    Find the storage roots of an OCFL repository path: its own root, and the root of each source of a
+    multi-endpoint harvest (<path_to_ocfl>/<source>/root, see WriteToOCFLPipeline)
+
+    :param path_to_ocfl: OCFL repository path, as path_to_ocfl for the spiders
+    :return: list of (source name or None, storage root path)
+    """
+    roots = []
+    if os.path.isdir(f"{path_to_ocfl}/root"):
+        roots.append((None, f"{path_to_ocfl}/root"))
+    with os.scandir(path_to_ocfl) as entries:
+        sources = sorted(entry.name for entry in entries if entry.is_dir() and entry.name not in ('root', 'workspace'))
+    roots += [(source, f"{path_to_ocfl}/{source}/root") for source in sources
+              if os.path.isdir(f"{path_to_ocfl}/{source}/root")]
+    return roots
+
+
+class PublicationDate:
+    """
+    Finds the publication date of a stored record the same way the spider which harvested it did: the values of
+    its publication_date_xpath, from which a year is guessed (see feed2html.dates) if it has
+    guess_publication_date set, otherwise the first value is used as it is
+    """
+
+    def __init__(self, xpath=DC_DATE_XPATH, namespaces=None, guess=True):
+        """
+        :param xpath: XPath of the date values, relative to the record element
+        :param namespaces: prefix -> namespace URI
+        :param guess: guess the year from the values, rather than take the first one
+        """
+        self.xpath = xpath
+        self.namespaces = dict(namespaces or DC_NAMESPACES)
+        self.guess = guess
+        self._compiled = None
+
+    @classmethod
+    def from_spider(cls, spidercls, xpath=None):
+        """
+        :param spidercls: spider class the records were harvested with
+        :param xpath: publication_date_xpath given to the spider, if it was not the spider's own
+        :return: PublicationDate
+        """
+        return cls(xpath or getattr(spidercls, 'publication_date_xpath', DC_DATE_XPATH),
+                   namespaces=getattr(spidercls, 'namespaces', None),
+                   guess=getattr(spidercls, 'guess_publication_date', True))
+
+    @property
+    def spec(self):
+        """
+        What the date depends on, for the build hash of a page
+        """
+        return [self.xpath, self.guess]
+
+    def __call__(self, root):
+        """
+        :param root: parsed record
+        :return: publication date string, or None
+        """
+        if self._compiled is None:
+            # Compiled XPath objects cannot be pickled, so each worker process compiles its own
+            self._compiled = etree.XPath(self.xpath, namespaces=self.namespaces, smart_strings=False)
+        values = self._compiled(root)
+        if self.guess:
+            return guess_date(values)
+        return values[0] if values else None
+
+    def __getstate__(self):
+        return {**self.__dict__, '_compiled': None}
+
+
+class RenderManifest:
+    """
+    The build manifest: maps the path of every page, relative to the output directory, to the hash
+    of the inputs it was last rendered from
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the JSON manifest file. It is created on the first save
+        """
+        self.path = path
+        self.pages = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as f:
+                self.pages = json.load(f)
+
+    def save(self):
+        """
+        Write the manifest file, via a temporary file so that a crash never leaves a truncated manifest
+        """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.pages, f, indent=0, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def file_digest(path):
+    """
+    :param path: file path
+    :return: SHA-256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_hash(record_digest, stylesheet_digest, params, date_spec=None):
+    """
+    Hash of everything a page is rendered from. The publication date is derived from the record,
+    so it is covered by the record digest, how the date is found and the renderer version
+
+    :param record_digest: digest of record.xml, from the OCFL inventory
+    :param stylesheet_digest: digest of the stylesheet
+    :param params: dict of the website_title, website_subtitle and path_to_assets parameters
+    :param date_spec: PublicationDate.spec
+    :return: hex digest
+    """
+    inputs = json.dumps([RENDERER_VERSION, record_digest, stylesheet_digest, params, date_spec], sort_keys=True)
+    return hashlib.sha256(inputs.encode('utf8')).hexdigest()
+
+
+def write_if_changed(path, content):
+    """
+    Write content to path, unless the file already has exactly this content.
+    The file is written to a temporary name and renamed, so a page is never seen half written
+
+    :param path: output file path
+    :param content: bytes
+    :return: True if the file was written
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return True
+
+
+def remove_page(output, page_path):
+    """
+    Remove a page and the directories above it which are left empty, up to the output directory
+
+    :param output: output directory
+    :param page_path: page path relative to the output directory
+    :return: None
+    """
+    with suppress(FileNotFoundError):
+        os.remove(os.path.join(output, page_path))
+    directory = os.path.dirname(page_path)
+    while directory:
+        try:
+            os.rmdir(os.path.join(output, directory))
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+def _init_worker(path_to_xsl, output, params, publication_date):
+    global _worker
+    # Compiled stylesheets and XSLT parameters cannot be pickled, so every process builds its own
+    _worker = SimpleNamespace(stylesheets=StylesheetCache(reload_interval=-1), path_to_xsl=path_to_xsl,
+                              output=output, params=spider_params(SimpleNamespace(**params)),
+                              publication_date=publication_date)
+
+
+def _render(job):
+    object_id, page_path, record_path, input_hash = job
+    try:
+        root = etree.parse(record_path).getroot()
+        transform = _worker.stylesheets.get(_worker.path_to_xsl)
+        publication_date = publication_date_param(_worker.publication_date(root))
+        result = transform(root, publication_date=publication_date, **_worker.params)
+        write_if_changed(os.path.join(_worker.output, page_path), bytes(result))
+        return 'rebuilt', page_path, input_hash
+    except Exception as error:
+        logger.error(f"Could not render {object_id}: {error}")
+        return 'failed', page_path, None
+
+
+def render_site(path_to_ocfl, path_to_xsl, output, params, processes=None, force=False, publication_date=None):
+    """
+    Render page.html for every object in an OCFL repository, in parallel across processes.
+    Pages whose inputs (record, stylesheet, parameters and renderer version) are the same as in the last
+    build are skipped, and pages of objects no longer in the repository are removed
+
+    :param path_to_ocfl: OCFL repository path (containing 'root', or a '<source>/root' per source)
+    :param path_to_xsl: stylesheet
+    :param output: directory to write pages to, as <output>/<object path>/page.html, or
+        <output>/<source>/<object path>/page.html for the objects of a source
+    :param params: dict of website_title, website_subtitle and path_to_assets
+    :param processes: number of worker processes (default: number of CPUs)
+    :param force: render every page, whatever the manifest says
+    :param publication_date: PublicationDate, how the spider found the publication date (default: guessed from
+        the Dublin Core dates)
+    :return: Counter of 'rebuilt', 'skipped', 'removed' and 'failed' pages
+    """
+    publication_date = publication_date or PublicationDate()
+    # Fail early on a broken stylesheet
+    etree.XSLT(etree.parse(path_to_xsl))
+    stylesheet_digest = file_digest(path_to_xsl)
+    os.makedirs(output, exist_ok=True)
+    manifest = RenderManifest(os.path.join(output, MANIFEST_NAME))
+    previous_pages = manifest.pages
+    manifest.pages = {}
+    counts = Counter()
+
+    # The pages to render are listed before the workers start, as the pool feeds them to the workers from
+    # another thread, which must not update the counts and the manifest
+    jobs = []
+    for source, storage_root in storage_roots(path_to_ocfl):
+        for object_id, relative_path, record_path, record_digest in find_records(storage_root):
+            page_path = os.path.join(source or '', relative_path, 'page.html')
+            input_hash = build_hash(record_digest, stylesheet_digest, params, publication_date.spec)
+            if not force and previous_pages.get(page_path) == input_hash \
+                    and os.path.exists(os.path.join(output, page_path)):
+                manifest.pages[page_path] = input_hash
+                counts['skipped'] += 1
+                continue
+            jobs.append((object_id, page_path, record_path, input_hash))
+
+    with Pool(processes, initializer=_init_worker, initargs=(path_to_xsl, output, params, publication_date)) as pool:
+        for status, page_path, input_hash in pool.imap_unordered(_render, jobs, chunksize=64):
+            counts[status] += 1
+            # A page which failed has no hash, so it is kept but rendered again next time
+            manifest.pages[page_path] = input_hash
+
+    for page_path in previous_pages.keys() - manifest.pages.keys():
+        remove_page(output, page_path)
+        counts['removed'] += 1
+    manifest.save()
+    return counts
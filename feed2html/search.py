@@ -0,0 +1,320 @@
+"""
+Static search index, built while crawling and served as plain files next to the site.
+
+The index is an inverted index over a few item fields (title, abstract, subject and identifier by default),
+split into small JSON files so a browser only fetches what a query needs:
+- index.json: the manifest, with the fields and their weights, how terms are made (prefix length, maximum length,
+  stopwords), the number of documents, the documents per document shard and the list of term shards
+- terms/<prefix>.json: every term starting with the prefix -> postings, a flat list of
+  [document number delta, weight, document number delta, weight, ...] in document number order
+- docs/<n>.json: documents n * documents_per_shard onwards, each [key, title], or null once deleted
+
+A document key is the path of the item's page: its export path (see pipelines.get_file_paths) for items with a
+hash, its OCFL object ID otherwise, prefixed with the source of a multi-endpoint harvest.
+Terms are lowercased words without accents, so a client has to normalise queries the same way
+(output/js/search.js does). While crawling, postings are appended to run files in a .build directory; at the end
+of the crawl they are merged into the existing index, so an incremental harvest updates the records it saw
+and keeps the others
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import unicodedata
+from collections import Counter, defaultdict
+from contextlib import suppress
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+# Item fields indexed, and the weight of a term found in each
+DEFAULT_FIELDS = {'title': 4, 'subject': 3, 'identifier': 2, 'abstract': 1}
+
+WORD = re.compile(r'\w+')
+
+# Too common to be worth a posting list
+STOPWORDS = frozenset("""
+an and are as at be but by for from has have in into is it its of on or that the their this to was were which
+with
+""".split())
+
+# Longer words are cut to this length. Like the stopwords, it is in the manifest for the client
+MAX_TERM_LENGTH = 32
+
+
+def tokenize(text):
+    """
+    :param text: field value
+    :return: list of terms: words without accents, lowercased, of at least two characters and not stopwords
+    """
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = text.lower()
+    return [word[:MAX_TERM_LENGTH] for word in WORD.findall(text) if len(word) > 1 and word not in STOPWORDS]
+
+
+def item_terms(item, fields):
+    """
+    :param item: item (or dict)
+    :param fields: field name -> weight
+    :return: Counter of term -> weight in the item, the sum of the weights of the fields it is in
+    """
+    terms = Counter()
+    for field, weight in fields.items():
+        values = item.get(field)
+        if not values:
+            continue
+        if isinstance(values, str):
+            values = [values]
+        found = set()
+        for value in values:
+            if value:
+                found.update(tokenize(str(value)))
+        for term in found:
+            terms[term] += weight
+    return terms
+
+
+def encode_postings(postings):
+    """
+    :param postings: dict of document number -> weight
+    :return: flat list of document number deltas and weights
+    """
+    encoded = []
+    previous = 0
+    for number in sorted(postings):
+        encoded += [number - previous, postings[number]]
+        previous = number
+    return encoded
+
+
+def decode_postings(encoded):
+    """
+    :param encoded: flat list of document number deltas and weights, see encode_postings
+    :return: dict of document number -> weight
+    """
+    postings = {}
+    number = 0
+    for i in range(0, len(encoded), 2):
+        number += encoded[i]
+        postings[number] = encoded[i + 1]
+    return postings
+
+
+def _read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    """
+    Write compact JSON via a temporary file, so a page never fetches a half written shard
+
+    :return: number of bytes written
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        size = f.tell()
+    os.replace(tmp_path, path)
+    return size
+
+
+class SearchIndexBuilder:
+    """
+    Builds the search index of a crawl in a directory of the site. Items are added as they pass, their postings
+    buffered per term prefix and appended to run files in <path>/.build when the buffer is full, so memory use does
+    not grow with the number of records. build() merges the run files into the index.
+    The run files of a crawl which did not finish are kept and added to by the next one
+    """
+
+    def __init__(self, path, fields=None, prefix_length=2, documents_per_shard=1000, buffer_size=100000):
+        """
+        :param path: index directory, eg. <site>/search
+        :param fields: item field -> weight (default DEFAULT_FIELDS)
+        :param prefix_length: number of leading characters of a term which select its shard. Longer prefixes
+            make more, smaller shards
+        :param documents_per_shard: number of documents in each document shard
+        :param buffer_size: number of postings kept in memory before they are written to the run files
+        """
+        self.path = path
+        self.fields = fields or DEFAULT_FIELDS
+        self.prefix_length = prefix_length
+        self.documents_per_shard = documents_per_shard
+        self.buffer_size = buffer_size
+        self.build_path = os.path.join(path, '.build')
+        os.makedirs(self.build_path, exist_ok=True)
+        self.documents_path = os.path.join(self.build_path, 'documents.jsonl')
+        # Documents of this crawl not yet written to the run files, and postings by prefix as (term, seq, weight)
+        self.documents = []
+        self.buffer = defaultdict(list)
+        self.buffered = 0
+        # Crawl sequence number of the next document, continuing the run files of an unfinished crawl
+        self.sequence = 0
+        if os.path.exists(self.documents_path):
+            for name in os.listdir(self.build_path):
+                self._truncate_partial_line(os.path.join(self.build_path, name))
+            with open(self.documents_path, 'r', encoding='utf8') as f:
+                self.sequence = sum(1 for _ in f)
+            logger.info(f"Continuing the search index run files of an unfinished crawl, {self.sequence} documents")
+
+    @staticmethod
+    def _truncate_partial_line(path):
+        """
+        Cut the last line of a run file written by a crawl which was killed, if it is incomplete
+        """
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+
+    def prefix(self, term):
+        return term[:self.prefix_length]
+
+    def add(self, key, title, item):
+        """
+        Add (or replace) a document
+
+        :param key: document key
+        :param title: title shown in search results
+        :param item: item to take the indexed fields from
+        :return: None
+        """
+        sequence = self._document(key, title)
+        for term, weight in item_terms(item, self.fields).items():
+            self.buffer[self.prefix(term)].append((term, sequence, weight))
+            self.buffered += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def delete(self, key):
+        """
+        :param key: key of a document to remove from the index
+        :return: None
+        """
+        self._document(key, None)
+
+    def _document(self, key, title):
+        self.documents.append([key, title])
+        self.sequence += 1
+        return self.sequence - 1
+
+    def flush(self):
+        """
+        Append the buffered documents to the run files, then their postings. Documents go first, so after a crash
+        in between the next crawl does not give the sequence numbers of orphaned postings to new documents
+        """
+        with open(self.documents_path, 'a', encoding='utf8') as f:
+            f.writelines(json.dumps(document, ensure_ascii=False) + '\n' for document in self.documents)
+        for prefix, postings in self.buffer.items():
+            with open(os.path.join(self.build_path, f"{prefix}.tsv"), 'a', encoding='utf8') as f:
+                f.writelines(f"{term}\t{sequence}\t{weight}\n" for term, sequence, weight in postings)
+        self.buffer.clear()
+        self.buffered = 0
+        self.documents = []
+
+    def build(self):
+        """
+        Merge the run files into the index: documents seen in this crawl replace their earlier postings,
+        deleted documents are removed, and only the shards which changed are written
+
+        :return: dict of statistics: documents, changed (documents added, updated or deleted), shards, bytes
+        """
+        self.flush()
+        manifest = _read_json(os.path.join(self.path, 'index.json'), {})
+        if manifest and manifest.get('prefix_length') != self.prefix_length:
+            # Shards of another prefix length cannot be merged, so the documents they held are not kept
+            logger.warning(f"Search index prefix length changed to {self.prefix_length}, rebuilding it from "
+                           f"the records of this crawl only")
+            for directory in ('terms', 'docs'):
+                shutil.rmtree(os.path.join(self.path, directory), ignore_errors=True)
+            manifest = {}
+        documents = self._read_documents(manifest)
+        # Documents already in the index which this crawl updated or deleted, their old postings have to go
+        replaced = set()
+        numbers = {document[0]: number for number, document in enumerate(documents) if document}
+        # Crawl sequence number -> document number, for the latest version of each document of this crawl
+        latest = {}
+        changed = set()
+        with open(self.documents_path, 'r', encoding='utf8') as f:
+            for sequence, line in enumerate(f):
+                key, title = json.loads(line)
+                number = numbers.get(key)
+                if number is None:
+                    if title is None:
+                        continue
+                    number = numbers[key] = len(documents)
+                    documents.append(None)
+                elif number < manifest.get('documents', 0):
+                    replaced.add(number)
+                documents[number] = [key, title] if title is not None else None
+                latest[key] = sequence
+                changed.add(number)
+        current = {sequence: numbers[key] for key, sequence in latest.items() if documents[numbers[key]]}
+
+        written = 0
+        shards = set(manifest.get('shards', []))
+        run_files = {name[:-len('.tsv')] for name in os.listdir(self.build_path) if name.endswith('.tsv')}
+        os.makedirs(os.path.join(self.path, 'terms'), exist_ok=True)
+        # Without replaced documents, only the shards with new postings change
+        for prefix in sorted(shards | run_files if replaced else run_files):
+            shard_path = os.path.join(self.path, 'terms', f"{prefix}.json")
+            terms = {term: decode_postings(encoded) for term, encoded in (_read_json(shard_path, {}) or {}).items()}
+            modified = prefix in run_files
+            for postings in terms.values():
+                for number in replaced.intersection(postings):
+                    del postings[number]
+                    modified = True
+            if not modified:
+                continue
+            if prefix in run_files:
+                with open(os.path.join(self.build_path, f"{prefix}.tsv"), 'r', encoding='utf8') as f:
+                    for line in f:
+                        term, sequence, weight = line.rstrip('\n').split('\t')
+                        number = current.get(int(sequence))
+                        if number is not None:
+                            terms.setdefault(term, {})[number] = int(weight)
+            terms = {term: encode_postings(postings) for term, postings in sorted(terms.items()) if postings}
+            if terms:
+                written += _write_json(shard_path, terms)
+                shards.add(prefix)
+            else:
+                with suppress(FileNotFoundError):
+                    os.remove(shard_path)
+                shards.discard(prefix)
+
+        os.makedirs(os.path.join(self.path, 'docs'), exist_ok=True)
+        if manifest.get('documents_per_shard', self.documents_per_shard) != self.documents_per_shard:
+            # Every document shard is written again with the new size
+            for name in os.listdir(os.path.join(self.path, 'docs')):
+                os.remove(os.path.join(self.path, 'docs', name))
+            changed.update(range(len(documents)))
+        for block in sorted({number // self.documents_per_shard for number in changed}):
+            start = block * self.documents_per_shard
+            written += _write_json(os.path.join(self.path, 'docs', f"{block}.json"),
+                                   documents[start:start + self.documents_per_shard])
+        # The manifest last, so a client never sees shards it does not list
+        written += _write_json(os.path.join(self.path, 'index.json'), {
+            'version': INDEX_VERSION, 'fields': self.fields, 'prefix_length': self.prefix_length,
+            'max_term_length': MAX_TERM_LENGTH, 'stopwords': sorted(STOPWORDS), 'documents': len(documents),
+            'documents_per_shard': self.documents_per_shard, 'shards': sorted(shards)})
+        shutil.rmtree(self.build_path)
+        return {'documents': sum(1 for document in documents if document), 'changed': len(changed),
+                'shards': len(shards), 'bytes': written}
+
+    def _read_documents(self, manifest):
+        """
+        :param manifest: index manifest
+        :return: list of the documents already in the index, [key, title] or None, by document number
+        """
+        documents = []
+        per_shard = manifest.get('documents_per_shard', self.documents_per_shard)
+        for block in range(-(-manifest.get('documents', 0) // per_shard)):
+            documents += _read_json(os.path.join(self.path, 'docs', f"{block}.json"), [])
+        return documents
@@ -11,6 +11,8 @@ BOT_NAME = "feed2html"
 
 SPIDER_MODULES = ["feed2html.spiders"]
 NEWSPIDER_MODULE = "feed2html.spiders"
+# Project commands, eg. scrapy rerender
+COMMANDS_MODULE = "feed2html.commands"
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -50,15 +52,18 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    "feed2html.middlewares.Feed2HtmlDownloaderMiddleware": 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    # After RetryMiddleware (550) on the way in, so it sees 429/503 responses before they are retried
+    "feed2html.middlewares.AdaptiveThrottleMiddleware": 950,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-#}
+EXTENSIONS = {
+    #"scrapy.extensions.telnet.TelnetConsole": None,
+    "feed2html.extensions.StageMetrics": 500,
+    "feed2html.extensions.ItemProfiler": 510,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -91,3 +96,78 @@ ROBOTSTXT_OBEY = True
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
+
+# XSLT stylesheets are compiled once per crawl by TransformXmlPipeline. This is the minimum
+# number of seconds between checks for a changed stylesheet on disk (-1 never reloads)
+#XSLT_RELOAD_INTERVAL = 1.0
+# Number of worker threads TransformXmlPipeline uses for XSLT. 0 transforms inline on the
+# reactor thread; a value around the number of CPU cores keeps downloads going while rendering
+#XSLT_WORKERS = 0
+
+# Number of OAI-PMH ListRecords pages fetched ahead of the page being processed. The next page is
+# requested as soon as a page arrives; pages are still handed to the pipelines in order. 0 disables
+#OAI_PREFETCH_PAGES = 1
+# With -a partition=sets or -a partition=dates, each harvest is split into several resumption chains
+# (one per set from ListSets, or one per from/until window) run at the same time against the endpoint.
+# The number of chains running per harvest, and the number of date windows
+#OAI_PARTITION_CONCURRENCY = 4
+#OAI_PARTITION_WINDOWS = 16
+# With -a job=<job ID>, the progress of each harvest is checkpointed to <OAI_CHECKPOINT_DIR>/<job ID>.json after
+# every page the pipelines have finished with, so a crashed or killed job continues when started with the same ID
+#OAI_CHECKPOINT_DIR = "checkpoints"
+
+# OCFL storage layout for WriteToOCFLPipeline: 'flat' stores objects directly under the storage root,
+# 'hashed' uses the hashed n-tuple layout (extension 0004) so no directory gets too large.
+# The layout of an existing storage root cannot be changed
+#OCFL_STORAGE_LAYOUT = "flat"
+# How WriteToOCFLPipeline writes downloaded files into OCFL objects: 'copy' (kernel-side copy),
+# 'reflink' (copy-on-write clone where the filesystem supports it, otherwise copy) or 'hardlink'
+# (same filesystem only; the crawl copy and the OCFL content then share an inode)
+#OCFL_FILE_LINK_MODE = "copy"
+# WriteToOCFLPipeline can write objects on a background thread. The queue size bounds how many finished
+# objects wait to be written (0 writes on the reactor thread); the crawl slows down while the queue is full.
+# Objects are written in batches, and with OCFL_FSYNC the storage filesystem is synced once per batch
+#OCFL_WRITER_QUEUE_SIZE = 0
+#OCFL_WRITER_BATCH_SIZE = 50
+#OCFL_FSYNC = False
+# FilesRelativePipeline streams large files to disk instead of keeping them in memory, and downloads
+# them in ranges of at most this many bytes where the server accepts range requests
+#FILES_STREAM_THRESHOLD = 16 * 1024 * 1024
+# SearchIndexPipeline (add it to ITEM_PIPELINES after the other pipelines) builds a sharded static search index
+# while crawling, for client-side search with output/js/search.js. The index is written to SEARCH_INDEX_DIR
+# (default <path_to_assets>/search). Indexed item fields and their weights, the number of leading characters
+# of a term that select its shard file, the documents per document shard, and the postings kept in memory
+# before they are spilled to run files
+#SEARCH_INDEX_DIR = "/tmp/site/search"
+#SEARCH_INDEX_FIELDS = {"title": 4, "subject": 3, "identifier": 2, "abstract": 1}
+#SEARCH_INDEX_PREFIX_LENGTH = 2
+#SEARCH_INDEX_DOCUMENTS_PER_SHARD = 1000
+#SEARCH_INDEX_BUFFER = 100000
+# AdaptiveThrottleMiddleware adapts the concurrency of each host to the server latency, backs off on
+# 429/503 responses (ADAPTIVE_THROTTLE_HTTP_CODES) and network errors, and obeys Retry-After (up to
+# ADAPTIVE_THROTTLE_MAX_DELAY seconds). Concurrency starts at the concurrency of the host (or
+# ADAPTIVE_THROTTLE_START_CONCURRENCY) and grows while the latency stays within ADAPTIVE_THROTTLE_LATENCY_TOLERANCE
+# times the lowest latency seen, up to ADAPTIVE_THROTTLE_MAX_CONCURRENCY (or the concurrency of the endpoint).
+# DOWNLOAD_DELAY is the lowest delay used. The current concurrency, delay and responses per second of each host are
+# in the throttle/* stats. The OAI spiders and dspaceweb enable it in their custom_settings
+ADAPTIVE_THROTTLE_ENABLED = False
+#ADAPTIVE_THROTTLE_START_CONCURRENCY = 1
+#ADAPTIVE_THROTTLE_MAX_CONCURRENCY = 8
+#ADAPTIVE_THROTTLE_MAX_DELAY = 300
+#ADAPTIVE_THROTTLE_LATENCY_TOLERANCE = 2.0
+#ADAPTIVE_THROTTLE_HTTP_CODES = [429, 503]
+# StageMetrics times every stage of a crawl (downloads, parse_record, the process_item of each pipeline) in
+# latency histograms, counts items, errors and the bytes each pipeline writes, and samples the depth of the
+# queues between the downloader and the pipelines every STAGE_METRICS_SAMPLE_INTERVAL seconds. Results are in
+# the metrics/* and bytes_written/* stats, logged every STAGE_METRICS_INTERVAL seconds (0 only at the end),
+# and written to STAGE_METRICS_PROMETHEUS_FILE in the Prometheus text format if it is set
+STAGE_METRICS_ENABLED = True
+#STAGE_METRICS_INTERVAL = 60.0
+#STAGE_METRICS_SAMPLE_INTERVAL = 1.0
+#STAGE_METRICS_PROMETHEUS_FILE = "/var/lib/node_exporter/textfile/feed2html.prom"
+# ItemProfiler profiles this fraction of the items of a crawl with cProfile (eg. 0.01 for 1%; 0 is off): parse_record
+# and the process_item of every pipeline, for the sampled items only. The merged profile is written at the end of
+# the crawl to PROFILE_OUTPUT as pstats, or as collapsed stacks for flame graphs with PROFILE_FORMAT = "collapsed"
+#PROFILE_SAMPLE_RATE = 0.0
+#PROFILE_OUTPUT = "profile.pstats"
+#PROFILE_FORMAT = "pstats"
@@ -1,15 +1,25 @@
 import scrapy
 
+from feed2html.mapping import DSPACE_HTML, compile_mapping
+
+
 class DSpaceWeb(scrapy.spiders.CrawlSpider):
     name = "dspaceweb"
+    # Item fields, see feed2html.mapping
+    mapping = DSPACE_HTML
 
     custom_settings = {
         'ROBOTSTXT_OBEY': False,
         'USER_AGENT': 'Mozilla/5.0 (Windows NT 6.1; WOW64) '
                       'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/34.0.1847.131 Safari/537.36',
-        'AUTO_THROTTLE_ENABLED': True,
+        # Opt in to AdaptiveThrottleMiddleware, web UIs slow down under load well before OAI endpoints do
+        'ADAPTIVE_THROTTLE_ENABLED': True,
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.field_mapping = compile_mapping(self.mapping)
+
     def start_requests(self):
         """
         Start the requests for the spider. Each run, the crawler will start here
@@ -35,20 +45,9 @@ class DSpaceWeb(scrapy.spiders.CrawlSpider):
         we want, and extracting the text out.
         """
 
-        # Return the following fields as a dictionary
-        yield {
-            'url': response.url,
-            'title': response.xpath('//meta[@name="DC.title"]/@content').get(),
-            'author': response.xpath('//meta[@name="DC.creator"]/@content').get(),
-            'issueDate': response.xpath('//meta[@name="DCTERMS.issued"]/@content').get(),
-            'bibliographicCitation': response.xpath('//meta[@name="DCTERMS.bibliographicCitation"]/@content').get(),
-            'identifier': response.xpath('//meta[@name="DC.identifier"]/@content').get(),
-            'abstract': response.xpath('//meta[@name="DCTERMS.abstract"]/@content').get(),
-            'language': response.xpath('//meta[@name="DC.language"]/@content').get(),
-            'subject': response.xpath('//meta[@name="DC.subject"]/@content').get(),
-            'type': response.xpath('//meta[@name="DC.type"]/@content').get(),
-            'bitstream': response.xpath('//meta[@name="citation_pdf_url"]/@content').get(),
-        }
-        yield response.follow(response.xpath('//meta[@name="citation_pdf_url"]/@content').get())
-
-
+        # Return the mapped fields (see feed2html.mapping) as a dictionary
+        item = {'url': response.url}
+        item.update(self.field_mapping.extract(response.selector.root))
+        yield item
+        if item['bitstream']:
+            yield response.follow(item['bitstream'])
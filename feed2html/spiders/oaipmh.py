@@ -0,0 +1,655 @@
+import os
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timezone
+from typing import Optional, Any
+from urllib.parse import urlsplit
+
+import scrapy
+from scrapy import Request, signals
+from scrapy.selector import Selector
+from scrapy.utils.misc import load_object
+from scrapy.utils.spider import iterate_spider_output
+
+from feed2html.items import Feed2HtmlItem
+from feed2html.mapping import compile_mapping
+from feed2html.oai import Harvest, date_windows, iterparse_page, load_endpoints, parse_identify, \
+    parse_list_sets, resumption_url, sniff_resumption_token, source_name, top_level_sets, with_params
+from feed2html.state import HarvestCheckpoint, HarvestState
+
+# Times an expired resumption token of a harvest is replaced by a new list request before the harvest gives up
+MAX_RESTARTS = 3
+
+
+def item_key(item):
+    """
+    :param item: item
+    :return: key of the record of an item, which is kept through the pipelines: (source, record identifier)
+    """
+    identifier = item.get('id')
+    if isinstance(identifier, list):
+        identifier = identifier[0] if identifier else None
+    return item.get('source'), identifier
+
+
+class OaipmhSpider(scrapy.spiders.XMLFeedSpider):
+    """
+    Base class for the OAI-PMH spiders, handling the parts of a harvest which are the same
+    whatever the metadata format: streaming page parsing, resumption tokens, incremental harvesting
+    and deleted records.
+    Subclasses set self.url before calling this constructor, and implement parse_record, which can use
+    self.field_mapping to extract the item fields declared by the mapping spec. With
+    iterator = 'iterparse' (the default) each page is streamed record by record into parse_record. The
+    XMLFeedSpider iterators are still supported, in which case parse_node gets the whole page.
+    With -a endpoints=<file>, one run harvests several endpoints and sets at once instead of self.url, each as its
+    own Harvest (resumption token chain, page ordering and state), and items are tagged with their source.
+    With -a job=<job ID>, the progress of every harvest is checkpointed after each page the pipelines have finished
+    with, and a job started again with the same ID continues from its checkpoint
+    """
+    # Stream pages with lxml iterparse rather than loading each one as a Selector DOM
+    iterator = 'iterparse'
+    # Settings shared by the OAI spiders, subclasses add theirs to these
+    custom_settings = {
+        # Back off when an endpoint is overloaded (429/503 and Retry-After), see AdaptiveThrottleMiddleware
+        'ADAPTIVE_THROTTLE_ENABLED': True,
+    }
+    # Path to the harvest state file. When set, the harvest is incremental: the highest datestamp
+    # seen is saved at the end of a completed harvest and used as the 'from' argument of the next one
+    state_path = None
+    # Header status XPath, used to detect deleted records
+    status_xpath = 'oaipmh:header/@status'
+    # Item field mapping spec, see feed2html.mapping. Can be replaced with -a mapping=<import path of a spec>,
+    # eg. to harvest another metadata format
+    mapping = None
+    # Split each harvest into parallel resumption chains: 'sets' (one chain per set, from ListSets) or
+    # 'dates' (from/until windows between the repository's earliest datestamp and now). None harvests with one chain
+    partition = None
+
+    def __init__(self, name: Optional[str] = None, state_path: Optional[str] = None, mapping: Optional[str] = None,
+                 endpoints: Optional[str] = None, partition: Optional[str] = None, job: Optional[str] = None,
+                 **kwargs: Any):
+        """
+        :param name: spider name
+        :param state_path: path to the harvest state file (optional, enables incremental harvesting)
+        :param mapping: import path of the mapping spec to use instead of the spider's own
+        :param endpoints: path to an endpoints file (see oai.load_endpoints), to harvest several endpoints
+            and sets in one run instead of self.url
+        :param partition: 'sets' or 'dates', to harvest each endpoint with several resumption chains at once
+        :param job: job ID, to checkpoint the harvest and continue it after a crash (see start_checkpoint)
+        :param kwargs: kwargs pointer
+        """
+        super().__init__(name, **kwargs)
+        self.state_path = state_path
+        self.job = job
+        # HarvestCheckpoint of the job, opened when the crawl starts
+        self.checkpoint = None
+        # item_key() of each item on its way through the pipelines -> (harvest key, page) of the items with that key
+        # (a record can be in two sets harvested at once), to count failed items for the harvest state and for
+        # checkpointing
+        self.item_pages = defaultdict(deque)
+        if partition is not None:
+            self.partition = partition
+        if self.partition not in (None, 'sets', 'dates'):
+            raise ValueError(f"Unknown partition '{self.partition}', use 'sets' or 'dates'")
+        if mapping is not None:
+            self.mapping = load_object(mapping)
+        # Compiled once, used for every record
+        self.field_mapping = compile_mapping(self.mapping, dict(self.namespaces)) if self.mapping else None
+        self.harvest_state = HarvestState(self.state_path) if self.state_path else None
+        self.endpoints = load_endpoints(endpoints) if endpoints else []
+        # Harvests of this run by key, each with its own resumption token chain
+        self.harvests = {}
+        # Harvests to split into partitions before they start: key -> 'sets' or 'dates'
+        self.partitions = {}
+        # Partitions of each split harvest waiting for a free chain, the number of chains running,
+        # and the identifiers already harvested (a record can be in several sets)
+        self.waiting_partitions = defaultdict(deque)
+        self.running_partitions = Counter()
+        self.seen_identifiers = defaultdict(set)
+        for endpoint in self.endpoints:
+            for url in [with_params(endpoint['url'], set=s) for s in endpoint['sets']] or [endpoint['url']]:
+                self.add_harvest(Harvest(url, source=endpoint['name']),
+                                 partition=None if endpoint['sets'] else endpoint.get('partition', self.partition))
+            self.allowed_domains = list(self.allowed_domains or []) + [urlsplit(endpoint['url']).hostname]
+        if not self.harvests:
+            self.add_harvest(Harvest(self.url), partition=self.partition)
+
+    def add_harvest(self, harvest, partition=None):
+        """
+        Add a harvest to this run, from the 'from' datestamp saved by the last completed one if the
+        harvest is incremental
+
+        :param harvest: Harvest
+        :param partition: 'sets' or 'dates' to split the harvest into partitions when it starts
+        :return: None
+        """
+        if self.harvest_state is not None and harvest.harvest_from is None:
+            harvest.harvest_from = self.harvest_state.datestamp(harvest.state_key)
+            if harvest.harvest_from:
+                self.logger.info(f"Incremental harvest of {harvest.key} from {harvest.harvest_from}")
+        self.harvests[harvest.key] = harvest
+        if partition:
+            self.partitions[harvest.key] = partition
+
+    def start_requests(self):
+        """
+        Start every harvest at once. Each endpoint host gets its own downloader slot, with the endpoint's
+        concurrency and delay if the endpoints file sets them, so a slow repository does not hold back the others
+        """
+        per_slot_settings = self.crawler.engine.downloader.per_slot_settings
+        for endpoint in self.endpoints:
+            host = urlsplit(endpoint['url']).hostname
+            politeness = {name: endpoint[name] for name in ('concurrency', 'delay') if endpoint.get(name) is not None}
+            if politeness and host not in per_slot_settings:
+                per_slot_settings[host] = politeness
+        for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+            self.crawler.signals.connect(self.item_finished, signal=signal)
+        if self.job:
+            yield from self.start_checkpoint()
+        for harvest in list(self.harvests.values()):
+            if harvest.complete or harvest.parent is not None:
+                # Finished before a restart, or a partition restored from the checkpoint
+                continue
+            partition = self.partitions.get(harvest.key)
+            if partition == 'sets':
+                yield Request(with_params(harvest.url, verb='ListSets', metadataPrefix=None, set=None),
+                              callback=self.parse_sets, errback=self.partitioning_failed, dont_filter=True,
+                              meta={'oai_harvest': harvest.key, 'oai_sets': []})
+            elif partition == 'dates':
+                yield Request(with_params(harvest.url, verb='Identify', metadataPrefix=None, set=None),
+                              callback=self.parse_identify, errback=self.partitioning_failed, dont_filter=True,
+                              meta={'oai_harvest': harvest.key})
+            else:
+                yield self.start_request(harvest)
+
+    def start_request(self, harvest):
+        """
+        :param harvest: Harvest
+        :return: the request for the first page of the harvest
+        """
+        harvest.outstanding += 1
+        url = resumption_url(harvest.url, harvest.resume_token) if harvest.resume_token else harvest.start_url
+        return Request(url, callback=self._parse, errback=self.page_failed, dont_filter=True,
+                       meta={'oai_harvest': harvest.key, 'oai_page': harvest.next_page})
+
+    def start_checkpoint(self):
+        """
+        Open the checkpoint of the job (OAI_CHECKPOINT_DIR/<job>.json) and, if the job ran before, restore the
+        progress of its harvests: partitions of a split harvest are restored rather than split again, harvests
+        which completed are not started, and the others continue from the resumption token of their last
+        checkpointed page. A harvest whose chain had ended without completing (an OAI-PMH error) starts again
+        from its 'from' datestamp, see restart_request
+
+        :return: generator of first page requests of restored partitions
+        """
+        directory = self.settings.get('OAI_CHECKPOINT_DIR', 'checkpoints')
+        self.checkpoint = HarvestCheckpoint(os.path.join(directory, f"{source_name(self.job)}.json"))
+        saved = self.checkpoint.harvests
+        if saved:
+            self.logger.info(f"Continuing job {self.job} from {self.checkpoint.path}")
+        parents = set()
+        for key, entry in saved.items():
+            parent = self.harvests.get(entry.get('parent'))
+            if parent is None or parent.parent is not None:
+                continue
+            window = tuple(entry['window']) if entry.get('window') else None
+            partition = Harvest(parent.url if window else entry['url'], source=parent.source, parent=parent.key,
+                                harvest_from=entry.get('harvest_from'), window=window)
+            self.add_harvest(partition)
+            parents.add(parent.key)
+        for harvest in self.harvests.values():
+            entry = saved.get(harvest.key)
+            if entry is not None:
+                self.restore_progress(harvest, entry)
+        for parent in parents:
+            del self.harvests[parent]
+            self.partitions.pop(parent, None)
+            self.waiting_partitions[parent].extend(harvest for harvest in self.harvests.values()
+                                                   if harvest.parent == parent and not harvest.complete)
+            yield from self.start_partitions(parent)
+
+    def restore_progress(self, harvest, entry):
+        """
+        :param harvest: Harvest
+        :param entry: its checkpoint entry
+        :return: None
+        """
+        harvest.harvest_from = entry.get('harvest_from')
+        harvest.complete = entry.get('complete', False)
+        harvest.next_page = harvest.checkpoint_page = entry.get('page', 0)
+        harvest.resume_token = entry.get('token')
+        harvest.completed = entry.get('completed', 0)
+        harvest.high_water = harvest.checkpoint_high_water = entry.get('high_water')
+        harvest.ordered = entry.get('ordered', True)
+        if not harvest.complete and harvest.resume_token is None and harvest.next_page > 0:
+            # The chain had ended on an error page, start it again
+            harvest.harvest_from = self.restart_from(harvest)
+        if harvest.completed:
+            self.logger.info(f"Harvest of {harvest.key}: {harvest.completed} records done, "
+                             f"{'complete' if harvest.complete else f'continuing from page {harvest.next_page}'}")
+
+    def save_checkpoint(self, harvest):
+        """
+        Save the progress of a harvest to the job checkpoint
+
+        :param harvest: Harvest
+        :return: None
+        """
+        self.checkpoint.update(harvest.key, url=harvest.url, source=harvest.source, parent=harvest.parent,
+                               harvest_from=harvest.harvest_from, window=harvest.window, token=harvest.resume_token,
+                               page=harvest.checkpoint_page, completed=harvest.completed,
+                               high_water=harvest.checkpoint_high_water, ordered=harvest.ordered,
+                               complete=harvest.complete and not harvest.pages)
+        self.checkpoint.save()
+        self.crawler.stats.inc_value('oaipmh/checkpoints')
+
+    def page_parsed(self, harvest, page):
+        """
+        All records of a page have been handed to the pipelines. The page is checkpointed once they are through
+
+        :param harvest: Harvest
+        :param page: page number
+        :return: None
+        """
+        if self.checkpoint is None:
+            return
+        harvest.page_progress(page)['parsed'] = True
+        self.advance_checkpoint(harvest)
+
+    def item_finished(self, item, spider, failure=None, **kwargs):
+        """
+        An item has been through the pipelines (item_scraped, item_dropped or item_error signal). A pipeline
+        error (failure) keeps the harvest from being recorded as complete, and its page from being checkpointed
+        """
+        item_pages = self.item_pages.get(item_key(item))
+        if not item_pages:
+            return
+        key, page = item_pages.popleft()
+        if not item_pages:
+            del self.item_pages[item_key(item)]
+        harvest = self.harvests.get(key)
+        if harvest is None:
+            return
+        if failure is not None:
+            harvest.errors += 1
+        if self.checkpoint is None:
+            return
+        progress = harvest.page_progress(page)
+        progress['outstanding'] -= 1
+        progress['records'] += 1
+        if failure is not None:
+            progress['failed'] = True
+        if progress['parsed'] and not progress['outstanding']:
+            self.advance_checkpoint(harvest)
+
+    def advance_checkpoint(self, harvest):
+        """
+        Checkpoint the pages of a harvest which are finished, in page order, so the checkpoint never gets ahead
+        of a page with records still in the pipelines, or of a page with a record a pipeline failed on
+
+        :param harvest: Harvest
+        :return: None
+        """
+        advanced = False
+        while True:
+            progress = harvest.pages.get(harvest.checkpoint_page)
+            if progress is None or not progress['parsed'] or progress['outstanding'] or progress['failed']:
+                break
+            del harvest.pages[harvest.checkpoint_page]
+            harvest.completed += progress['records']
+            harvest.checkpoint_high_water = max(filter(None, [harvest.checkpoint_high_water, progress['high_water']]),
+                                                default=None)
+            harvest.resume_token = harvest.tokens.pop(harvest.checkpoint_page, None)
+            harvest.checkpoint_page += 1
+            advanced = True
+        if advanced:
+            self.save_checkpoint(harvest)
+
+    def restart_from(self, harvest):
+        """
+        The 'from' datestamp to start a harvest again from when its resumption token can no longer be used.
+        If every record so far came in datestamp order, everything up to the high-water mark has been harvested,
+        otherwise the harvest starts again from its own 'from' (records which did not change are skipped by
+        WriteToOCFLPipeline)
+
+        :param harvest: Harvest
+        :return: datestamp, or None for a full harvest
+        """
+        if harvest.ordered and harvest.high_water:
+            return harvest.high_water
+        self.logger.warning(f"Records of {harvest.key} are not in datestamp order, starting it again from "
+                            f"{harvest.harvest_from or 'the beginning'}")
+        return harvest.harvest_from
+
+    def restart_request(self, harvest, page):
+        """
+        Replace an expired resumption token (badResumptionToken) with a new list request, from the datestamp
+        given by restart_from
+
+        :param harvest: Harvest
+        :param page: number of the page with the error
+        :return: Request for the next page, or None after MAX_RESTARTS restarts
+        """
+        harvest.restarts += 1
+        if harvest.restarts > MAX_RESTARTS:
+            self.logger.error(f"Resumption token of {harvest.key} expired {MAX_RESTARTS} times, giving up")
+            return None
+        from_ = self.restart_from(harvest)
+        self.logger.warning(f"Resumption token of {harvest.key} expired, listing again from {from_ or 'the beginning'}")
+        self.crawler.stats.inc_value('oaipmh/restarts')
+        harvest.outstanding += 1
+        return Request(with_params(harvest.url, from_=from_) if from_ else harvest.url, callback=self._parse,
+                       errback=self.page_failed, dont_filter=True,
+                       meta={'oai_harvest': harvest.key, 'oai_page': page + 1})
+
+    @property
+    def partition_concurrency(self):
+        """
+        Number of partitions of a harvest run at the same time (OAI_PARTITION_CONCURRENCY)
+        """
+        return max(self.settings.getint('OAI_PARTITION_CONCURRENCY', 4), 1)
+
+    def parse_sets(self, response):
+        """
+        Collect the sets of the endpoint from its ListSets pages, then split the harvest into one partition per set
+
+        :param response: ListSets response
+        :return: generator of requests
+        """
+        set_specs, token = parse_list_sets(response.body)
+        set_specs = response.meta['oai_sets'] + set_specs
+        if token:
+            yield response.request.replace(url=resumption_url(response.url, token),
+                                           meta={**response.meta, 'oai_sets': set_specs})
+            return
+        harvest = self.harvests[response.meta['oai_harvest']]
+        set_specs = top_level_sets(list(dict.fromkeys(set_specs)))
+        yield from self.split_harvest(harvest, [Harvest(with_params(harvest.url, set=spec), source=harvest.source,
+                                                        parent=harvest.key) for spec in set_specs])
+
+    def parse_identify(self, response):
+        """
+        Split the harvest into from/until windows, between its 'from' datestamp (or the earliest datestamp of the
+        repository) and now, at the datestamp granularity of the repository
+
+        :param response: Identify response
+        :return: generator of requests
+        """
+        harvest = self.harvests[response.meta['oai_harvest']]
+        earliest, granularity = parse_identify(response.body)
+        start = harvest.harvest_from or earliest
+        windows = date_windows(start, datetime.now(timezone.utc), self.settings.getint('OAI_PARTITION_WINDOWS', 16),
+                               granularity or 'YYYY-MM-DD') if start else []
+        yield from self.split_harvest(harvest, [Harvest(harvest.url, source=harvest.source, parent=harvest.key,
+                                                        window=window) for window in windows])
+
+    def split_harvest(self, harvest, partitions):
+        """
+        Replace a harvest with its partitions, and start the first OAI_PARTITION_CONCURRENCY of them.
+        A harvest which cannot be split (no sets, no earliest datestamp) is harvested with a single chain
+
+        :param harvest: Harvest being split
+        :param partitions: list of Harvests
+        :return: generator of requests
+        """
+        if not partitions:
+            self.logger.warning(f"Could not split {harvest.key} into partitions, harvesting it with a single chain")
+            yield self.start_request(harvest)
+            return
+        self.logger.info(f"Harvesting {harvest.key} in {len(partitions)} partitions, "
+                         f"{self.partition_concurrency} at a time")
+        del self.harvests[harvest.key]
+        for partition in partitions:
+            self.add_harvest(partition)
+            if self.checkpoint is not None:
+                # All partitions are in the checkpoint from the start, so a restarted job does not split again
+                self.save_checkpoint(partition)
+        self.waiting_partitions[harvest.key].extend(partitions)
+        yield from self.start_partitions(harvest.key)
+
+    def start_partitions(self, parent):
+        """
+        :param parent: key of a split harvest
+        :return: generator of first page requests of its waiting partitions, while fewer than
+            OAI_PARTITION_CONCURRENCY are running
+        """
+        waiting = self.waiting_partitions[parent]
+        while waiting and self.running_partitions[parent] < self.partition_concurrency:
+            self.running_partitions[parent] += 1
+            yield self.start_request(waiting.popleft())
+
+    def partitioning_failed(self, failure):
+        """
+        The ListSets or Identify request failed, harvest with a single chain instead
+        """
+        harvest = self.harvests[failure.request.meta['oai_harvest']]
+        self.logger.error(f"Could not split {harvest.key} into partitions: {failure.value}")
+        yield self.start_request(harvest)
+
+    def page_done(self, harvest):
+        """
+        Count a page of a harvest as processed. Once the last outstanding page of a partition has been processed
+        its chain has ended, complete or not, and the next waiting partition starts
+
+        :param harvest: Harvest
+        :return: generator of requests
+        """
+        harvest.outstanding -= 1
+        if harvest.outstanding == 0 and harvest.parent is not None:
+            self.running_partitions[harvest.parent] -= 1
+            yield from self.start_partitions(harvest.parent)
+
+    def page_failed(self, failure):
+        """
+        A page request failed (after retries). The harvest cannot continue without the page, so its chain ends
+        """
+        harvest = self.harvests[failure.request.meta['oai_harvest']]
+        self.logger.error(f"Harvest of {harvest.key} stopped: {failure.request.url} failed ({failure.value})")
+        yield from self.page_done(harvest)
+
+    def harvest_of(self, response):
+        """
+        :param response: http response of a list request
+        :return: the Harvest the response belongs to
+        """
+        key = response.meta.get('oai_harvest')
+        return self.harvests[key] if key is not None else next(iter(self.harvests.values()))
+
+    def queue_depths(self):
+        """
+        Queues of the harvests, for the StageMetrics extension: pages which arrived ahead of the page being
+        processed, and partitions waiting for a free chain
+
+        :return: dict of queue name to depth
+        """
+        return {'oai_pages_waiting': sum(len(harvest.waiting_pages) for harvest in self.harvests.values()),
+                'oai_partitions_waiting': sum(len(partitions) for partitions in self.waiting_partitions.values())}
+
+    @property
+    def prefetch_pages(self):
+        """
+        Number of pages to fetch ahead of the page being processed (OAI_PREFETCH_PAGES, 0 disables)
+        """
+        return self.settings.getint('OAI_PREFETCH_PAGES', 1)
+
+    def _parse(self, response, **kwargs):
+        if self.iterator != 'iterparse':
+            yield from super()._parse(response, **kwargs)
+            self.page_parsed(self.harvest_of(response), response.meta.get('oai_page', 0))
+            yield from self.page_done(self.harvest_of(response))
+            return
+        yield from self.parse_stream(self.adapt_response(response))
+
+    def parse_stream(self, response):
+        """
+        Handle an OAI-PMH page. The next page is requested before any records are parsed, using the
+        resumption token found at the end of the body, so it downloads while this page is processed.
+        Up to OAI_PREFETCH_PAGES pages are fetched ahead. Pages which arrive before an earlier page has
+        been processed wait for it, so records always reach the pipelines in page order
+
+        :param response: http response
+        :return: generator of items and page requests
+        """
+        harvest = self.harvest_of(response)
+        page = response.meta.get('oai_page', 0)
+        if self.prefetch_pages > 0:
+            token = sniff_resumption_token(response.body)
+            if token is not None:
+                harvest.requested_pages.add(page)
+                request = self.resumption_request(token, page, harvest)
+                if request is not None:
+                    if page + 1 - harvest.next_page > self.prefetch_pages:
+                        # Too far ahead, request it once the pages before have been processed
+                        harvest.held_request = request
+                    else:
+                        yield request
+
+        if page != harvest.next_page:
+            self.logger.debug(f"Page {page} of {harvest.key} waiting for page {harvest.next_page} to be processed")
+            harvest.waiting_pages[page] = response
+            return
+
+        while response is not None:
+            yield from self.parse_page(response)
+            self.page_parsed(harvest, harvest.next_page)
+            yield from self.page_done(harvest)
+            harvest.next_page += 1
+            if harvest.held_request is not None and \
+                    harvest.held_request.meta['oai_page'] - harvest.next_page <= self.prefetch_pages:
+                yield harvest.held_request
+                harvest.held_request = None
+            response = harvest.waiting_pages.pop(harvest.next_page, None)
+
+    def parse_page(self, response):
+        """
+        Parse an OAI-PMH page one record at a time. Each record element is wrapped in a Selector, so
+        parse_record works the same as with the 'xml' iterator, and is freed after parse_record returns
+
+        :param response: http response
+        :return: generator of items, and the next page request if it was not already made
+        """
+        harvest = self.harvest_of(response)
+        page = response.meta.get('oai_page', 0)
+        namespaces = dict(self.namespaces)
+        # A list which fits on one page has no resumption token at all
+        last_page = True
+        for tag, element in iterparse_page(response.body):
+            if tag == 'record':
+                node = Selector(root=element, type='xml', namespaces=namespaces)
+                yield from self.process_results(response, iterate_spider_output(self.parse_record(response, node)))
+            elif tag == 'resumptionToken':
+                self.logger.debug(f"completeListSize={element.get('completeListSize')}")
+                self.logger.debug(f"resumptionToken={element.text}")
+                last_page = False
+                if page not in harvest.requested_pages:
+                    request = self.resumption_request(element.text, page, harvest)
+                    if request is not None:
+                        yield request
+            elif element.get('code') == 'noRecordsMatch':
+                # Normal for an incremental harvest with nothing new
+                self.logger.info(f"No records match {response.url}")
+            elif element.get('code') == 'badResumptionToken' and self.checkpoint is not None:
+                last_page = False
+                request = self.restart_request(harvest, page)
+                if request is not None:
+                    yield request
+            else:
+                self.logger.error(f"OAI-PMH error {element.get('code')}: {element.text}")
+                last_page = False
+        harvest.requested_pages.discard(page)
+        if last_page:
+            harvest.complete = True
+
+    def resumption_request(self, token, page=0, harvest=None):
+        """
+        Build the request for the next page
+
+        :param token: resumption token of the current page
+        :param page: number of the current page in the resumption chain
+        :param harvest: Harvest of the current page (default: the first harvest of the run)
+        :return: Request, or None if this was the last page (an empty token)
+        """
+        harvest = harvest or next(iter(self.harvests.values()))
+        if not token or not token.strip():
+            harvest.complete = True
+            return None
+        harvest.tokens[page] = token.strip()
+        harvest.outstanding += 1
+        # Never filtered as a duplicate: some endpoints number their tokens, so the harvests of two sets
+        # can request the same resumption URL
+        return Request(resumption_url(harvest.url, token.strip()), callback=self._parse, errback=self.page_failed,
+                       dont_filter=True, meta={'oai_harvest': harvest.key, 'oai_page': page + 1})
+
+    def is_deleted(self, node):
+        """
+        :param node: oaipmh:record node
+        :return: True if the record header has status="deleted"
+        """
+        return node.xpath(self.status_xpath).get() == 'deleted'
+
+    def process_results(self, response, results):
+        """
+        Track the highest datestamp and deleted records from the items parsed out of each page, tag
+        items with the source of their harvest, and drop records already harvested by another partition
+        """
+        harvest = self.harvest_of(response)
+        page = response.meta.get('oai_page', 0)
+        seen = self.seen_identifiers[harvest.parent] if harvest.parent is not None else None
+        for result in results:
+            if isinstance(result, Feed2HtmlItem):
+                if harvest.source is not None:
+                    result['source'] = harvest.source
+                key = item_key(result)
+                if seen is not None:
+                    if key[1] in seen:
+                        self.crawler.stats.inc_value('oaipmh/duplicates')
+                        continue
+                    seen.add(key[1])
+                datestamp = result.get('datestamp')
+                if datestamp and harvest.high_water is not None and datestamp < harvest.high_water:
+                    harvest.ordered = False
+                if datestamp and (harvest.high_water is None or datestamp > harvest.high_water):
+                    harvest.high_water = datestamp
+                if result.get('deleted'):
+                    self.crawler.stats.inc_value('oaipmh/deleted')
+                if self.checkpoint is not None:
+                    progress = harvest.page_progress(page)
+                    progress['outstanding'] += 1
+                    if datestamp and (progress['high_water'] is None or datestamp > progress['high_water']):
+                        progress['high_water'] = datestamp
+                if self.checkpoint is not None or self.harvest_state is not None:
+                    self.item_pages[key].append((harvest.key, page))
+            yield result
+
+    def closed(self, reason):
+        """
+        Save the high-water mark of every harvest which completed without pipeline errors. OAI-PMH does not
+        return records in datestamp order, so the datestamp of an interrupted harvest does not mean everything
+        before it was seen, and a record which failed would not be harvested again after it
+        """
+        if self.checkpoint is not None and reason == 'finished' and \
+                all(harvest.complete and not harvest.pages for harvest in self.harvests.values()):
+            self.checkpoint.remove()
+        if self.harvest_state is None:
+            return
+        if reason != 'finished':
+            self.logger.warning(f"Harvest ended with '{reason}', harvest state not updated")
+            return
+        # The date windows of a harvest share its state, which is only updated when all of them completed
+        by_state_key = defaultdict(list)
+        for harvest in self.harvests.values():
+            by_state_key[harvest.state_key].append(harvest)
+        for state_key, harvests in by_state_key.items():
+            incomplete = [harvest.key for harvest in harvests if not harvest.complete]
+            if incomplete:
+                self.logger.warning(f"Harvest of {', '.join(incomplete)} did not complete, harvest state not updated")
+                continue
+            errors = sum(harvest.errors for harvest in harvests)
+            if errors:
+                self.logger.warning(f"{errors} records of {state_key} failed in the pipelines, "
+                                    f"harvest state not updated")
+                continue
+            # Nothing new since the last harvest keeps the previous high-water mark
+            datestamp = max(filter(None, [harvest.high_water for harvest in harvests] +
+                                [harvest.harvest_from for harvest in harvests]), default=None)
+            self.harvest_state.update(state_key, datestamp=datestamp)
+        self.harvest_state.save()
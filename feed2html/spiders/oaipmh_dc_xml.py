@@ -1,16 +1,16 @@
-import pytz
-from dateutil.parser import parse, ParserError
 from typing import Optional, Any
 
 import scrapy
-from scrapy import Request
 from scrapy.selector import Selector
 
+from feed2html.dates import guess_date
 from feed2html.items import Feed2HtmlItem
+from feed2html.mapping import OAI_DC
+from feed2html.spiders.oaipmh import OaipmhSpider
 import re
 
 
-class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
+class OaipmhDcSpider(OaipmhSpider):
     """
     Crawl an OAI-PMH XML feed and send the parsed items through configured pipelines
     """
@@ -20,8 +20,12 @@ class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
     identifier_xpath = 'oaipmh:header/oaipmh:identifier/text()'
     datestamp_xpath = 'oaipmh:header/oaipmh:datestamp/text()'
     publication_date_xpath = './/dc:date/text()'
+    # The publication year is guessed from the values of publication_date_xpath (also by scrapy rerender)
+    guess_publication_date = True
+    # Item fields, see feed2html.mapping
+    mapping = OAI_DC
 
-    extract_domain_regex = r'https?://([^/]+)'
+    extract_domain_regex = r'https?://([^/:]+)'
     allowed_domains = []
     url = None
     start_urls = []
@@ -33,7 +37,8 @@ class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
     resumption_xpath = "//oaipmh:resumptionToken"
     record_xpath = "//oaipmh:record"
     itertag = "oaipmh:OAI-PMH"
-    iterator = 'xml'
+    # Stream each page record by record. Set to 'xml' to parse whole pages with parse_node instead
+    iterator = 'iterparse'
 
     # Custom properties for pipelines to access when transforming or rendering documents
     # such as website name, path to assets, path to OCFL repository, etc.
@@ -49,6 +54,7 @@ class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
 
     # Set up custom settings and pipelines
     custom_settings = {
+        **OaipmhSpider.custom_settings,
         'ROBOTSTXT_OBEY': False,
         #'CLOSESPIDER_PAGECOUNT': 1,
         #'CLOSESPIDER_ITEMCOUNT': 1,
@@ -110,12 +116,12 @@ class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
         self.logger.debug(f"completeListSize={size}")
         token = resumption.xpath("./text()").get()
         self.logger.debug(f"resumptionToken={token}")
-        url = self.url.replace('&metadataPrefix=oai_dc', '')
-        req = Request(f"{url}&resumptionToken={token}", callback=self._parse)
+        req = self.resumption_request(token, response.meta.get('oai_page', 0), self.harvest_of(response))
 
         for record in records:
             yield self.parse_record(response, record)
-        yield req
+        if req is not None:
+            yield req
 
     def parse_record(self, response, node):
         """
@@ -131,17 +137,24 @@ class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
         item = Feed2HtmlItem()
         item['id'] = node.xpath(self.identifier_xpath).extract()
         item['datestamp'] = node.xpath(self.datestamp_xpath).get()
+        # Sanitise OAI identifier so that it is a valid FS directory name
+        # You might need to change this based on your own requirements and FS used
+        item['ocfl_id'] = re.sub(r'[/:, ]', '_', str(item['id'][0]))
+        if self.is_deleted(node):
+            # Deleted records have a header but no metadata. The item is still passed on so that
+            # pipelines can remove anything they stored for it in an earlier harvest
+            item['deleted'] = True
+            return item
+        # The XSLT renders the whole record, but the mapped fields are also set on the item for the other pipelines
+        item.update(self.field_mapping.extract(node.root))
         # Although we let XSLT handle all the other metadata fields directly, we know from experience
         # that dc:date in simple DC from DSpace can be an issue if the repository doesn't do its own
         # handling to reduce them down to a single publication date. Also, we might want some more powerful
         # parsing and formatting of date strings, and this is a lot easier to do in Python.
         # So, we have a static function that will try to guess and format the best date.
         # It will be passed to the XSLT as a parameter
-        item['date'] = self.guess_date(node.xpath(self.publication_date_xpath).extract(), item['id'])
+        item['date_issued'] = self.guess_date(node.xpath(self.publication_date_xpath).extract(), item['id'])
         item['xml'] = node.xpath('.').get()
-        # Sanitise OAI identifier so that it is a valid FS directory name
-        # You might need to change this based on your own requirements and FS used
-        item['ocfl_id'] = re.sub(r'[/:, ]', '_', str(item['id'][0]))
 
         # Other spiders use yield here, but it screwed up our data handling (the 1996 date ending up in many items etc)
         # so we are using the more straight-forward return here, to process things in strict order and return
@@ -154,53 +167,17 @@ class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
 
         :param dates: list of dates
         :param identitier: used for logging date errors which can be helpful in metadata validation
-        :return: formatted date
+        :return: year string, or None if no date could be parsed (rendered as xslt.UNKNOWN_DATE)
         """
-        parsed_dates = list()
-        if isinstance(dates, list):
-            for date in dates:
-                if len(date) == 4:
-                    # A date which is just a year, is probably what we are looking for.
-                    return date
-                # Parse the date string to a datetime object
-                try:
-                    parsed_date = parse(date).replace(tzinfo=pytz.UTC)
-                    if parsed_date is not None:
-                        parsed_dates.append(parsed_date)
-                except ParserError as error:
-                    self.logger.error(f"Could not parse date: {error}")
-                    if date is not None and len(date) > 4:
-                        try:
-                            # Hm, ok, we will just extract the first 4 consecutive numbers we see
-                            # and call it a date
-                            year_guess = re.search(r'[0-9]{4}', date)
-                            if year_guess is not None and year_guess.group():
-                                parsed_date = parse(year_guess.group()).replace(tzinfo=pytz.UTC)
-                                if parsed_date is not None:
-                                    parsed_dates.append(parsed_date)
-                        except ParserError as second_error:
-                            # OK, give up and skip this date
-                            self.logger.error(f"Could not parse partial date: {identifier}")
-
-        best_guess = None
-
-        if len(parsed_dates) > 0:
-            # Get the earliest date
-            best_guess = min(parsed_dates)
-
-        if best_guess is not None:
-            # Return just the year in this simple example
-            return best_guess.strftime("%Y")
-
-        return "Unknown date"
+        return guess_date(dates, identifier)
 
     def test(self, response):
         """
         We use this special method as our item validation test so we can use scrapy check
         as part of our test-driven development process
-        TODO: This test needs rewriting to support the new root node parsing, and a reference to a live site was removed
+        Start the OAI-PMH stand-in first: python benchmarks/oai_server.py --port 8000
 
-        @url https://localhost/oai/request?verb=GetRecord&metadataPrefix=oai_dc&identifier=oai:localhost:1234
+        @url http://localhost:8000/oai/request?verb=GetRecord&metadataPrefix=oai_dc&identifier=oai:bench:1
         @returns items 1 1
         @returns requests 0 0
         @scrapes id
@@ -209,6 +186,7 @@ class OaipmhDcSpider(scrapy.spiders.XMLFeedSpider):
         # Adapt this response to a TextReponse and create an XML node
         response = self.adapt_response(response)
         node = Selector(response, type="xml")
+        for prefix, uri in self.namespaces:
+            node.register_namespace(prefix, uri)
         # Return the actual parsed item from the check response
         return self.parse_node(response, node)
-
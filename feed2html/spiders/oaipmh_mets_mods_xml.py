@@ -1,19 +1,18 @@
 import hashlib
-
-import pytz
-from dateutil.parser import parse, ParserError
 from typing import Optional, Any
 
 import scrapy
-from scrapy import Request
+from lxml import etree
 from scrapy.selector import Selector
 from scrapy.utils.python import to_bytes
 
 from feed2html.items import Feed2HtmlItem
+from feed2html.mapping import METS, METS_FILE, MODS, PREMIS_OBJECT, compile_mapping
+from feed2html.spiders.oaipmh import OaipmhSpider
 import re
 
 
-class MetsModsXml(scrapy.spiders.XMLFeedSpider):
+class MetsModsXml(OaipmhSpider):
     """
     Crawl an OAI-PMH XML feed and send the parsed items through configured pipelines
     Assumeing METS wrapper with MODS metadata
@@ -24,7 +23,7 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
     identifier_xpath = 'oaipmh:header/oaipmh:identifier/text()'
     datestamp_xpath = 'oaipmh:header/oaipmh:datestamp/text()'
 
-    extract_domain_regex = r'https?://([^/]+)'
+    extract_domain_regex = r'https?://([^/:]+)'
     allowed_domains = []
     url = None
     start_urls = []
@@ -40,8 +39,21 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
     record_xpath = "//oaipmh:record"
     premis_xpath = ".//premis:object"
     mods_xpath = ".//mods:mods"
+    # The publication date is the MODS dateIssued as mapped by MODS (date_issued), taken as it is. For scrapy rerender
+    publication_date_xpath = f"({MODS['context']})[1]/{MODS['fields']['date_issued']}"
+    guess_publication_date = False
+    # Item fields, see feed2html.mapping. The MODS metadata is the main mapping, and the
+    # METS record fields and files to download have their own
+    mapping = MODS
+    record_mapping = METS
+    premis_mapping = PREMIS_OBJECT
+    # PREMIS might not be implemented everywhere, so files are also read from the METS fileSec.
+    # DSpace uses 'ORIGINAL', Eprints 'reference' for main files (and DSpace 'TEXT' for full text)
+    file_xpath = ".//mets:fileSec/mets:fileGrp[@USE='ORIGINAL' or @USE='reference']//mets:file"
+    file_mapping = METS_FILE
     itertag = "oaipmh:OAI-PMH"
-    iterator = 'xml'
+    # Stream each page record by record. Set to 'xml' to parse whole pages with parse_node instead
+    iterator = 'iterparse'
 
     # Custom properties for pipelines to access when transforming or rendering documents
     # such as website name, path to assets, path to OCFL repository, etc.
@@ -59,6 +71,7 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
 
     # Set up custom settings and pipelines
     custom_settings = {
+        **OaipmhSpider.custom_settings,
         'ROBOTSTXT_OBEY': False,
         'MEDIA_ALLOW_REDIRECTS': True,
         'FILES_STORE': file_crawl_path,
@@ -112,6 +125,13 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
 
         super().__init__(name, **kwargs)
 
+        namespaces = dict(self.namespaces)
+        self.record_field_mapping = compile_mapping(self.record_mapping, namespaces)
+        self.premis_field_mapping = compile_mapping(self.premis_mapping, namespaces)
+        self.file_field_mapping = compile_mapping(self.file_mapping, namespaces)
+        self.find_premis_objects = etree.XPath(self.premis_xpath, namespaces=namespaces)
+        self.find_files = etree.XPath(self.file_xpath, namespaces=namespaces)
+
     def parse_node(self, response, node):
         """
         Parse the main OAI-PMH node. We need to access the resumptionToken here which
@@ -129,15 +149,15 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
         self.logger.debug(f"completeListSize={size}")
         token = resumption.xpath("./text()").get()
         self.logger.debug(f"resumptionToken={token}")
-        url = self.url.replace('&metadataPrefix=oai_dc', '')
-        req = Request(f"{url}&resumptionToken={token}", callback=self._parse)
+        req = self.resumption_request(token, response.meta.get('oai_page', 0), self.harvest_of(response))
         i = 0
         for record in records:
             if i < 10:
                 yield self.parse_record(response, record)
             i = i + 1
 
-        yield req
+        if req is not None:
+            yield req
 
     def parse_record(self, response, node):
         """
@@ -159,49 +179,26 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
         # You might need to change this based on your own requirements and FS used
         item['ocfl_id'] = re.sub(r'[/:, ]', '_', str(item['id']))
 
-        # METS Agent (org) name
-        item['agent_name'] = node.xpath('.//mets:agent/mets:name/text()').get()
+        # Hash something about the item to use as a local ID / file path prefix
+        item_hash = hashlib.sha1(to_bytes(item['id'])).hexdigest()
+        item['hash'] = item_hash
+
+        if self.is_deleted(node):
+            # Deleted records have a header but no metadata. The item is still passed on so that
+            # pipelines can remove anything they stored for it in an earlier harvest
+            item['deleted'] = True
+            return item
 
+        element = node.root
+        # METS Agent (org) name
+        item.update(self.record_field_mapping.extract(element))
         # MODS basic metadata
-        item['title'] = node.xpath('.//mods:title/text()').get()
-        item['date_issued'] = node.xpath('.//mods:dateIssued/text()').get()
-        item['abstract'] = node.xpath('.//mods:abstract/text()').get()
-        item['identifier'] = node.xpath('.//mods:identifier/text()').extract()
-        item['language'] = node.xpath('.//mods:language/mods:languageTerm/text()').get()
-        item['publication_type'] = node.xpath('.//mods:genre/text()').get()
-
-        item['access_condition'] = node.xpath('.//mods:accessCondition/text()').get()
-
-        premis_objects = []
-        files = []
-        for premis_object in node.xpath(self.premis_xpath):
-            premis_uri = premis_object.xpath('.//premis:objectIdentifierValue/text()').get()
-            premis_size = premis_object.xpath('.//premis:size/text()').get()
-            premis_md5 = premis_object.xpath('.//premis:fixity/premis:messageDigest/text()').get()
-            premis_format = premis_object.xpath('.//premis:format/premis:formatDesignation/premis:formatName/text()').get()
-            object = {
-                'uri': premis_uri,
-                'size': premis_size,
-                'md5': premis_md5,
-                'format': premis_format
-            }
-            premis_objects.append(object)
-
-        # PREMIS might not be implemented everywhere, so also get fileSec/fileGrp
-        if len(premis_objects) == 0:
-            for fileGrp in node.xpath(".//fileSec/fileGrp[@USE='ORIGINAL' or @USE='reference']"):
-                # Filter out any unwanted groups here? DSpace uses 'ORIGINAL', Eprints 'reference' for main files
-                # and dspace uses 'TEXT' for full text
-                for file in fileGrp.xpath(".//file"):
-                    files.append({
-                        'uri': file.xpath("FLocat[LOCTYPE='URL']").attrib('xlink:href').get(),
-                        'size': file.attrib('SIZE').get(),
-                        'md5': file.attrib('CHECKSUM').get(),
-                        'format': file.attrib('MIMETYPE').get()
-                    })
-            item['files_to_download'] = files
-        else:
-            item['files_to_download'] = premis_objects
+        item.update(self.field_mapping.extract(element))
+
+        files = [self.premis_field_mapping.extract(obj) for obj in self.find_premis_objects(element)]
+        if not files:
+            files = [self.file_field_mapping.extract(file) for file in self.find_files(element)]
+        item['files_to_download'] = files
 
         item['file_urls'] = []
         for file in item['files_to_download']:
@@ -210,10 +207,6 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
         # Finally store the entire XML object if we want - e.g. to pass to XSLT
         item['xml'] = node.xpath('.').get()
 
-        # Finally finally, hash something about the item to use as a local ID / file path prefix
-        item_hash = hashlib.sha1(to_bytes(item['id'])).hexdigest()
-        item['hash'] = item_hash
-
         # Other spiders use yield here, but it screwed up our data handling (the 1996 date ending up in many items etc)
         # so we are using the more straight-forward return here, to process things in strict order and return
         # the item instead of a generator.
@@ -223,9 +216,9 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
         """
         We use this special method as our item validation test so we can use scrapy check
         as part of our test-driven development process
-        TODO: This test needs rewriting to support the new root node parsing, and a reference to a live site was removed
+        Start the OAI-PMH stand-in first: python benchmarks/oai_server.py --port 8000
 
-        @url https://localhost/oai/request?verb=GetRecord&metadataPrefix=oai_dc&identifier=oai:localhost:1234
+        @url http://localhost:8000/oai/request?verb=GetRecord&metadataPrefix=mets&identifier=oai:bench:1
         @returns items 1 1
         @returns requests 0 0
         @scrapes id
@@ -234,6 +227,8 @@ class MetsModsXml(scrapy.spiders.XMLFeedSpider):
         # Adapt this response to a TextReponse and create an XML node
         response = self.adapt_response(response)
         node = Selector(response, type="xml")
+        for prefix, uri in self.namespaces:
+            node.register_namespace(prefix, uri)
         # Return the actual parsed item from the check response
         return self.parse_node(response, node)
 
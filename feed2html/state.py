@@ -0,0 +1,95 @@
+"""
+Persistent harvest state, so that the next run of a spider can continue where the last one left off
+"""
+import json
+import logging
+import os
+from contextlib import suppress
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class HarvestState:
+    """
+    A small JSON store of per-harvest state, keyed by endpoint, set and metadataPrefix (see oai.harvest_key).
+    The main value kept is the high-water mark: the highest OAI datestamp seen in the last completed harvest,
+    which becomes the 'from' argument of the next one.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the JSON state file. It is created on the first save
+        """
+        self.path = path
+        self.harvests = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as f:
+                self.harvests = json.load(f)
+
+    def get(self, key):
+        """
+        :param key: harvest key
+        :return: the state dict for the harvest (empty if it has never completed)
+        """
+        return self.harvests.get(key, {})
+
+    def datestamp(self, key):
+        """
+        :param key: harvest key
+        :return: the high-water mark datestamp of the harvest, or None
+        """
+        return self.get(key).get('datestamp')
+
+    def update(self, key, **values):
+        """
+        Update the state of a harvest. The harvested time is set automatically
+
+        :param key: harvest key
+        :param values: state values to set
+        :return: None
+        """
+        state = self.harvests.setdefault(key, {})
+        state.update(values)
+        state['harvested'] = datetime.now(timezone.utc).isoformat()
+
+    def write(self):
+        """
+        Write the state file, via a temporary file so that a crash never leaves a truncated state file
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.harvests, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        """
+        Write the state file and log it
+        """
+        self.write()
+        logger.info(f"Saved harvest state to {self.path}")
+
+
+class HarvestCheckpoint(HarvestState):
+    """
+    Progress of a harvest job, keyed by harvest key: the endpoint URL, source and partition of each harvest, the
+    resumption token to continue from, the next page number, the number of records the pipelines have finished
+    with and their highest datestamp. It is saved after every page whose records have all been through the
+    pipelines, so a job which crashed or was killed continues from its last page when started again with the
+    same job ID, and removed when the job completes
+    """
+
+    def save(self):
+        self.write()
+        logger.debug(f"Saved harvest checkpoint to {self.path}")
+
+    def remove(self):
+        """
+        Remove the checkpoint file, once the job has completed
+        """
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+        logger.info(f"Harvest job complete, removed checkpoint {self.path}")
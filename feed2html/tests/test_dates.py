@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+
+import pytest
+from dateutil.parser import parse
+
+from feed2html.dates import guess_date, normalise_date
+
+
+@pytest.mark.parametrize('value', [
+    '2019', '2019-05', '2019-05-03', '2019-05-03T10:22:01Z', '2019-05-03T10:22Z', '2019-05-03 10:22:01.123+10:00',
+    '2019-05-03T10:22:01-0500', ' 2019-05-03 ',
+])
+def test_normalise_iso_dates_like_dateutil(value):
+    # Missing parts default to the start of the year or month, and fractions of seconds are dropped
+    expected = parse(value, default=datetime(1, 1, 1)).replace(tzinfo=timezone.utc, microsecond=0)
+
+    assert normalise_date(value) == expected
+
+
+def test_normalise_other_dates():
+    assert normalise_date('May 3, 2019') == datetime(2019, 5, 3, tzinfo=timezone.utc)
+    assert normalise_date('2019-02-30') == datetime(2019, 1, 1, tzinfo=timezone.utc)
+    assert normalise_date('circa 1850s') == datetime(1850, 1, 1, tzinfo=timezone.utc)
+    assert normalise_date('n.d.') is None
+
+
+def test_guess_date_prefers_year():
+    assert guess_date(['2001-05-01', '1999', '1998-01-01']) == '1999'
+
+
+def test_guess_date_earliest():
+    assert guess_date(['2020-08-24T19:47:30Z', '2019-05', 'n.d.'], 'oai:x:1') == '2019'
+    assert guess_date(['n.d.']) is None
+    assert guess_date([]) is None
+    assert guess_date(None) is None
@@ -0,0 +1,167 @@
+import cProfile
+import pstats
+from types import SimpleNamespace
+
+import pytest
+import scrapy
+from scrapy import signals
+from scrapy.exceptions import DropItem
+from scrapy.pipelines import ItemPipelineManager
+from scrapy.utils.test import get_crawler
+
+from feed2html.extensions import ItemProfiler, LatencyHistogram, StageMetrics, collapsed_stacks, frame_label
+
+
+def test_quantile_of_empty_histogram():
+    assert LatencyHistogram().quantile(0.5) == 0.0
+
+
+def test_quantile_interpolates_within_bucket():
+    histogram = LatencyHistogram(buckets=(1.0, 2.0, 4.0))
+    for seconds in (0.5, 1.5, 1.5, 3.0):
+        histogram.observe(seconds)
+
+    assert histogram.count == 4
+    assert histogram.sum == 6.5
+    assert histogram.counts == [1, 2, 1, 0]
+    # Rank 2 of 4 is halfway through the two observations of the (1, 2] bucket
+    assert histogram.quantile(0.5) == pytest.approx(1.5)
+    assert histogram.quantile(0.25) == pytest.approx(1.0)
+    assert histogram.quantile(0.1) == pytest.approx(0.4)
+    # Never more than the largest value observed
+    assert histogram.quantile(1.0) == 3.0
+
+
+def test_quantile_in_last_bucket_uses_maximum():
+    histogram = LatencyHistogram(buckets=(1.0,))
+    histogram.observe(0.5)
+    histogram.observe(9.0)
+
+    assert histogram.quantile(0.75) == pytest.approx(5.0)
+    assert histogram.quantile(0.99) <= 9.0
+
+
+def test_frame_label():
+    assert frame_label(('/src/feed2html/pipelines.py', 360, 'process_item')) == 'pipelines.py:process_item:360'
+    assert frame_label(('~', 0, "<method 'xpath' of 'lxml.etree._Element' objects>")) == \
+        "<method_'xpath'_of_'lxml.etree._Element'_objects>"
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+def outer():
+    return busy(200000) + busy(100000)
+
+
+def test_collapsed_stacks():
+    profiler = cProfile.Profile()
+    profiler.runcall(outer)
+
+    lines = collapsed_stacks(pstats.Stats(profiler))
+
+    stacks = {line.rsplit(' ', 1)[0]: int(line.rsplit(' ', 1)[1]) for line in lines}
+    busy_stacks = [stack for stack in stacks if stack.split(';')[-1].startswith('test_extensions.py:busy:')]
+    assert busy_stacks
+    assert all(stack.split(';')[-2].startswith('test_extensions.py:outer:') for stack in busy_stacks)
+    assert all(seconds > 0 for seconds in stacks.values())
+
+
+class TitlePipeline:
+    opened = False
+
+    def open_spider(self, spider):
+        self.opened = True
+
+    def process_item(self, item, spider):
+        item['title'] = item['title'].title()
+        return item
+
+
+class CheckPipeline:
+    def process_item(self, item, spider):
+        if not item['title']:
+            raise DropItem('no title')
+        if item['title'] == 'Fail':
+            raise ValueError(item['title'])
+        return item
+
+    def queue_depths(self):
+        return {'checks': 0}
+
+
+def item_pipelines(extensions, **settings):
+    """
+    Build the pipelines as Scrapy does, with the given extensions installed
+
+    :return: tuple of (dict of extension class to extension, pipeline manager, spider)
+    """
+    crawler = get_crawler(scrapy.Spider, {'EXTENSIONS': extensions, 'STAGE_METRICS_ENABLED': True,
+                                          'ITEM_PIPELINES': {TitlePipeline: 100, CheckPipeline: 200}, **settings})
+    spider = scrapy.Spider('items')
+    spider.crawler = crawler
+    pipelines = ItemPipelineManager.from_crawler(crawler)
+    pipelines.open_spider(spider)
+    return {type(extension): extension for extension in crawler.extensions.middlewares}, pipelines, spider
+
+
+def send_items(pipelines, spider, *titles):
+    """
+    Send an item with each title through the pipelines, and the signal the scraper sends once it is done
+    """
+    crawler = spider.crawler
+    for title in titles:
+        item = {'title': title}
+        results = []
+        pipelines.process_item(item, spider).addBoth(results.append)
+        result, = results
+        if isinstance(result, dict):
+            crawler.signals.send_catch_log(signals.item_scraped, item=item, response=None, spider=spider)
+        elif result.check(DropItem):
+            crawler.signals.send_catch_log(signals.item_dropped, item=item, response=None, spider=spider,
+                                           exception=result.value)
+        else:
+            crawler.signals.send_catch_log(signals.item_error, item=item, response=None, spider=spider,
+                                           failure=result)
+
+
+def test_stage_metrics_times_each_pipeline():
+    extensions, pipelines, spider = item_pipelines({StageMetrics: 500})
+    send_items(pipelines, spider, 'one', '', 'fail', 'two')
+    metrics = extensions[StageMetrics]
+
+    assert metrics.stages['TitlePipeline'].count == 4
+    assert metrics.stages['CheckPipeline'].count == 4
+    # Dropped items are not errors
+    assert metrics.stages['CheckPipeline'].errors == 1
+    assert [type(pipeline).__name__ for pipeline in metrics.pipelines] == ['TitlePipeline', 'CheckPipeline']
+    assert metrics.pipelines[0].opened
+    assert metrics.items_in_pipelines == 0
+
+
+def test_stage_metrics_queue_depths():
+    extensions, pipelines, spider = item_pipelines({StageMetrics: 500})
+    metrics = extensions[StageMetrics]
+    metrics.crawler.engine = SimpleNamespace()
+    metrics.items_in_pipelines = 1
+
+    # The engine queues are left out while the engine cannot report them
+    assert metrics.queue_depths(spider) == {'items': 1, 'checks': 0}
+
+
+def test_item_profiler_profiles_sampled_items(tmp_path):
+    output = str(tmp_path / 'profile.collapsed')
+    extensions, pipelines, spider = item_pipelines({StageMetrics: 500, ItemProfiler: 510}, PROFILE_SAMPLE_RATE=1.0,
+                                                   PROFILE_OUTPUT=output, PROFILE_FORMAT='collapsed')
+    profiler = extensions[ItemProfiler]
+    profiler.spider_opened(spider)
+    send_items(pipelines, spider, 'one', 'two')
+    profiler.spider_closed(spider, 'finished')
+
+    assert profiler.stats.get_value('profile/sampled_items') == 2
+    assert profiler.sampled == set()
+    # Both extensions wrap the pipelines
+    assert extensions[StageMetrics].stages['TitlePipeline'].count == 2
+    with open(output, encoding='utf8') as f:
+        assert 'test_extensions.py:process_item:' in f.read()
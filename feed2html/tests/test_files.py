@@ -0,0 +1,316 @@
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+import scrapy
+from scrapy.exceptions import StopDownload
+from scrapy.http import Headers, Request, Response
+from scrapy.pipelines.files import FileException
+from scrapy.utils.test import get_crawler
+
+from feed2html.files import PartialDownload, expected_file, parse_content_range
+from feed2html.pipelines import FilesRelativePipeline
+
+CONTENT = bytes(range(256)) * 40
+URL = 'http://example.org/bitstreams/a.pdf'
+
+
+def test_parse_content_range():
+    assert parse_content_range('bytes 1000-1999/5000') == (1000, 5000)
+    assert parse_content_range('bytes 0-99/*') == (0, None)
+    assert parse_content_range('items 0-1/2') is None
+    assert parse_content_range(None) is None
+
+
+def test_expected_file():
+    files = [{'uri': 'http://example.org/a.pdf', 'size': ' 1234 ', 'md5': ' ABCDEF '}]
+    assert expected_file(files, 'http://example.org/a.pdf') == (1234, 'abcdef')
+    assert expected_file(files, 'http://example.org/b.pdf') == (None, None)
+    assert expected_file([{'uri': 'u', 'size': 'unknown', 'md5': ''}], 'u') == (None, None)
+
+
+def test_resume_interrupted_part_file(tmp_path):
+    path = str(tmp_path / 'files' / 'a.pdf')
+    # The first crawl is interrupted after 1000 bytes
+    download = PartialDownload(path, total=len(CONTENT))
+    download.start(0)
+    download.write(CONTENT[:1000])
+    download.close()
+
+    # The next one asks for the rest with a range request and continues the checksums from the part file
+    download = PartialDownload(path, total=len(CONTENT))
+    offset = download.existing_size()
+    assert offset == 1000
+    download.start(offset)
+    download.write(CONTENT[offset:])
+    assert download.received == len(CONTENT) - offset
+    size, md5, sha512 = download.finish()
+    download.complete()
+
+    assert size == len(CONTENT)
+    assert md5 == hashlib.md5(CONTENT).hexdigest()
+    assert sha512 == hashlib.sha512(CONTENT).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not (tmp_path / 'files' / 'a.pdf.part').exists()
+
+
+def test_full_response_replaces_part_file(tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    with open(f"{path}.part", 'wb') as f:
+        f.write(b'stale data from another version of the file')
+
+    # The server ignored the Range header and sent the whole file
+    download = PartialDownload(path)
+    download.start(0)
+    download.write(CONTENT)
+    size, md5, _ = download.finish()
+
+    assert size == len(CONTENT)
+    assert md5 == hashlib.md5(CONTENT).hexdigest()
+
+
+def test_next_response_continues_without_hashing_again(tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    download = PartialDownload(path)
+    download.start(0)
+    download.write(CONTENT[:500])
+    # A response stopped part way: the same download continues with a range request from its size
+    download.start(download.size)
+    download.write(CONTENT[500:])
+    size, md5, _ = download.finish()
+
+    assert size == len(CONTENT)
+    assert md5 == hashlib.md5(CONTENT).hexdigest()
+
+
+def test_discard(tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    download = PartialDownload(path)
+    download.start(0)
+    download.write(CONTENT)
+    download.discard()
+
+    assert download.existing_size() == 0
+    assert not download.started
+
+
+def files_pipeline(tmp_path, **settings):
+    crawler = get_crawler(scrapy.Spider, dict(settings, FILES_STORE=str(tmp_path / 'files')))
+    pipeline = FilesRelativePipeline.from_crawler(crawler)
+    spider = scrapy.Spider('files')
+    spider.crawler = crawler
+    pipeline.open_spider(spider)
+    return pipeline, pipeline.spiderinfo
+
+
+def files_item(size=len(CONTENT), md5=hashlib.md5(CONTENT).hexdigest()):
+    return {'hash': 'abcdef', 'file_urls': [URL], 'files_added': [],
+            'files_to_download': [{'uri': URL, 'size': str(size) if size else None, 'md5': md5}]}
+
+
+def media_request(pipeline, info, item):
+    request, = pipeline.get_media_requests(item, info)
+    return request, os.path.join(pipeline.store.basedir, pipeline.file_path(request, info=info, item=item))
+
+
+def stream(pipeline, request, body, status=200, headers=None):
+    """
+    Send a response through the signals the downloader sends while the body arrives
+    """
+    headers = Headers(headers or {})
+    pipeline.headers_received(headers, len(body), request, None)
+    flags = []
+    for n in range(0, len(body), 1000):
+        try:
+            pipeline.bytes_received(body[n:n + 1000], request, None)
+        except StopDownload:
+            flags.append('download_stopped')
+            body = body[:n + 1000]
+            break
+    return Response(URL, status=status, headers=headers, body=body, request=request, flags=flags)
+
+
+def ranged_server(pipeline, requests):
+    """
+    Stand-in for the engine, answering range requests for the rest of CONTENT
+    """
+    from twisted.internet import defer
+
+    def download(request):
+        requests.append(request.headers['Range'])
+        offset = int(request.headers['Range'].decode().split('=')[1].rstrip('-'))
+        headers = {'Content-Range': f"bytes {offset}-{len(CONTENT) - 1}/{len(CONTENT)}", 'Accept-Ranges': 'bytes'}
+        return defer.succeed(stream(pipeline, request, CONTENT[offset:], status=206, headers=headers))
+
+    pipeline.crawler.engine = SimpleNamespace(download=download)
+
+
+def result_of(d):
+    results = []
+    d.addBoth(results.append)
+    result, = results
+    return result
+
+
+def test_file_up_to_date_is_not_downloaded(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item()
+    request, path = media_request(pipeline, info, item)
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+
+    result = pipeline.media_to_download(request, info, item=item)
+
+    assert result['status'] == 'uptodate'
+    assert result['sha512'] == hashlib.sha512(CONTENT).hexdigest()
+    assert item['files_added'] == [result]
+
+
+def test_file_streamed_to_part_file(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item()
+    request, path = media_request(pipeline, info, item)
+
+    assert pipeline.media_to_download(request, info, item=item) is None
+    assert request.headers['Accept-Encoding'] == b'identity'
+    result = pipeline.media_downloaded(stream(pipeline, request, CONTENT), request, info, item=item)
+
+    assert result['status'] == 'downloaded'
+    assert result['checksum'] == hashlib.md5(CONTENT).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(f"{path}.part")
+
+
+def test_interrupted_download_is_resumed(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item()
+    request, path = media_request(pipeline, info, item)
+    os.makedirs(os.path.dirname(path))
+    with open(f"{path}.part", 'wb') as f:
+        f.write(CONTENT[:1000])
+
+    assert pipeline.media_to_download(request, info, item=item) is None
+    assert request.headers['Range'] == b'bytes=1000-'
+    response = stream(pipeline, request, CONTENT[1000:], status=206,
+                      headers={'Content-Range': f"bytes 1000-{len(CONTENT) - 1}/{len(CONTENT)}"})
+    result = pipeline.media_downloaded(response, request, info, item=item)
+
+    assert result['status'] == 'resumed'
+    assert result['sha512'] == hashlib.sha512(CONTENT).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_streamed_download_checksum_mismatch(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item(md5='0' * 32)
+    request, path = media_request(pipeline, info, item)
+    pipeline.media_to_download(request, info, item=item)
+
+    with pytest.raises(FileException, match='checksum-mismatch'):
+        pipeline.media_downloaded(stream(pipeline, request, CONTENT), request, info, item=item)
+
+    assert not os.path.exists(path) and not os.path.exists(f"{path}.part")
+    assert item['files_added'] == []
+
+
+def test_download_checksum_mismatch(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    # Without a published size the file is downloaded as by FilesPipeline, then checked
+    item = files_item(size=None, md5='0' * 32)
+    request, path = media_request(pipeline, info, item)
+    assert pipeline.media_to_download(request, info, item=item) is None
+
+    with pytest.raises(FileException, match='checksum-mismatch'):
+        pipeline.media_downloaded(Response(URL, body=CONTENT, request=request), request, info, item=item)
+
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('size', [len(CONTENT), None])
+def test_large_file_downloaded_in_ranges(tmp_path, size):
+    pipeline, info = files_pipeline(tmp_path, FILES_STREAM_THRESHOLD=3000)
+    requests = []
+    ranged_server(pipeline, requests)
+    item = files_item(size=size, md5=None)
+    request, path = media_request(pipeline, info, item)
+    pipeline.media_to_download(request, info, item=item)
+
+    response = stream(pipeline, request, CONTENT, headers={'Accept-Ranges': 'bytes'})
+    assert response.flags == ['download_stopped']
+    assert request.meta['download_maxsize'] == 0
+    result = result_of(pipeline.media_downloaded(response, request, info, item=item))
+
+    assert requests == [b'bytes=3000-', b'bytes=6000-', b'bytes=9000-']
+    assert result['status'] == 'downloaded'
+    assert result['checksum'] == hashlib.md5(CONTENT).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_small_file_of_unknown_size_is_not_streamed(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item(size=None, md5=None)
+    request, path = media_request(pipeline, info, item)
+    pipeline.media_to_download(request, info, item=item)
+
+    response = stream(pipeline, request, CONTENT)
+    assert not request.meta['file_download'].started
+    result = pipeline.media_downloaded(response, request, info, item=item)
+
+    assert result['sha512'] == hashlib.sha512(CONTENT).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(f"{path}.part")
+
+
+def test_file_without_metadata_up_to_date(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item(size=None, md5=None)
+    request, path = media_request(pipeline, info, item)
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+
+    result = pipeline.media_to_download(request, info, item=item)
+
+    # The same result as for a file checked against its metadata, or downloaded
+    assert result['status'] == 'uptodate'
+    assert result['checksum'] == hashlib.md5(CONTENT).hexdigest()
+    assert result['sha512'] == hashlib.sha512(CONTENT).hexdigest()
+    assert item['files_added'] == [result]
+
+
+def test_error_response_part_file_discarded(tmp_path):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item()
+    request, path = media_request(pipeline, info, item)
+    pipeline.media_to_download(request, info, item=item)
+
+    # An error page the size of the file is streamed, as the headers do not tell the status
+    error = b'x' * len(CONTENT)
+    with pytest.raises(FileException, match='download-error'):
+        pipeline.media_downloaded(stream(pipeline, request, error, status=500), request, info, item=item)
+
+    assert not os.path.exists(path) and not os.path.exists(f"{path}.part")
+    assert item['files_added'] == []
+
+
+def test_failed_processing_discards_part_file(tmp_path, monkeypatch):
+    pipeline, info = files_pipeline(tmp_path)
+    item = files_item()
+    request, path = media_request(pipeline, info, item)
+    pipeline.media_to_download(request, info, item=item)
+    response = stream(pipeline, request, CONTENT)
+
+    def complete():
+        raise OSError('disk full')
+    monkeypatch.setattr(request.meta['file_download'], 'complete', complete)
+    with pytest.raises(OSError):
+        pipeline.media_downloaded(response, request, info, item=item)
+
+    assert not os.path.exists(f"{path}.part")
@@ -0,0 +1,96 @@
+from lxml import etree, html
+from scrapy import Request
+from scrapy.http import XmlResponse
+from scrapy.utils.test import get_crawler
+
+from feed2html.mapping import DSPACE_HTML, OAI_DC, XOAI, compile_mapping
+from feed2html.spiders.oaipmh_dc_xml import OaipmhDcSpider
+
+NAMESPACES = {'oaipmh': 'http://www.openarchives.org/OAI/2.0/'}
+
+DC_RECORD = b"""<record xmlns="http://www.openarchives.org/OAI/2.0/"><header><identifier>oai:x:1</identifier></header>
+<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+                     xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>One</dc:title><dc:creator>Smith, A</dc:creator><dc:creator>Jones, B</dc:creator>
+<dc:date>2001-05-01</dc:date><dc:date>1999</dc:date><dc:language>en</dc:language>
+</oai_dc:dc></metadata></record>"""
+
+XOAI_PAGE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>
+<record><header><identifier>oai:x:1</identifier><datestamp>2022-09-26T07:12:38Z</datestamp></header>
+<metadata><metadata xmlns="http://www.lyncode.com/xoai"><element name="dc">
+<element name="contributor"><element name="author"><element name="none">
+<field name="value">Deringer, William P</field><field name="authority">1003c81f</field>
+</element></element></element>
+<element name="date"><element name="issued"><element name="none"><field name="value">2020-03</field>
+</element></element></element>
+<element name="identifier"><element name="issn"><element name="none"><field name="value">1058-6180</field>
+</element></element><element name="uri"><element name="none">
+<field name="value">https://hdl.handle.net/1721.1/126771</field></element></element></element>
+<element name="title"><element name="en_US"><field name="value">Michael Milken's Spreadsheets</field>
+</element></element>
+</element></metadata></metadata></record>
+</ListRecords></OAI-PMH>"""
+
+DSPACE_PAGE = """<html><head><meta name="DC.title" content="A paper">
+<meta name="DC.creator" content="Smith, A"><meta name="DC.creator" content="Jones, B">
+<meta name="citation_pdf_url" content="http://example.org/a.pdf"></head><body></body></html>"""
+
+
+def test_mapping_fields():
+    mapping = compile_mapping(OAI_DC, NAMESPACES)
+
+    fields = mapping.extract(etree.fromstring(DC_RECORD))
+
+    assert fields['title'] == 'One'
+    assert fields['author'] == ['Smith, A', 'Jones, B']
+    assert fields['language'] == 'en'
+    assert fields['abstract'] is None
+    assert fields['subject'] == []
+    assert type(fields['title']) is str
+
+
+def test_mapping_without_context():
+    mapping = compile_mapping(OAI_DC, NAMESPACES)
+    record = etree.fromstring(b'<record xmlns="http://www.openarchives.org/OAI/2.0/"><header/></record>')
+
+    assert mapping.extract(record) == dict.fromkeys(OAI_DC['fields'])
+
+
+def test_mapping_attributes():
+    mapping = compile_mapping(DSPACE_HTML)
+
+    fields = mapping.extract(html.fromstring(DSPACE_PAGE))
+
+    assert fields['title'] == 'A paper'
+    assert fields['author'] == 'Smith, A'
+    assert fields['bitstream'] == 'http://example.org/a.pdf'
+    assert fields['abstract'] is None
+
+
+def test_dc_spider_sets_mapped_fields():
+    spider = OaipmhDcSpider.from_crawler(get_crawler(OaipmhDcSpider, {'OAI_PREFETCH_PAGES': 0}),
+                                         url='http://example.org/oai?verb=ListRecords&metadataPrefix=oai_dc')
+    page = b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>%s</ListRecords></OAI-PMH>' % DC_RECORD
+
+    item, = spider._parse(XmlResponse(spider.url, body=page, request=Request(spider.url)))
+
+    assert item['title'] == 'One'
+    assert item['author'] == ['Smith, A', 'Jones, B']
+    assert item['date_issued'] == '1999'
+
+
+def test_dc_spider_with_xoai_mapping():
+    url = 'http://example.org/oai?verb=ListRecords&metadataPrefix=xoai'
+    spider = OaipmhDcSpider.from_crawler(
+        get_crawler(OaipmhDcSpider, {'OAI_PREFETCH_PAGES': 0}), url=url, mapping='feed2html.mapping.XOAI',
+        publication_date_xpath=".//doc:element[@name='date']//doc:field[@name='value']/text()")
+    assert spider.mapping is XOAI
+
+    item, = spider._parse(XmlResponse(url, body=XOAI_PAGE, request=Request(url)))
+
+    assert item['title'] == "Michael Milken's Spreadsheets"
+    assert item['author'] == ['Deringer, William P']
+    assert item['identifier'] == ['1058-6180', 'https://hdl.handle.net/1721.1/126771']
+    assert item['language'] is None
+    assert item['date_issued'] == '2020'
@@ -0,0 +1,57 @@
+import os
+from types import SimpleNamespace
+
+import frontmatter
+import pytest
+import scrapy
+from scrapy.utils.test import get_crawler
+
+from feed2html.pipelines import ExportMarkdownPipeline
+
+
+def markdown_spider(tmp_path):
+    return SimpleNamespace(file_crawl_path=str(tmp_path), crawler=get_crawler(scrapy.Spider))
+
+
+def test_markdown_export(tmp_path):
+    spider = markdown_spider(tmp_path)
+    pipeline = ExportMarkdownPipeline()
+    pipeline.open_spider(spider)
+
+    for title in ('First', 'Second'):
+        pipeline.process_item({'hash': 'abcdef', 'id': ['oai:x:1'], 'title': title, 'xml': '<record/>'}, spider)
+    pipeline.process_item({'hash': 'abxyz', 'title': 'Other'}, spider)
+    pipeline.close_spider(spider)
+
+    post = frontmatter.load(str(tmp_path / 'ab' / 'abcdef' / 'metadata.md'))
+    assert post.metadata == {'hash': 'abcdef', 'id': ['oai:x:1'], 'title': 'Second'}
+    assert frontmatter.load(str(tmp_path / 'ab' / 'abxyz' / 'metadata.md'))['title'] == 'Other'
+    assert sorted(os.listdir(tmp_path / 'ab' / 'abcdef')) == ['metadata.md']
+
+
+def test_markdown_export_failure_keeps_previous_file(tmp_path, monkeypatch):
+    spider = markdown_spider(tmp_path)
+    pipeline = ExportMarkdownPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item({'hash': 'abcdef', 'title': 'First'}, spider)
+
+    def fail_part_way(item):
+        pipeline.exporter.file.write(b'---\ntitle: Sec')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(pipeline.exporter, 'export_item', fail_part_way)
+    with pytest.raises(OSError):
+        pipeline.process_item({'hash': 'abcdef', 'title': 'Second'}, spider)
+
+    assert frontmatter.load(str(tmp_path / 'ab' / 'abcdef' / 'metadata.md'))['title'] == 'First'
+
+
+def test_markdown_export_removes_deleted_records(tmp_path):
+    spider = markdown_spider(tmp_path)
+    pipeline = ExportMarkdownPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item({'hash': 'abcdef', 'title': 'First'}, spider)
+
+    pipeline.process_item({'hash': 'abcdef', 'deleted': True}, spider)
+
+    assert not os.path.exists(tmp_path / 'ab' / 'abcdef')
@@ -0,0 +1,68 @@
+from scrapy import Request
+from scrapy.http import XmlResponse
+from scrapy.utils.test import get_crawler
+
+from feed2html.spiders.oaipmh_mets_mods_xml import MetsModsXml
+
+URL = 'http://example.org/oai/request?verb=ListRecords&metadataPrefix=mets'
+
+PAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>
+<record><header><identifier>oai:x:1</identifier><datestamp>2020-01-02</datestamp></header>
+<metadata><mets xmlns="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink">
+<metsHdr><agent><name>Example University</name></agent></metsHdr>
+<dmdSec><mdWrap><xmlData><mods:mods xmlns:mods="http://www.loc.gov/mods/v3">
+<mods:titleInfo><mods:title>A paper</mods:title></mods:titleInfo>
+<mods:originInfo><mods:dateIssued>2001-05</mods:dateIssued></mods:originInfo>
+<mods:identifier type="uri">http://hdl.handle.net/1/1</mods:identifier>
+<mods:identifier type="doi">10.1/1</mods:identifier>
+<mods:language><mods:languageTerm>en</mods:languageTerm></mods:language>
+<mods:genre>Article</mods:genre>
+</mods:mods></xmlData></mdWrap></dmdSec>
+%s
+</mets></metadata></record>
+<record><header status="deleted"><identifier>oai:x:2</identifier><datestamp>2020-01-03</datestamp></header></record>
+</ListRecords></OAI-PMH>"""
+
+PREMIS = """<amdSec><techMD><mdWrap><xmlData><premis:premis xmlns:premis="http://www.loc.gov/standards/premis">
+<premis:object><premis:objectIdentifier>
+<premis:objectIdentifierValue>http://example.org/a.pdf</premis:objectIdentifierValue></premis:objectIdentifier>
+<premis:objectCharacteristics><premis:fixity><premis:messageDigest>abc</premis:messageDigest></premis:fixity>
+<premis:size>1234</premis:size><premis:format><premis:formatDesignation>
+<premis:formatName>application/pdf</premis:formatName></premis:formatDesignation></premis:format>
+</premis:objectCharacteristics></premis:object></premis:premis></xmlData></mdWrap></techMD></amdSec>"""
+
+FILESEC = """<fileSec><fileGrp USE="ORIGINAL"><file SIZE="99" CHECKSUM="def" MIMETYPE="text/plain">
+<FLocat LOCTYPE="URL" xlink:href="http://example.org/b.txt"/></file></fileGrp>
+<fileGrp USE="THUMBNAIL"><file SIZE="1"><FLocat LOCTYPE="URL" xlink:href="http://example.org/b.jpg"/></file>
+</fileGrp></fileSec>"""
+
+
+def parse(files):
+    spider = MetsModsXml.from_crawler(get_crawler(MetsModsXml, {'OAI_PREFETCH_PAGES': 0}), url=URL)
+    return list(spider._parse(XmlResponse(URL, body=(PAGE % files).encode('utf8'), request=Request(URL))))
+
+
+def test_mets_record():
+    item, deleted = parse(PREMIS)
+
+    assert item['id'] == 'oai:x:1'
+    assert item['agent_name'] == 'Example University'
+    assert item['title'] == 'A paper'
+    assert item['date_issued'] == '2001-05'
+    assert item['identifier'] == ['http://hdl.handle.net/1/1', '10.1/1']
+    assert item['language'] == 'en'
+    assert item['publication_type'] == 'Article'
+    assert item['abstract'] is None
+    assert item['files_to_download'] == [{'uri': 'http://example.org/a.pdf', 'size': '1234', 'md5': 'abc',
+                                          'format': 'application/pdf'}]
+    assert item['file_urls'] == ['http://example.org/a.pdf']
+    assert '<mods:title>A paper</mods:title>' in item['xml']
+    assert deleted['deleted'] and 'title' not in deleted
+
+
+def test_mets_files_from_file_section_without_premis():
+    item, _ = parse(FILESEC)
+
+    assert item['files_to_download'] == [{'uri': 'http://example.org/b.txt', 'size': '99', 'md5': 'def',
+                                          'format': 'text/plain'}]
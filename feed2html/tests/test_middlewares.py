@@ -0,0 +1,137 @@
+from email.utils import formatdate
+from types import SimpleNamespace
+
+from scrapy import Request
+from scrapy.core.downloader import Slot
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+from feed2html import middlewares
+from feed2html.middlewares import AdaptiveThrottleMiddleware, SlotThrottle, parse_retry_after
+from feed2html.spiders.oaipmh_dc_xml import OaipmhDcSpider
+from feed2html.spiders.oaipmh_mets_mods_xml import MetsModsXml
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(b'120') == 120.0
+    assert parse_retry_after(formatdate(1030.0, usegmt=True), now=1000.0) == 30.0
+    assert parse_retry_after(formatdate(900.0, usegmt=True), now=1000.0) == 0.0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_concurrency_grows_while_latency_is_low():
+    throttle = SlotThrottle(1, 4, min_delay=0.0, max_delay=60.0, tolerance=2.0)
+    # About one more request per round trip: +1/concurrency per response
+    throttle.latency_measured(0.1)
+    assert throttle.concurrency == 2.0
+    throttle.latency_measured(0.1)
+    assert throttle.concurrency == 2.5
+    for _ in range(20):
+        throttle.latency_measured(0.1)
+    assert throttle.concurrency == 4
+
+
+def test_concurrency_shrinks_when_latency_rises():
+    throttle = SlotThrottle(4, 4, min_delay=0.0, max_delay=60.0, tolerance=2.0)
+    throttle.latency_measured(0.1)
+    for _ in range(3):
+        throttle.latency_measured(1.0)
+    assert 1.0 < throttle.concurrency < 4
+    for _ in range(20):
+        throttle.latency_measured(1.0)
+    assert throttle.concurrency == 1.0
+
+
+def test_back_off_halves_once_per_round_trip():
+    throttle = SlotThrottle(8, 8, min_delay=0.5, max_delay=60.0, tolerance=2.0)
+    throttle.back_off(100.0)
+    throttle.back_off(100.5)
+    assert throttle.concurrency == 4.0
+    assert throttle.delay == 1.0
+    throttle.back_off(102.0)
+    assert throttle.concurrency == 2.0
+    assert throttle.delay == 2.0
+    # A response within the latency tolerance brings the delay back down to the configured one
+    throttle.latency_measured(0.1)
+    throttle.latency_measured(0.1)
+    assert throttle.delay == 0.5
+
+
+def test_retry_after_pauses_the_slot():
+    throttle = SlotThrottle(2, 8, min_delay=0.0, max_delay=60.0, tolerance=2.0)
+    throttle.back_off(100.0, retry_after=300.0)
+    assert throttle.paused(159.0)
+    assert not throttle.paused(160.0)
+    # The downloader counts the delay from the last request sent
+    assert throttle.slot_delay(110.0, lastseen=99.0) == 61.0
+    assert throttle.slot_delay(160.0, lastseen=99.0) == 0.0
+    # Responses to requests sent before the pause do not back off again
+    throttle.back_off(130.0)
+    assert throttle.concurrency == 1.0
+    assert throttle.delay == 0.0
+
+
+def throttle_middleware(monkeypatch, clock, **settings):
+    crawler = get_crawler(settings_dict={'ADAPTIVE_THROTTLE_ENABLED': True, 'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 4,
+                                         **settings})
+    slot = Slot(concurrency=8, delay=0.25, randomize_delay=True)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={'example.org': slot}, per_slot_settings={}))
+    monkeypatch.setattr(middlewares, 'time', SimpleNamespace(time=lambda: clock[0]))
+    return AdaptiveThrottleMiddleware(crawler), slot
+
+
+def test_middleware_holds_requests_during_retry_after(monkeypatch):
+    clock = [1000.0]
+    middleware, slot = throttle_middleware(monkeypatch, clock, ADAPTIVE_THROTTLE_START_CONCURRENCY=1)
+    request = Request('http://example.org/oai', meta={'download_slot': 'example.org'})
+    assert middleware.process_request(request, None) is None
+    assert slot.concurrency == 1
+
+    response = Response('http://example.org/oai', status=503, headers={'Retry-After': '30'}, request=request)
+    middleware.process_response(request, response, None)
+    # Requests already queued in the slot wait without a random delay, new ones are held until the pause ends
+    assert slot.delay >= 30.0
+    assert not slot.randomize_delay
+    held = middleware.process_request(request.replace(), None)
+    assert isinstance(held, Deferred)
+    held.addErrback(lambda failure: None)
+    held.cancel()
+
+    clock[0] += 30.0
+    assert middleware.process_request(request.replace(), None) is None
+    assert slot.delay == 0.25
+    assert slot.randomize_delay
+    assert middleware.stats.get_value('throttle/backoff_count/example.org') == 1
+
+
+def test_middleware_adapts_the_slot(monkeypatch):
+    clock = [1000.0]
+    middleware, slot = throttle_middleware(monkeypatch, clock, ADAPTIVE_THROTTLE_START_CONCURRENCY=1)
+    request = Request('http://example.org/oai', meta={'download_slot': 'example.org', 'download_latency': 0.1})
+    assert middleware.process_request(request, None) is None
+    assert slot.concurrency == 1
+
+    middleware.process_response(request, Response(request.url, request=request), None)
+    assert slot.concurrency == 2
+    assert slot.delay == 0.25
+    assert middleware.stats.get_value('throttle/concurrency/example.org') == 2
+
+
+def test_middleware_starts_at_the_slot_concurrency(monkeypatch):
+    clock = [1000.0]
+    middleware, slot = throttle_middleware(monkeypatch, clock)
+    request = Request('http://example.org/oai', meta={'download_slot': 'example.org'})
+    # Not slower than without the throttle, even above ADAPTIVE_THROTTLE_MAX_CONCURRENCY
+    assert middleware.process_request(request, None) is None
+    assert slot.concurrency == 8
+
+    response = Response('http://example.org/oai', status=503, request=request)
+    middleware.process_response(request, response, None)
+    assert slot.concurrency == 4
+
+
+def test_oai_spiders_enable_the_throttle():
+    for spider in (OaipmhDcSpider, MetsModsXml):
+        assert get_crawler(spider).settings.getbool('ADAPTIVE_THROTTLE_ENABLED')
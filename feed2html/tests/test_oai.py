@@ -0,0 +1,176 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from lxml import etree
+
+from feed2html.oai import (date_windows, harvest_key, iterparse_page, load_endpoints, parse_identify,
+                           parse_list_sets, resumption_url, sniff_resumption_token, top_level_sets, with_params)
+
+PAGE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>
+<record><header><identifier>oai:x:1</identifier></header></record>
+<record><header><identifier>oai:x:2</identifier></header></record>
+%s
+</ListRecords></OAI-PMH>"""
+
+
+def test_with_params():
+    url = 'http://example.org/oai?verb=ListRecords&metadataPrefix=oai_dc&set=a'
+    assert with_params(url, from_='2020-01-01', set=None) == \
+        'http://example.org/oai?verb=ListRecords&metadataPrefix=oai_dc&from=2020-01-01'
+
+
+def test_harvest_key():
+    assert harvest_key('http://example.org/oai?verb=ListRecords&metadataPrefix=oai_dc&set=a&from=2020') == \
+        'http://example.org/oai|a|oai_dc'
+    assert harvest_key('http://example.org/oai?metadataPrefix=mets&verb=ListRecords') == 'http://example.org/oai||mets'
+
+
+def test_resumption_url():
+    url = 'http://example.org/oai?verb=ListRecords&metadataPrefix=oai_dc&set=a&from=2020-01-01'
+    assert resumption_url(url, 'x y') == 'http://example.org/oai?verb=ListRecords&resumptionToken=x+y'
+
+
+def test_iterparse_page():
+    body = PAGE % b'<resumptionToken completeListSize="2">t1</resumptionToken>'
+    seen = []
+    for tag, element in iterparse_page(body):
+        seen.append((tag, element.findtext('.//{http://www.openarchives.org/OAI/2.0/}identifier') or element.text))
+        # Records already parsed have been freed
+        assert all(len(previous) == 0 for previous in element.itersiblings(preceding=True))
+
+    assert seen == [('record', 'oai:x:1'), ('record', 'oai:x:2'), ('resumptionToken', 't1')]
+
+
+def test_iterparse_page_error():
+    body = b"""<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<error code="noRecordsMatch">No matching records</error></OAI-PMH>"""
+    assert [(tag, element.get('code')) for tag, element in iterparse_page(body)] == [('error', 'noRecordsMatch')]
+
+
+def test_sniff_resumption_token():
+    assert sniff_resumption_token(PAGE % b'<resumptionToken cursor="0">a/b&amp;c</resumptionToken>') == 'a/b&c'
+    assert sniff_resumption_token(PAGE % b'<oai:resumptionToken>\n  t1 \n</oai:resumptionToken>') == 't1'
+
+
+def test_sniff_resumption_token_last_page():
+    assert sniff_resumption_token(PAGE % b'<resumptionToken completeListSize="1" cursor="0"/>') == ''
+    assert sniff_resumption_token(PAGE % b'<resumptionToken></resumptionToken>') == ''
+    assert sniff_resumption_token(PAGE % b'') is None
+
+
+def test_sniff_resumption_token_only_searches_the_tail():
+    body = PAGE % (b'<resumptionToken>t1</resumptionToken>' + b' ' * 100)
+    assert sniff_resumption_token(body, tail=50) is None
+
+
+def write_endpoints(tmp_path, endpoints):
+    path = tmp_path / 'endpoints.json'
+    path.write_text(json.dumps(endpoints))
+    return str(path)
+
+
+def test_load_endpoints(tmp_path):
+    path = write_endpoints(tmp_path, {'endpoints': [
+        {'url': 'http://example.org:8080/oai?verb=ListRecords&metadataPrefix=oai_dc', 'sets': ['a', 'b']},
+        {'url': 'http://example.com/oai?verb=ListRecords&metadataPrefix=mets', 'name': 'My repository/2'},
+    ]})
+
+    first, second = load_endpoints(path)
+
+    assert (first['name'], first['sets']) == ('example.org', ['a', 'b'])
+    assert (second['name'], second['sets']) == ('My_repository_2', [])
+
+
+def test_load_endpoints_names_are_unique(tmp_path):
+    path = write_endpoints(tmp_path, [{'url': 'http://example.org/oai?metadataPrefix=oai_dc'},
+                                      {'url': 'http://example.org/oai?metadataPrefix=mets'}])
+
+    with pytest.raises(ValueError):
+        load_endpoints(path)
+
+
+def test_top_level_sets():
+    assert top_level_sets(['a', 'a:b', 'c:d', 'c:d:e', 'ab']) == ['a', 'c:d', 'ab']
+
+
+def test_parse_list_sets():
+    body = b"""<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListSets>
+<set><setSpec>a</setSpec><setName>A</setName></set><set><setSpec> a:b </setSpec></set>
+<resumptionToken>t</resumptionToken></ListSets></OAI-PMH>"""
+    assert parse_list_sets(body) == (['a', 'a:b'], 't')
+    assert parse_list_sets(body.replace(b'<resumptionToken>t</resumptionToken>', b'')) == (['a', 'a:b'], None)
+
+
+def test_parse_identify():
+    body = b"""<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><Identify>
+<earliestDatestamp>2001-01-01T00:00:00Z</earliestDatestamp><granularity>YYYY-MM-DDThh:mm:ssZ</granularity>
+</Identify></OAI-PMH>"""
+    assert parse_identify(body) == ('2001-01-01T00:00:00Z', 'YYYY-MM-DDThh:mm:ssZ')
+    assert parse_identify(b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"/>') == (None, None)
+
+
+def test_date_windows_days():
+    windows = date_windows('2020-01-01', datetime(2020, 1, 11, 12, tzinfo=timezone.utc), 2)
+    assert windows == [('2020-01-01', '2020-01-05'), ('2020-01-06', None)]
+
+
+def test_date_windows_seconds():
+    windows = date_windows('2020-01-01T00:00:00Z', datetime(2020, 1, 1, 0, 0, 30, tzinfo=timezone.utc), 3,
+                           granularity='YYYY-MM-DDThh:mm:ssZ')
+    assert windows == [('2020-01-01T00:00:00Z', '2020-01-01T00:00:09Z'),
+                       ('2020-01-01T00:00:10Z', '2020-01-01T00:00:19Z'),
+                       ('2020-01-01T00:00:20Z', None)]
+
+
+def test_date_windows_short_range():
+    # Never more windows than units of the granularity, and never an empty one
+    windows = date_windows('2020-01-01', datetime(2020, 1, 2, 12, tzinfo=timezone.utc), 16)
+    assert windows == [('2020-01-01', '2020-01-01'), ('2020-01-02', None)]
+    # A start after the end gives no windows, the spider then harvests with a single chain
+    assert date_windows('2030-01-01', datetime(2020, 1, 1, tzinfo=timezone.utc), 4) == []
+
+
+
+LAUGHS = b"""<?xml version="1.0"?>
+<!DOCTYPE OAI-PMH [
+<!ENTITY lol "lol">
+<!ENTITY lol1 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">
+<!ENTITY lol2 "&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;">
+<!ENTITY lol3 "&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;">
+<!ENTITY lol4 "&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;">
+<!ENTITY lol5 "&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;">
+<!ENTITY lol6 "&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;">
+<!ENTITY lol7 "&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;">
+<!ENTITY lol8 "&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;">
+<!ENTITY lol9 "&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;">
+]>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListSets>
+<set><setSpec>&lol9;</setSpec></set><record><header><identifier>&lol9;</identifier></header></record>
+</ListSets></OAI-PMH>"""
+
+ENTITIES = b"""<?xml version="1.0"?>
+<!DOCTYPE OAI-PMH [<!ENTITY lol "lol"><!ENTITY secret SYSTEM "file://%s">]>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListSets>
+<set><setSpec>a&lol;&secret;</setSpec></set><record><header><identifier>a&lol;&secret;</identifier></header></record>
+<resumptionToken>t&lol;&secret;</resumptionToken></ListSets></OAI-PMH>"""
+
+
+def test_entity_bomb_rejected():
+    with pytest.raises(etree.XMLSyntaxError):
+        list(iterparse_page(LAUGHS))
+    with pytest.raises(etree.XMLSyntaxError):
+        parse_list_sets(LAUGHS)
+
+
+def test_entities_not_resolved(tmp_path):
+    secret = tmp_path / 'secret'
+    secret.write_text('password')
+    body = ENTITIES % str(secret).encode()
+
+    # References are kept as they are, neither expanded nor loaded
+    assert [''.join(element.itertext()) for tag, element in iterparse_page(body)] == \
+        ['a&lol;&secret;', 't&lol;&secret;']
+    set_specs, token = parse_list_sets(body)
+    assert set_specs == ['a'] and 'password' not in token
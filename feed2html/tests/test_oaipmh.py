@@ -0,0 +1,395 @@
+import json
+from types import SimpleNamespace
+
+from scrapy import Request
+from scrapy.http import XmlResponse
+from scrapy.utils.test import get_crawler
+
+from feed2html.items import Feed2HtmlItem
+from feed2html.oai import split_url
+from feed2html.spiders.oaipmh import MAX_RESTARTS
+from feed2html.spiders.oaipmh_dc_xml import OaipmhDcSpider
+from feed2html.state import HarvestState
+
+URL = 'http://example.org/oai?verb=ListRecords&metadataPrefix=oai_dc'
+
+PAGE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+         xmlns:dc="http://purl.org/dc/elements/1.1/"><ListRecords>
+<record><header><identifier>oai:x:1</identifier><datestamp>2020-01-02</datestamp></header>
+<metadata><oai_dc:dc><dc:title>One</dc:title><dc:date>2001-05-01</dc:date><dc:date>1999</dc:date></oai_dc:dc></metadata>
+</record>
+<record><header status="deleted"><identifier>oai:x:2</identifier><datestamp>2020-01-03</datestamp></header></record>
+%s
+</ListRecords></OAI-PMH>"""
+
+
+class DcSpider(OaipmhDcSpider):
+    """
+    OaipmhDcSpider with a minimal parse_record, to test the page handling on its own
+    """
+
+    def parse_record(self, response, node):
+        return Feed2HtmlItem(id=node.xpath(self.identifier_xpath).get(),
+                             datestamp=node.xpath(self.datestamp_xpath).get(),
+                             deleted=self.is_deleted(node), xml=node.xpath('.').get())
+
+
+def page_response(token=b'<resumptionToken completeListSize="3">a b</resumptionToken>', page=0):
+    return XmlResponse(URL, body=PAGE % token, request=Request(URL, meta={'oai_page': page}))
+
+
+def describe(results):
+    return [f"page {result.meta['oai_page']}" if isinstance(result, Request) else result['id'] for result in results]
+
+
+def state_spider(tmp_path):
+    crawler = get_crawler(OaipmhDcSpider)
+    return OaipmhDcSpider.from_crawler(crawler, url=URL, state_path=str(tmp_path / 'state.json'))
+
+
+def first_harvest(spider):
+    return next(iter(spider.harvests.values()))
+
+
+def harvest(spider, *datestamps):
+    """
+    Pass the items of a one-page harvest through process_results
+    """
+    items = [Feed2HtmlItem(id=f"oai:x:{datestamp}", datestamp=datestamp) for datestamp in datestamps]
+    results = list(spider.process_results(page_response(), items))
+    spider.resumption_request('', 0, first_harvest(spider))
+    return results
+
+
+def test_incremental_harvest_starts_from_high_water_mark(tmp_path):
+    spider = state_spider(tmp_path)
+    assert first_harvest(spider).start_url == URL
+    harvest(spider, '2020-01-02', '2020-01-03', '2020-01-01')
+    spider.closed('finished')
+
+    assert HarvestState(str(tmp_path / 'state.json')).datestamp(first_harvest(spider).key) == '2020-01-03'
+    spider = state_spider(tmp_path)
+    assert first_harvest(spider).harvest_from == '2020-01-03'
+    assert first_harvest(spider).start_url == f"{URL}&from=2020-01-03"
+
+
+def test_interrupted_harvest_keeps_state(tmp_path):
+    spider = state_spider(tmp_path)
+    harvest(spider, '2020-01-02')
+    spider.closed('shutdown')
+
+    assert first_harvest(state_spider(tmp_path)).harvest_from is None
+
+
+def test_empty_incremental_harvest_keeps_high_water_mark(tmp_path):
+    spider = state_spider(tmp_path)
+    harvest(spider, '2020-01-02')
+    spider.closed('finished')
+
+    spider = state_spider(tmp_path)
+    harvest(spider)
+    spider.closed('finished')
+
+    assert first_harvest(state_spider(tmp_path)).harvest_from == '2020-01-02'
+
+
+def test_harvest_with_failed_records_keeps_state(tmp_path):
+    spider = state_spider(tmp_path)
+    first, second = harvest(spider, '2020-01-02', '2020-01-03')
+    spider.item_finished(first, spider)
+    # Pipelines may hand on a copy of the item
+    spider.item_finished(second.copy(), spider, failure=object())
+    spider.closed('finished')
+
+    assert first_harvest(spider).errors == 1
+    assert not spider.item_pages
+    assert first_harvest(state_spider(tmp_path)).harvest_from is None
+
+
+def test_items_not_tracked_without_state_or_checkpoint():
+    spider = OaipmhDcSpider.from_crawler(get_crawler(OaipmhDcSpider), url=URL)
+    item, = harvest(spider, '2020-01-02')
+
+    assert not spider.item_pages
+    spider.item_finished(item, spider, failure=object())
+
+
+def test_deleted_records_are_counted(tmp_path):
+    spider = state_spider(tmp_path)
+    list(spider.process_results(page_response(), [Feed2HtmlItem(datestamp='2020', deleted=True)]))
+
+    assert spider.crawler.stats.get_value('oaipmh/deleted') == 1
+
+
+def test_parse_stream():
+    spider = DcSpider.from_crawler(get_crawler(DcSpider, {'OAI_PREFETCH_PAGES': 0}), url=f"{URL}&set=a")
+
+    results = list(spider._parse(page_response()))
+
+    first, deleted, request = results
+    assert (first['id'], first['datestamp'], first['deleted']) == ('oai:x:1', '2020-01-02', False)
+    assert '<dc:title>One</dc:title>' in first['xml']
+    assert (deleted['id'], deleted['deleted']) == ('oai:x:2', True)
+    assert isinstance(request, Request)
+    assert request.url == 'http://example.org/oai?verb=ListRecords&resumptionToken=a+b'
+
+
+def test_parse_stream_last_page():
+    for token in (b'<resumptionToken completeListSize="2"/>', b''):
+        spider = DcSpider.from_crawler(get_crawler(DcSpider), url=URL)
+        results = list(spider._parse(page_response(token)))
+        assert [result['id'] for result in results] == ['oai:x:1', 'oai:x:2']
+
+
+def test_parse_stream_matches_xml_iterator():
+    spider = DcSpider.from_crawler(get_crawler(DcSpider, {'OAI_PREFETCH_PAGES': 0}), url=URL)
+    streamed = list(spider._parse(page_response()))
+    spider.iterator = 'xml'
+    parsed = list(spider._parse(page_response()))
+
+    assert [(result['id'], result['deleted']) for result in streamed[:2]] == \
+        [(result['id'], result['deleted']) for result in parsed[:2]]
+    assert streamed[2].url == parsed[2].url
+
+
+def test_prefetch_requests_next_page_before_records():
+    spider = DcSpider.from_crawler(get_crawler(DcSpider), url=URL)
+
+    assert describe(spider._parse(page_response())) == ['page 1', 'oai:x:1', 'oai:x:2']
+
+
+def test_prefetch_falls_back_to_parsed_token():
+    spider = DcSpider.from_crawler(get_crawler(DcSpider), url=URL)
+    # The token is too far from the end of the body to be sniffed, so it is taken from the parsed page
+    token = b'<resumptionToken>a b</resumptionToken>' + b' ' * (64 * 1024)
+
+    assert describe(spider._parse(page_response(token))) == ['oai:x:1', 'oai:x:2', 'page 1']
+
+
+def test_prefetch_keeps_page_order():
+    spider = DcSpider.from_crawler(get_crawler(DcSpider), url=URL)
+    first_page = spider._parse(page_response(page=0))
+    assert describe([next(first_page)]) == ['page 1']
+
+    # Page 1 arrives while page 0 is still being processed: it waits, and its next page is held back
+    assert describe(spider._parse(page_response(page=1))) == []
+    assert first_harvest(spider).held_request.meta['oai_page'] == 2
+
+    assert describe(first_page) == ['oai:x:1', 'oai:x:2', 'page 2', 'oai:x:1', 'oai:x:2']
+    assert first_harvest(spider).held_request is None
+    assert first_harvest(spider).next_page == 2
+
+
+def endpoints_spider(tmp_path):
+    path = tmp_path / 'endpoints.json'
+    path.write_text(json.dumps([
+        {'url': 'http://example.org:8080/oai?verb=ListRecords&metadataPrefix=oai_dc', 'sets': ['a', 'b'],
+         'concurrency': 1, 'delay': 2},
+        {'url': 'http://example.com/oai?verb=ListRecords&metadataPrefix=oai_dc', 'name': 'com'},
+    ]))
+    crawler = get_crawler(DcSpider, {'OAI_PREFETCH_PAGES': 0})
+    spider = DcSpider.from_crawler(crawler, url=URL, endpoints=str(path))
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(per_slot_settings={}))
+    return spider
+
+
+def test_endpoints_are_harvested_at_once(tmp_path):
+    spider = endpoints_spider(tmp_path)
+
+    requests = list(spider.start_requests())
+
+    assert [request.url for request in requests] == [
+        'http://example.org:8080/oai?verb=ListRecords&metadataPrefix=oai_dc&set=a',
+        'http://example.org:8080/oai?verb=ListRecords&metadataPrefix=oai_dc&set=b',
+        'http://example.com/oai?verb=ListRecords&metadataPrefix=oai_dc',
+    ]
+    assert sorted(spider.allowed_domains) == ['example.com', 'example.org', 'example.org']
+    assert spider.crawler.engine.downloader.per_slot_settings == {'example.org': {'concurrency': 1, 'delay': 2}}
+
+
+def test_endpoint_pages_are_kept_apart(tmp_path):
+    spider = endpoints_spider(tmp_path)
+    set_a, set_b, com = spider.start_requests()
+
+    def response(request):
+        return XmlResponse(request.url, body=PAGE % b'<resumptionToken>t</resumptionToken>', request=request)
+
+    *items, next_page = spider._parse(response(set_b))
+    assert [item['source'] for item in items] == ['example.org', 'example.org']
+    assert next_page.url == 'http://example.org:8080/oai?verb=ListRecords&resumptionToken=t'
+    assert next_page.meta['oai_harvest'] == set_b.meta['oai_harvest']
+
+    *items, _ = spider._parse(response(com))
+    assert [item['source'] for item in items] == ['com', 'com']
+    assert [harvest.next_page for harvest in spider.harvests.values()] == [0, 1, 1]
+
+
+def test_allowed_domains_without_port():
+    spider = DcSpider.from_crawler(get_crawler(DcSpider), url='http://localhost:8000/oai/request?verb=ListRecords')
+
+    assert spider.allowed_domains == ['localhost']
+
+
+LIST_SETS = b"""<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListSets>
+<set><setSpec>a</setSpec></set><set><setSpec>a:1</setSpec></set><set><setSpec>b</setSpec></set>
+<set><setSpec>c</setSpec></set></ListSets></OAI-PMH>"""
+
+
+def partition_spider(partition, **settings):
+    crawler = get_crawler(DcSpider, {'OAI_PREFETCH_PAGES': 0, **settings})
+    spider = DcSpider.from_crawler(crawler, url=URL, partition=partition)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(per_slot_settings={}))
+    return spider
+
+
+def test_set_partitions_run_a_few_at_a_time():
+    spider = partition_spider('sets', OAI_PARTITION_CONCURRENCY=2)
+    list_sets, = spider.start_requests()
+    assert list_sets.url == 'http://example.org/oai?verb=ListSets'
+
+    started = list(spider.parse_sets(XmlResponse(list_sets.url, body=LIST_SETS, request=list_sets)))
+
+    assert [request.url for request in started] == [f"{URL}&set=a", f"{URL}&set=b"]
+    # The last page of set a ends its chain, and set c starts
+    last_page = XmlResponse(started[0].url, body=PAGE % b'', request=started[0])
+    assert describe(spider._parse(last_page)) == ['oai:x:1', 'oai:x:2', 'page 0']
+    assert list(spider.harvests.values())[2].url == f"{URL}&set=c"
+
+
+def test_set_partitions_drop_records_harvested_twice():
+    spider = partition_spider('sets')
+    list_sets, = spider.start_requests()
+    set_a, set_b, _ = spider.parse_sets(XmlResponse(list_sets.url, body=LIST_SETS, request=list_sets))
+
+    items = [result for request in (set_a, set_b)
+             for result in spider._parse(XmlResponse(request.url, body=PAGE % b'', request=request))]
+
+    assert [item['id'] for item in items] == ['oai:x:1', 'oai:x:2']
+    assert spider.crawler.stats.get_value('oaipmh/duplicates') == 2
+
+
+def test_date_partitions():
+    spider = partition_spider('dates', OAI_PARTITION_WINDOWS=2)
+    identify, = spider.start_requests()
+    assert identify.url == 'http://example.org/oai?verb=Identify'
+    body = b"""<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><Identify>
+<earliestDatestamp>2000-01-01</earliestDatestamp><granularity>YYYY-MM-DD</granularity></Identify></OAI-PMH>"""
+
+    first, second = spider.parse_identify(XmlResponse(identify.url, body=body, request=identify))
+
+    assert f"{URL}&until=" in first.url and first.url.endswith('&from=2000-01-01')
+    assert f"{URL}&from=" in second.url and 'until' not in second.url
+    assert {harvest.state_key for harvest in spider.harvests.values()} == {first_harvest(spider).state_key}
+
+
+def test_harvest_with_one_chain_when_partitioning_fails():
+    spider = partition_spider('sets')
+    list_sets, = spider.start_requests()
+    empty = b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListSets/></OAI-PMH>'
+
+    request, = spider.parse_sets(XmlResponse(list_sets.url, body=empty, request=list_sets))
+
+    assert request.url == URL
+
+
+BAD_RESUMPTION_TOKEN = b"""<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<error code="badResumptionToken">The resumption token has expired</error>
+</OAI-PMH>"""
+
+
+def job_spider(tmp_path):
+    crawler = get_crawler(OaipmhDcSpider, {'OAI_CHECKPOINT_DIR': str(tmp_path)})
+    spider = OaipmhDcSpider.from_crawler(crawler, url=URL, job='job')
+    list(spider.start_checkpoint())
+    return spider, next(iter(spider.harvests.values()))
+
+
+def job_page_response(harvest, page, body):
+    request = Request(URL, meta={'oai_harvest': harvest.key, 'oai_page': page})
+    return XmlResponse(URL, body=body, request=request)
+
+
+def test_expired_token_lists_again_from_high_water_mark(tmp_path):
+    spider, harvest = job_spider(tmp_path)
+    harvest.high_water = '2020-03-01T00:00:00Z'
+
+    requests = list(spider.parse_page(job_page_response(harvest, 2, BAD_RESUMPTION_TOKEN)))
+
+    assert len(requests) == 1
+    _, query = split_url(requests[0].url)
+    assert query == {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'from': '2020-03-01T00:00:00Z'}
+    assert requests[0].meta['oai_page'] == 3
+    assert not harvest.complete
+    assert spider.crawler.stats.get_value('oaipmh/restarts') == 1
+
+
+def test_expired_token_of_unordered_harvest_lists_again_from_its_start(tmp_path):
+    spider, harvest = job_spider(tmp_path)
+    harvest.harvest_from = '2019-01-01'
+    harvest.high_water = '2020-03-01T00:00:00Z'
+    harvest.ordered = False
+
+    request, = spider.parse_page(job_page_response(harvest, 2, BAD_RESUMPTION_TOKEN))
+
+    assert split_url(request.url)[1]['from'] == '2019-01-01'
+
+
+def test_expired_token_gives_up_after_max_restarts(tmp_path):
+    spider, harvest = job_spider(tmp_path)
+    for page in range(MAX_RESTARTS):
+        assert len(list(spider.parse_page(job_page_response(harvest, page, BAD_RESUMPTION_TOKEN)))) == 1
+
+    assert list(spider.parse_page(job_page_response(harvest, MAX_RESTARTS, BAD_RESUMPTION_TOKEN))) == []
+    assert not harvest.complete
+
+
+def finish_page(spider, harvest, page, token, datestamps, failed=()):
+    """
+    Pass the items of a page through process_results and send the item signals the pipelines would
+    """
+    response = job_page_response(harvest, page, b'')
+    spider.resumption_request(token, page, harvest)
+    items = list(spider.process_results(response, [Feed2HtmlItem(id=f"oai:x:{d}", datestamp=d) for d in datestamps]))
+    spider.page_parsed(harvest, page)
+    for item in items:
+        spider.item_finished(item, spider, failure=object() if item['datestamp'] in failed else None)
+
+
+def test_checkpoint_follows_finished_pages(tmp_path):
+    spider, harvest = job_spider(tmp_path)
+    finish_page(spider, harvest, 0, 't1', ['2020-01-01', '2020-01-02'])
+    finish_page(spider, harvest, 1, 't2', ['2020-01-03'])
+
+    with open(tmp_path / 'job.json', 'r', encoding='utf8') as f:
+        entry = json.load(f)[harvest.key]
+    assert entry['page'] == 2
+    assert entry['token'] == 't2'
+    assert entry['completed'] == 3
+    assert entry['high_water'] == '2020-01-03'
+
+
+def test_checkpoint_stops_at_failed_item(tmp_path):
+    spider, harvest = job_spider(tmp_path)
+    finish_page(spider, harvest, 0, 't1', ['2020-01-01'])
+    finish_page(spider, harvest, 1, 't2', ['2020-01-02', '2020-01-03'], failed={'2020-01-02'})
+    finish_page(spider, harvest, 2, 't3', ['2020-01-04'])
+
+    with open(tmp_path / 'job.json', 'r', encoding='utf8') as f:
+        entry = json.load(f)[harvest.key]
+    assert entry['page'] == 1
+    assert entry['token'] == 't1'
+    assert harvest.errors == 1
+
+
+def test_job_continues_from_checkpoint(tmp_path):
+    spider, harvest = job_spider(tmp_path)
+    finish_page(spider, harvest, 0, 't1', ['2020-01-01'])
+
+    spider, harvest = job_spider(tmp_path)
+    request = spider.start_request(harvest)
+
+    assert split_url(request.url)[1] == {'verb': 'ListRecords', 'resumptionToken': 't1'}
+    assert request.meta['oai_page'] == 1
+    assert harvest.completed == 1
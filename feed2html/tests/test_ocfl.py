@@ -0,0 +1,370 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+import scrapy
+from ocflcore import FileSystemStorage, OCFLObject, OCFLRepository, OCFLVersion, StorageRoot, TopLevelLayout
+from scrapy.utils.test import get_crawler
+
+from feed2html import pipelines
+from feed2html.ocfl import HashedNTupleLayout, ObjectIndex, add_version, object_path, scan_objects
+from feed2html.pipelines import WriteToOCFLPipeline
+
+
+def sha512(data):
+    return hashlib.sha512(data).hexdigest()
+
+
+def version(**files):
+    v = OCFLVersion(datetime.now(timezone.utc))
+    for name, data in files.items():
+        v.files.add(name, BytesIO(data), sha512(data))
+    return v
+
+
+def create_object(tmp_path, object_id, v, layout=None):
+    layout = layout or TopLevelLayout()
+    repository = OCFLRepository(StorageRoot(layout), FileSystemStorage(str(tmp_path / 'root')),
+                                workspace_storage=FileSystemStorage(str(tmp_path / 'workspace')))
+    repository.initialize()
+    obj = OCFLObject(object_id)
+    obj.versions.append(v)
+    repository.add(obj)
+    return str(tmp_path / 'root' / object_path(layout, object_id))
+
+
+def inventory(object_root):
+    with open(os.path.join(object_root, 'inventory.json'), 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def test_hashed_layout_path():
+    path = object_path(HashedNTupleLayout(), 'oai:x:1')
+    digest = hashlib.sha256(b'oai:x:1').hexdigest()
+    assert path == f"{digest[:3]}/{digest[3:6]}/{digest[6:9]}/{digest}"
+
+
+def test_add_version(tmp_path):
+    object_root = create_object(tmp_path, 'oai_x_1', version(**{'record.xml': b'<a/>', 'page.html': b'<p>a</p>'}))
+
+    added = add_version(object_root, str(tmp_path / 'workspace'),
+                        version(**{'record.xml': b'<b/>', 'page.html': b'<p>a</p>'}))
+
+    assert added
+    head = inventory(object_root)
+    assert head['head'] == 'v2'
+    assert head['versions']['v2']['state'][sha512(b'<b/>')] == ['record.xml']
+    assert head['manifest'][sha512(b'<b/>')] == ['v2/content/record.xml']
+    # Content which did not change is not stored again
+    assert head['manifest'][sha512(b'<p>a</p>')] == ['v1/content/page.html']
+    assert not os.path.exists(os.path.join(object_root, 'v2', 'content', 'page.html'))
+    with open(os.path.join(object_root, 'inventory.json'), 'rb') as f:
+        inventory_digest = hashlib.sha512(f.read()).hexdigest()
+    sidecar, = (name for name in os.listdir(object_root) if name.startswith('inventory.json.'))
+    with open(os.path.join(object_root, sidecar), 'r', encoding='utf8') as f:
+        assert f.read().split()[0] == inventory_digest
+    with open(os.path.join(object_root, 'v2', 'inventory.json'), 'rb') as f:
+        assert hashlib.sha512(f.read()).hexdigest() == inventory_digest
+    # The version was assembled in the workspace, which is cleaned up
+    assert not os.path.exists(tmp_path / 'workspace' / 'oai_x_1-v2')
+
+
+def test_add_version_without_changes(tmp_path):
+    object_root = create_object(tmp_path, 'oai_x_1', version(**{'record.xml': b'<a/>'}))
+
+    assert not add_version(object_root, str(tmp_path / 'workspace'), version(**{'record.xml': b'<a/>'}))
+    assert inventory(object_root)['head'] == 'v1'
+
+
+def test_scan_objects(tmp_path):
+    create_object(tmp_path, 'oai:x:1', version(**{'record.xml': b'<a/>'}), HashedNTupleLayout())
+    create_object(tmp_path, 'oai:x:2', version(**{'record.xml': b'<b/>'}), HashedNTupleLayout())
+
+    assert scan_objects(str(tmp_path / 'root')) == {'oai:x:1', 'oai:x:2'}
+
+
+def test_object_index(tmp_path):
+    path = str(tmp_path / 'index.json')
+    index = ObjectIndex(path)
+    assert not index.clean
+    index.rebuild(['a', 'b'])
+    index.open()
+    index.set('a', 'digest-a')
+    index.remove('b')
+    index.save()
+
+    index = ObjectIndex(path)
+    assert index.clean
+    assert 'a' in index and 'b' not in index
+    assert index.get('a') == 'digest-a'
+    assert len(index) == 1
+
+
+def test_object_index_left_open_is_not_clean(tmp_path):
+    path = str(tmp_path / 'index.json')
+    index = ObjectIndex(path)
+    index.set('a', 'digest-a')
+    index.save()
+    # A crawl opened the index and was killed before saving it, maybe after writing a new version of 'a'
+    index.open()
+
+    index = ObjectIndex(path)
+    assert not index.clean
+    index.rebuild(['a', 'b'])
+    assert index.clean
+    assert index.get('a') is None and 'b' in index
+
+
+def ocfl_spider(tmp_path):
+    crawler = get_crawler(scrapy.Spider)
+    return SimpleNamespace(path_to_ocfl=str(tmp_path / 'ocfl'), file_crawl_path=str(tmp_path / 'files'),
+                           crawler=crawler)
+
+
+def record(html=b'<p>a</p>', **fields):
+    return dict(ocfl_id='oai_x_1', xml='<record/>', html=html, **fields)
+
+
+def test_ocfl_pipeline_skips_unchanged_and_versions_changed(tmp_path):
+    spider = ocfl_spider(tmp_path)
+    object_root = str(tmp_path / 'ocfl' / 'root' / 'oai_x_1')
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+
+    item = pipeline.process_item(record(), spider)
+    assert 'html' not in item and 'xml' not in item
+    pipeline.process_item(record(), spider)
+    assert inventory(object_root)['head'] == 'v1'
+
+    pipeline.process_item(record(html=b'<p>b</p>'), spider)
+    pipeline.close_spider(spider)
+
+    assert inventory(object_root)['head'] == 'v2'
+    stats = spider.crawler.stats
+    assert [stats.get_value(f"ocfl/{name}") for name in ('added', 'unchanged', 'versioned')] == [1, 1, 1]
+
+    # The repository and its index are kept for the next crawl
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item(record(html=b'<p>b</p>'), spider)
+    assert inventory(object_root)['head'] == 'v2'
+    assert stats.get_value('ocfl/unchanged') == 2
+
+
+def test_ocfl_pipeline_versions_changed_files(tmp_path):
+    spider = ocfl_spider(tmp_path)
+    os.makedirs(tmp_path / 'files' / 'x')
+    (tmp_path / 'files' / 'x' / 'paper.pdf').write_bytes(b'one')
+    object_root = str(tmp_path / 'ocfl' / 'root' / 'oai_x_1')
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+
+    pipeline.process_item(record(files=[{'path': 'x/paper.pdf', 'checksum': 'c1'}]), spider)
+    pipeline.process_item(record(files=[{'path': 'x/paper.pdf', 'checksum': 'c1'}]), spider)
+    assert inventory(object_root)['head'] == 'v1'
+
+    (tmp_path / 'files' / 'x' / 'paper.pdf').write_bytes(b'two')
+    pipeline.process_item(record(files=[{'path': 'x/paper.pdf', 'checksum': 'c2'}]), spider)
+
+    head = inventory(object_root)
+    assert head['head'] == 'v2'
+    assert head['versions']['v2']['state'][sha512(b'two')] == ['paper.pdf']
+
+
+def test_ocfl_pipeline_removes_deleted_records(tmp_path):
+    spider = ocfl_spider(tmp_path)
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item(record(), spider)
+
+    pipeline.process_item({'ocfl_id': 'oai_x_1', 'deleted': True}, spider)
+    pipeline.close_spider(spider)
+
+    assert not os.path.exists(tmp_path / 'ocfl' / 'root' / 'oai_x_1')
+    assert ObjectIndex(str(tmp_path / 'ocfl' / 'index.json')).get('oai_x_1') is None
+
+
+def test_ocfl_pipeline_hashed_layout(tmp_path):
+    spider = ocfl_spider(tmp_path)
+    pipeline = WriteToOCFLPipeline(layout='hashed')
+    pipeline.open_spider(spider)
+    pipeline.process_item(record(), spider)
+    pipeline.close_spider(spider)
+
+    object_root = tmp_path / 'ocfl' / 'root' / object_path(HashedNTupleLayout(), 'oai_x_1')
+    assert inventory(str(object_root))['id'] == 'oai_x_1'
+    with open(tmp_path / 'ocfl' / 'root' / 'extensions' / HashedNTupleLayout.extension / 'config.json') as f:
+        assert json.load(f)['digestAlgorithm'] == 'sha256'
+
+    # The storage root cannot be reopened with another layout
+    with pytest.raises(ValueError):
+        WriteToOCFLPipeline(layout='flat').open_spider(spider)
+
+
+def test_ocfl_pipeline_rebuilds_index_after_crash(tmp_path):
+    spider = ocfl_spider(tmp_path)
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    # The crawl is killed before close_spider saves the index
+    pipeline.process_item(record(), spider)
+
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    assert 'oai_x_1' in pipeline.repositories[None].index
+    pipeline.process_item(record(), spider)
+    pipeline.close_spider(spider)
+
+    # The object is found again, and not added a second time
+    assert inventory(str(tmp_path / 'ocfl' / 'root' / 'oai_x_1'))['head'] == 'v1'
+    assert spider.crawler.stats.get_value('ocfl/added') == 1
+
+
+def test_ocfl_pipeline_forgets_digests_after_crash(tmp_path):
+    spider = ocfl_spider(tmp_path)
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item(record(), spider)
+    pipeline.close_spider(spider)
+    # The next crawl writes a new version and is killed before it saves the index
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item(record(html=b'<p>b</p>'), spider)
+
+    # The saved digest is the one of v1, which is no longer the head version
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item(record(), spider)
+    pipeline.close_spider(spider)
+
+    assert inventory(str(tmp_path / 'ocfl' / 'root' / 'oai_x_1'))['head'] == 'v3'
+
+
+def test_ocfl_pipeline_writes_a_repository_per_source(tmp_path):
+    spider = ocfl_spider(tmp_path)
+    spider.endpoints = [{'name': 'a'}, {'name': 'b'}]
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    pipeline.process_item(record(source='a'), spider)
+    pipeline.process_item(record(html=b'<p>b</p>', source='b'), spider)
+    pipeline.close_spider(spider)
+
+    assert not os.path.exists(tmp_path / 'ocfl' / 'root')
+    for source in ('a', 'b'):
+        assert inventory(str(tmp_path / 'ocfl' / source / 'root' / 'oai_x_1'))['head'] == 'v1'
+        assert ObjectIndex(str(tmp_path / 'ocfl' / source / 'index.json')).clean
+    assert spider.crawler.stats.get_value('ocfl/added') == 2
+
+@pytest.mark.parametrize('link_mode', ['copy', 'reflink', 'hardlink'])
+def test_ocfl_pipeline_writes_files_by_path(tmp_path, link_mode):
+    spider = ocfl_spider(tmp_path)
+    os.makedirs(tmp_path / 'files' / 'x')
+    crawl_path = tmp_path / 'files' / 'x' / 'paper.pdf'
+    crawl_path.write_bytes(b'one')
+    pipeline = WriteToOCFLPipeline(link_mode=link_mode)
+    pipeline.open_spider(spider)
+
+    pipeline.process_item(record(files=[{'path': 'x/paper.pdf', 'checksum': 'md5-1', 'sha512': sha512(b'one')}]),
+                          spider)
+    crawl_path.unlink()
+    crawl_path.write_bytes(b'two')
+    pipeline.process_item(record(files=[{'path': 'x/paper.pdf', 'checksum': 'md5-2', 'sha512': sha512(b'two')}]),
+                          spider)
+
+    object_root = tmp_path / 'ocfl' / 'root' / 'oai_x_1'
+    head = inventory(str(object_root))
+    assert head['manifest'][sha512(b'one')] == ['v1/content/paper.pdf']
+    assert head['manifest'][sha512(b'two')] == ['v2/content/paper.pdf']
+    # The files pipeline checksums are kept as fixity, including those of earlier versions
+    assert head['fixity']['md5'] == {'md5-1': ['v1/content/paper.pdf'], 'md5-2': ['v2/content/paper.pdf']}
+    ocfl_path = object_root / 'v2' / 'content' / 'paper.pdf'
+    assert ocfl_path.read_bytes() == b'two'
+    assert (os.stat(ocfl_path).st_ino == os.stat(crawl_path).st_ino) == (link_mode == 'hardlink')
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 10
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def writer_pipeline(tmp_path, monkeypatch, **kwargs):
+    from twisted.internet import reactor
+
+    # No reactor is running, so deliver the writer thread's results straight to the Deferreds
+    monkeypatch.setattr(reactor, 'callFromThread', lambda f, *args, **kwargs: f(*args, **kwargs))
+    syncs = []
+    monkeypatch.setattr(pipelines, 'sync_filesystem', syncs.append)
+    spider = ocfl_spider(tmp_path)
+    pipeline = WriteToOCFLPipeline(**kwargs)
+    pipeline.open_spider(spider)
+    # Hold the writer thread until released, so jobs pile up in the queue
+    release = threading.Event()
+    pipeline._submit(lambda repository: release.wait(), pipeline.repositories[None])
+    return spider, pipeline, release, syncs
+
+
+def results_of(d):
+    results = []
+    d.addBoth(results.append)
+    return results
+
+
+def close(pipeline, spider):
+    wait_for(results_of(pipeline.close_spider(spider)).__len__)
+
+
+def test_ocfl_writer_thread_batches_writes(tmp_path, monkeypatch):
+    spider, pipeline, release, syncs = writer_pipeline(tmp_path, monkeypatch, queue_size=10, batch_size=10,
+                                                       fsync=True)
+    results = [results_of(pipeline.process_item(dict(record(), ocfl_id=f"oai_x_{n}"), spider)) for n in range(5)]
+    assert not any(results)
+    release.set()
+    close(pipeline, spider)
+
+    # Each item is passed on once its object is written
+    assert [result[0]['ocfl_id'] for result in results] == [f"oai_x_{n}" for n in range(5)]
+    assert 'html' not in results[0][0]
+    assert spider.crawler.stats.get_value('ocfl/added') == 5
+    assert ObjectIndex(str(tmp_path / 'ocfl' / 'index.json')).clean
+    assert all(inventory(str(tmp_path / 'ocfl' / 'root' / f"oai_x_{n}"))['head'] == 'v1' for n in range(5))
+    # One sync per batch rather than one per object
+    assert 1 <= len(syncs) <= 3
+
+
+def test_ocfl_writer_thread_backpressure(tmp_path, monkeypatch):
+    spider, pipeline, release, syncs = writer_pipeline(tmp_path, monkeypatch, queue_size=1)
+
+    # The only slot is taken by the held job, so the write waits on the reactor side, not in the queue
+    result = results_of(pipeline.process_item(dict(record(), ocfl_id='oai_x_1'), spider))
+    time.sleep(0.05)
+    assert not result
+    assert pipeline.queue.empty()
+
+    release.set()
+    wait_for(result.__len__)
+    assert result[0]['ocfl_id'] == 'oai_x_1'
+    close(pipeline, spider)
+    assert spider.crawler.stats.get_value('ocfl/added') == 1
+    assert not syncs
+
+
+def test_ocfl_writer_thread_fails_items_whose_write_fails(tmp_path, monkeypatch):
+    from twisted.python.failure import Failure
+
+    spider, pipeline, release, syncs = writer_pipeline(tmp_path, monkeypatch, queue_size=10)
+    failed = results_of(pipeline.process_item(
+        dict(record(files=[{'path': 'missing.pdf', 'checksum': 'c'}]), ocfl_id='oai_x_1'), spider))
+    written = results_of(pipeline.process_item(dict(record(), ocfl_id='oai_x_2'), spider))
+    release.set()
+    close(pipeline, spider)
+
+    assert isinstance(failed[0], Failure) and failed[0].check(FileNotFoundError)
+    assert written[0]['ocfl_id'] == 'oai_x_2'
+    assert spider.crawler.stats.get_value('ocfl/added') == 1
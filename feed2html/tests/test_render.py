@@ -0,0 +1,176 @@
+import json
+import os
+import pickle
+import shutil
+from types import SimpleNamespace
+
+import scrapy
+from lxml import etree
+from scrapy.utils.test import get_crawler
+
+from feed2html.ocfl import head_file, read_inventory
+from feed2html.pipelines import WriteToOCFLPipeline
+from feed2html.render import MANIFEST_NAME, PublicationDate, build_hash, render_site
+from feed2html.spiders.oaipmh_dc_xml import OaipmhDcSpider
+from feed2html.spiders.oaipmh_mets_mods_xml import MetsModsXml
+
+STYLESHEET = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+xmlns:dc="http://purl.org/dc/elements/1.1/">
+<xsl:param name="website_title"/><xsl:param name="publication_date"/>
+<xsl:template match="/"><p>%s|<xsl:value-of select="$website_title"/>|<xsl:value-of
+select="$publication_date"/>|<xsl:value-of select="//dc:title"/></p></xsl:template>
+</xsl:stylesheet>"""
+
+RECORD = """<record xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<metadata><dc:title>%s</dc:title><dc:date>2020-05-04T10:00:00Z</dc:date><dc:date>2021</dc:date></metadata></record>"""
+
+PARAMS = {'website_title': 'Test', 'website_subtitle': 'open access', 'path_to_assets': '/tmp'}
+
+DC_RECORD = b"""<record xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<metadata><dc:date>2020-05-04T10:00:00Z</dc:date><dc:date>2021-01-01</dc:date></metadata></record>"""
+
+MODS_RECORD = b"""<record xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:mods="http://www.loc.gov/mods/v3">
+<metadata><mods:mods><mods:originInfo><mods:dateIssued>2001-05</mods:dateIssued></mods:originInfo></mods:mods>
+<mods:mods><mods:originInfo><mods:dateIssued>1999</mods:dateIssued></mods:originInfo></mods:mods></metadata></record>"""
+
+
+def store_records(tmp_path, *titles, source=None):
+    spider = SimpleNamespace(path_to_ocfl=str(tmp_path / 'ocfl'), file_crawl_path=str(tmp_path / 'files'),
+                             crawler=get_crawler(scrapy.Spider))
+    pipeline = WriteToOCFLPipeline()
+    pipeline.open_spider(spider)
+    for n, title in enumerate(titles):
+        pipeline.process_item({'ocfl_id': f"oai_x_{n}", 'xml': RECORD % title, 'html': b'<p/>', 'source': source},
+                              spider)
+    pipeline.close_spider(spider)
+
+
+def render(tmp_path, path_to_xsl, params=PARAMS, **kwargs):
+    return render_site(str(tmp_path / 'ocfl'), path_to_xsl, str(tmp_path / 'pages'), params, processes=1, **kwargs)
+
+
+def write_stylesheet(tmp_path, label):
+    path = tmp_path / 'page.xsl'
+    path.write_text(STYLESHEET % label, encoding='utf8')
+    return str(path)
+
+
+def page(tmp_path, n):
+    return (tmp_path / 'pages' / f"oai_x_{n}" / 'page.html').read_text(encoding='utf8')
+
+
+def test_head_file(tmp_path):
+    store_records(tmp_path, 'One')
+    inventory = read_inventory(str(tmp_path / 'ocfl' / 'root' / 'oai_x_0'))
+
+    digest, content_path = head_file(inventory, 'record.xml')
+    assert content_path == 'v1/content/record.xml'
+    assert inventory['manifest'][digest] == [content_path]
+    assert head_file(inventory, 'missing.pdf') is None
+
+
+def test_publication_date_of_dc_records_is_guessed():
+    publication_date = PublicationDate.from_spider(OaipmhDcSpider)
+    assert publication_date(etree.fromstring(DC_RECORD)) == '2020'
+    assert publication_date(etree.fromstring(MODS_RECORD)) is None
+
+
+def test_publication_date_of_mods_records_is_date_issued():
+    publication_date = PublicationDate.from_spider(MetsModsXml)
+    assert publication_date(etree.fromstring(MODS_RECORD)) == '2001-05'
+
+
+def test_publication_date_xpath_given_to_the_spider():
+    publication_date = PublicationDate.from_spider(OaipmhDcSpider, '(.//dc:date)[2]/text()')
+    assert publication_date(etree.fromstring(DC_RECORD)) == '2021'
+
+
+def test_publication_date_can_be_pickled_for_workers():
+    publication_date = PublicationDate()
+    publication_date(etree.fromstring(DC_RECORD))
+    copy = pickle.loads(pickle.dumps(publication_date))
+    assert copy(etree.fromstring(DC_RECORD)) == '2020'
+
+
+def test_build_hash_covers_the_publication_date():
+    params = {'website_title': 'Test'}
+    assert build_hash('r', 's', params, PublicationDate().spec) == build_hash('r', 's', params, PublicationDate().spec)
+    assert build_hash('r', 's', params, PublicationDate().spec) != \
+        build_hash('r', 's', params, PublicationDate.from_spider(MetsModsXml).spec)
+
+
+def test_render_site(tmp_path):
+    store_records(tmp_path, 'One', 'Two')
+
+    counts = render(tmp_path, write_stylesheet(tmp_path, 'v1'))
+
+    assert counts == {'rebuilt': 2}
+    assert 'v1|Test|2021|One' in page(tmp_path, 0)
+    assert 'v1|Test|2021|Two' in page(tmp_path, 1)
+    assert not any(name.endswith('.tmp') for name in os.listdir(tmp_path / 'pages' / 'oai_x_0'))
+    with open(tmp_path / 'pages' / MANIFEST_NAME) as f:
+        assert sorted(json.load(f)) == ['oai_x_0/page.html', 'oai_x_1/page.html']
+
+
+def test_render_site_skips_pages_with_unchanged_inputs(tmp_path):
+    store_records(tmp_path, 'One', 'Two')
+    path_to_xsl = write_stylesheet(tmp_path, 'v1')
+    render(tmp_path, path_to_xsl)
+
+    assert render(tmp_path, path_to_xsl) == {'skipped': 2}
+    assert render(tmp_path, path_to_xsl, force=True) == {'rebuilt': 2}
+
+    # A changed record renders its own page again
+    store_records(tmp_path, 'One', 'Two again')
+    assert render(tmp_path, path_to_xsl) == {'rebuilt': 1, 'skipped': 1}
+    assert 'v1|Test|2021|Two again' in page(tmp_path, 1)
+
+    # A changed stylesheet or parameter renders every page again
+    path_to_xsl = write_stylesheet(tmp_path, 'v2')
+    assert render(tmp_path, path_to_xsl) == {'rebuilt': 2}
+    assert 'v2|Test|2021|One' in page(tmp_path, 0)
+    assert render(tmp_path, path_to_xsl, dict(PARAMS, website_subtitle='other')) == {'rebuilt': 2}
+
+    # A page deleted from the output is rendered again
+    os.remove(tmp_path / 'pages' / 'oai_x_0' / 'page.html')
+    assert render(tmp_path, path_to_xsl, dict(PARAMS, website_subtitle='other')) == {'rebuilt': 1, 'skipped': 1}
+
+
+def test_render_site_removes_pages_of_removed_objects(tmp_path):
+    store_records(tmp_path, 'One', 'Two')
+    path_to_xsl = write_stylesheet(tmp_path, 'v1')
+    render(tmp_path, path_to_xsl)
+
+    shutil.rmtree(tmp_path / 'ocfl' / 'root' / 'oai_x_1')
+
+    assert render(tmp_path, path_to_xsl) == {'skipped': 1, 'removed': 1}
+    assert not os.path.exists(tmp_path / 'pages' / 'oai_x_1')
+
+
+def test_render_site_renders_failed_pages_again(tmp_path):
+    store_records(tmp_path, 'One')
+    record_path = tmp_path / 'ocfl' / 'root' / 'oai_x_0' / 'v1' / 'content' / 'record.xml'
+    record = record_path.read_bytes()
+    record_path.unlink()
+    path_to_xsl = write_stylesheet(tmp_path, 'v1')
+
+    assert render(tmp_path, path_to_xsl) == {'failed': 1}
+
+    record_path.write_bytes(record)
+    assert render(tmp_path, path_to_xsl) == {'rebuilt': 1}
+
+
+def test_render_site_renders_every_source(tmp_path):
+    store_records(tmp_path, 'One')
+    store_records(tmp_path, 'A one', 'A two', source='a')
+    store_records(tmp_path, 'B one', source='b')
+    path_to_xsl = write_stylesheet(tmp_path, 'v1')
+
+    assert render(tmp_path, path_to_xsl) == {'rebuilt': 4}
+    assert 'v1|Test|2021|One' in page(tmp_path, 0)
+    assert 'v1|Test|2021|A two' in (tmp_path / 'pages' / 'a' / 'oai_x_1' / 'page.html').read_text(encoding='utf8')
+    assert 'v1|Test|2021|B one' in (tmp_path / 'pages' / 'b' / 'oai_x_0' / 'page.html').read_text(encoding='utf8')
+
+    shutil.rmtree(tmp_path / 'ocfl' / 'b')
+    assert render(tmp_path, path_to_xsl) == {'skipped': 3, 'removed': 1}
+    assert not os.path.exists(tmp_path / 'pages' / 'b')
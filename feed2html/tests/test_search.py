@@ -0,0 +1,144 @@
+import json
+import os
+from types import SimpleNamespace
+
+import scrapy
+from scrapy.utils.test import get_crawler
+
+from feed2html.pipelines import SearchIndexPipeline
+from feed2html.search import SearchIndexBuilder, decode_postings, encode_postings, item_terms, tokenize
+
+
+def read_json(path):
+    with open(path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def search(path, term):
+    """
+    :return: dict of document key -> weight of a term, looked up the way output/js/search.js does
+    """
+    manifest = read_json(os.path.join(path, 'index.json'))
+    prefix = term[:manifest['prefix_length']]
+    if prefix not in manifest['shards']:
+        return {}
+    postings = decode_postings(read_json(os.path.join(path, 'terms', f"{prefix}.json")).get(term, []))
+    per_shard = manifest['documents_per_shard']
+    found = {}
+    for number, weight in postings.items():
+        document = read_json(os.path.join(path, 'docs', f"{number // per_shard}.json"))[number % per_shard]
+        found[document[0]] = weight
+    return found
+
+
+def test_tokenize():
+    assert tokenize("The Évolution of São Paulo's 3D-printed A") == ['evolution', 'sao', 'paulo', '3d', 'printed']
+    assert tokenize('x' * 40) == ['x' * 32]
+
+
+def test_item_terms_weights_fields():
+    terms = item_terms({'title': 'Coral reefs', 'subject': ['reefs', 'Reefs'], 'abstract': None},
+                       {'title': 4, 'subject': 3, 'abstract': 1})
+    assert terms == {'coral': 4, 'reefs': 7}
+
+
+def test_postings_round_trip():
+    postings = {7: 1, 2: 4, 30: 2}
+    assert encode_postings(postings) == [2, 4, 5, 1, 23, 2]
+    assert decode_postings(encode_postings(postings)) == postings
+
+
+def test_build(tmp_path):
+    path = str(tmp_path / 'search')
+    builder = SearchIndexBuilder(path, documents_per_shard=2)
+    builder.add('a', 'Coral reefs', {'title': 'Coral reefs', 'abstract': 'Bleaching of coral'})
+    builder.add('b', 'Kelp forests', {'title': 'Kelp forests', 'subject': ['coral']})
+    builder.add('c', 'Deep sea', {'title': 'Deep sea'})
+    stats = builder.build()
+
+    assert stats['documents'] == 3
+    assert stats['changed'] == 3
+    assert search(path, 'coral') == {'a': 5, 'b': 3}
+    assert search(path, 'deep') == {'c': 4}
+    assert read_json(os.path.join(path, 'docs', '1.json')) == [['c', 'Deep sea']]
+    assert not os.path.exists(os.path.join(path, '.build'))
+
+
+def test_incremental_build_replaces_updated_documents(tmp_path):
+    path = str(tmp_path / 'search')
+    builder = SearchIndexBuilder(path)
+    builder.add('a', 'Coral reefs', {'title': 'Coral reefs'})
+    builder.add('b', 'Kelp forests', {'title': 'Kelp forests'})
+    builder.build()
+    kelp_shard = os.path.join(path, 'terms', 'ke.json')
+    os.utime(kelp_shard, (0, 0))
+
+    # The next crawl only sees 'a', which changed title
+    builder = SearchIndexBuilder(path)
+    builder.add('a', 'Sponge reefs', {'title': 'Sponge reefs'})
+    stats = builder.build()
+
+    assert stats['documents'] == 2
+    assert stats['changed'] == 1
+    assert search(path, 'coral') == {}
+    assert search(path, 'sponge') == {'a': 4}
+    assert search(path, 'reefs') == {'a': 4}
+    assert search(path, 'kelp') == {'b': 4}
+    assert 'co' not in read_json(os.path.join(path, 'index.json'))['shards']
+    # Shards without postings of the replaced document are not written again
+    assert os.path.getmtime(kelp_shard) == 0
+
+
+def test_incremental_build_deletes_documents(tmp_path):
+    path = str(tmp_path / 'search')
+    builder = SearchIndexBuilder(path)
+    builder.add('a', 'Coral reefs', {'title': 'Coral reefs'})
+    builder.add('b', 'Coral gardens', {'title': 'Coral gardens'})
+    builder.build()
+
+    builder = SearchIndexBuilder(path)
+    builder.delete('a')
+    builder.delete('never-indexed')
+    stats = builder.build()
+
+    assert stats['documents'] == 1
+    assert search(path, 'coral') == {'b': 4}
+    assert read_json(os.path.join(path, 'docs', '0.json')) == [None, ['b', 'Coral gardens']]
+
+
+def test_unfinished_crawl_is_continued(tmp_path):
+    path = str(tmp_path / 'search')
+    builder = SearchIndexBuilder(path, buffer_size=1)
+    builder.add('a', 'Coral reefs', {'title': 'Coral reefs'})
+    # Killed while appending to a run file
+    with open(os.path.join(path, '.build', 'co.tsv'), 'a', encoding='utf8') as f:
+        f.write('coral\t1')
+
+    builder = SearchIndexBuilder(path)
+    assert builder.sequence == 1
+    builder.add('b', 'Coral gardens', {'title': 'Coral gardens'})
+    builder.build()
+
+    assert search(path, 'coral') == {'a': 4, 'b': 4}
+
+
+def test_search_index_pipeline(tmp_path, monkeypatch):
+    from twisted.internet import defer, threads
+
+    # No reactor is running, so build the index straight away
+    monkeypatch.setattr(threads, 'deferToThread', lambda function, *args: defer.succeed(function(*args)))
+    crawler = get_crawler(scrapy.Spider)
+    spider = SimpleNamespace(path_to_assets=str(tmp_path), crawler=crawler)
+    pipeline = SearchIndexPipeline.from_crawler(crawler)
+    pipeline.open_spider(spider)
+
+    pipeline.process_item({'ocfl_id': 'oai_x_1', 'title': 'Coral reefs', 'source': 'a'}, spider)
+    pipeline.process_item({'id': ['oai:x:2'], 'title': ['Kelp forests']}, spider)
+    pipeline.process_item({'ocfl_id': 'oai_x_3', 'title': 'Coral gone', 'deleted': True}, spider)
+    pipeline.close_spider(spider)
+
+    path = str(tmp_path / 'search')
+    assert set(search(path, 'coral')) == {'a/oai_x_1'}
+    assert set(search(path, 'kelp')) == {'oai:x:2'}
+    assert crawler.stats.get_value('search_index/documents') == 2
+
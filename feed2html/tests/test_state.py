@@ -0,0 +1,34 @@
+import json
+import os
+
+from feed2html.state import HarvestCheckpoint, HarvestState
+
+
+def test_harvest_state_round_trip(tmp_path):
+    path = str(tmp_path / 'state' / 'harvest-state.json')
+    state = HarvestState(path)
+    assert state.datestamp('a') is None
+    state.update('a', datestamp='2020-01-01')
+    state.save()
+
+    state = HarvestState(path)
+    assert state.datestamp('a') == '2020-01-01'
+    assert 'harvested' in state.get('a')
+    assert not os.path.exists(f"{path}.tmp")
+
+
+def test_checkpoint_keeps_progress_until_removed(tmp_path):
+    path = str(tmp_path / 'job.json')
+    checkpoint = HarvestCheckpoint(path)
+    checkpoint.update('a', token='t1', page=1)
+    checkpoint.update('a', token='t2', page=2)
+    checkpoint.save()
+
+    with open(path, 'r', encoding='utf8') as f:
+        assert {k: v for k, v in json.load(f)['a'].items() if k != 'harvested'} == {'token': 't2', 'page': 2}
+    assert HarvestCheckpoint(path).get('a')['page'] == 2
+
+    checkpoint.remove()
+    assert not os.path.exists(path)
+    # Removing it twice is fine, eg. a job completed by a second run
+    checkpoint.remove()
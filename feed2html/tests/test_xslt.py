@@ -0,0 +1,132 @@
+import os
+import time
+from types import SimpleNamespace
+
+from feed2html.pipelines import TransformXmlPipeline
+from feed2html.xslt import StylesheetCache, spider_params, transform_record
+
+STYLESHEET = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:param name="website_title"/><xsl:param name="publication_date"/>
+<xsl:template match="/"><p>%s|<xsl:value-of select="$website_title"/>|<xsl:value-of
+select="$publication_date"/>|<xsl:value-of select="/record/title"/></p></xsl:template>
+</xsl:stylesheet>"""
+
+SPIDER = SimpleNamespace(website_title="Bob's \"repository\"", website_subtitle='open access',
+                         path_to_assets='/tmp')
+
+
+def write_stylesheet(path, label, mtime):
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(STYLESHEET % label)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def render(transform, params=None):
+    return str(transform_record(transform, b'<record><title>T</title></record>', params or {}, '2020'))
+
+
+def test_stylesheet_compiled_once(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+    cache = StylesheetCache(reload_interval=0)
+
+    assert cache.get(path) is cache.get(path)
+
+
+def test_stylesheet_recompiled_when_changed(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+    cache = StylesheetCache(reload_interval=0)
+    assert 'v1' in render(cache.get(path))
+
+    write_stylesheet(path, 'v2', 10 ** 18 + 1)
+    assert 'v2' in render(cache.get(path))
+
+
+def test_stylesheet_changes_not_checked_within_reload_interval(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+    cache = StylesheetCache(reload_interval=3600)
+    first = cache.get(path)
+
+    write_stylesheet(path, 'v2', 10 ** 18 + 1)
+    assert cache.get(path) is first
+    assert 'v1' in render(cache.get(path))
+
+
+def test_stylesheet_never_reloaded_with_negative_interval(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+    cache = StylesheetCache(reload_interval=-1)
+    cache.get(path)
+
+    write_stylesheet(path, 'v2', 10 ** 18 + 1)
+    assert 'v1' in render(cache.get(path))
+
+
+def test_spider_params_are_quoted(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+
+    html = render(StylesheetCache().get(path), spider_params(SPIDER))
+
+    assert 'v1|Bob\'s "repository"|2020|T' in html
+
+
+def test_unknown_publication_date(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+
+    html = str(transform_record(StylesheetCache().get(path), b'<record><title>T</title></record>', {}, None))
+
+    assert 'v1||Unknown date|T' in html
+
+
+def test_transform_pipeline(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+    spider = SimpleNamespace(path_to_xsl=path, **vars(SPIDER))
+    pipeline = TransformXmlPipeline(reload_interval=0)
+    pipeline.open_spider(spider)
+
+    item = pipeline.process_item({'xml': b'<record><title>T</title></record>', 'date_issued': '1999'}, spider)
+
+    assert 'v1|Bob\'s "repository"|1999|T' in str(item['html'])
+
+
+def test_transform_pipeline_worker_threads(tmp_path, monkeypatch):
+    from twisted.internet import reactor
+
+    # No reactor is running, so deliver thread results straight to the Deferred
+    monkeypatch.setattr(reactor, 'callFromThread', lambda f, *args, **kwargs: f(*args, **kwargs))
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+    spider = SimpleNamespace(path_to_xsl=path, **vars(SPIDER))
+    pipeline = TransformXmlPipeline(reload_interval=0, workers=2)
+    pipeline.open_spider(spider)
+    try:
+        results = []
+        for year in ('1999', '2000', '2001'):
+            d = pipeline.process_item({'xml': b'<record><title>T</title></record>', 'date_issued': year}, spider)
+            d.addCallback(results.append)
+        deadline = time.monotonic() + 10
+        while len(results) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        pipeline.close_spider(spider)
+
+    assert sorted(str(item['html']).split('|')[2] for item in results) == ['1999', '2000', '2001']
+    assert pipeline.threadpool is None
+
+
+def test_transform_pipeline_inline_without_workers(tmp_path):
+    path = str(tmp_path / 'page.xsl')
+    write_stylesheet(path, 'v1', 10 ** 18)
+    spider = SimpleNamespace(path_to_xsl=path, **vars(SPIDER))
+    pipeline = TransformXmlPipeline(reload_interval=0, workers=0)
+    pipeline.open_spider(spider)
+
+    item = pipeline.process_item({'xml': b'<record><title>T</title></record>', 'date_issued': '1999'}, spider)
+
+    assert isinstance(item, dict)
+    assert pipeline.threadpool is None
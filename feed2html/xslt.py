@@ -0,0 +1,91 @@
+"""
+XSLT helpers shared by the pipelines that render records to HTML.
+Compiling a stylesheet is far more expensive than applying it, so stylesheets are compiled once
+and cached, and only recompiled when the file on disk changes.
+"""
+import logging
+import os
+import time
+
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+# Spider attributes passed to every stylesheet as XSLT string parameters. These do not change
+# during a crawl, so their quoted parameter values are built once per crawl
+SPIDER_PARAMS = ('website_title', 'website_subtitle', 'path_to_assets')
+
+# Publication date parameter of a record without a date that could be parsed
+UNKNOWN_DATE = 'Unknown date'
+
+
+def spider_params(spider):
+    """
+    Build the XSLT string parameters which stay the same for every record in a crawl
+
+    :param spider: the spider supplying items (website_title, website_subtitle, path_to_assets)
+    :return: dict of parameter name to quoted XSLT string parameter
+    """
+    return {name: etree.XSLT.strparam(str(getattr(spider, name))) for name in SPIDER_PARAMS}
+
+
+def publication_date_param(publication_date):
+    """
+    :param publication_date: the publication date guessed for a record, or None
+    :return: quoted XSLT string parameter, UNKNOWN_DATE for a record without a date
+    """
+    return etree.XSLT.strparam(str(publication_date) if publication_date else UNKNOWN_DATE)
+
+
+def transform_record(transform, xml, params, publication_date):
+    """
+    Apply a compiled stylesheet to a single serialised XML record
+
+    :param transform: compiled etree.XSLT stylesheet
+    :param xml: serialised XML record
+    :param params: prebuilt spider-level parameters (see spider_params)
+    :param publication_date: the per-record publication date, or None if it is unknown
+    :return: XSLT result tree
+    """
+    root = etree.XML(xml)
+    return transform(root, publication_date=publication_date_param(publication_date), **params)
+
+
+class StylesheetCache:
+    """
+    Cache of compiled XSLT stylesheets keyed by path and modification time.
+    The file is checked for changes at most once every reload_interval seconds, so an edited stylesheet
+    is picked up during a running crawl (hot reload) without a stat call for every record.
+    """
+
+    def __init__(self, reload_interval=1.0):
+        """
+        :param reload_interval: minimum number of seconds between checks for a changed stylesheet.
+        0 checks on every lookup, a negative value never reloads
+        """
+        self.reload_interval = reload_interval
+        # path -> (mtime, compiled stylesheet, time of last check)
+        self._stylesheets = {}
+
+    def get(self, path):
+        """
+        Get the compiled stylesheet for a path, compiling or recompiling it if necessary
+
+        :param path: path to the XSL file
+        :return: compiled etree.XSLT stylesheet
+        """
+        now = time.monotonic()
+        cached = self._stylesheets.get(path)
+        if cached is not None:
+            mtime, transform, checked = cached
+            if self.reload_interval < 0 or now - checked < self.reload_interval:
+                return transform
+            if os.stat(path).st_mtime_ns == mtime:
+                self._stylesheets[path] = (mtime, transform, now)
+                return transform
+            logger.info(f"Stylesheet {path} changed on disk, recompiling")
+
+        mtime = os.stat(path).st_mtime_ns
+        transform = etree.XSLT(etree.parse(path))
+        self._stylesheets[path] = (mtime, transform, now)
+        return transform
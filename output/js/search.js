@@ -0,0 +1,130 @@
+/*
+ * Client-side search over the static index written by SearchIndexPipeline (see feed2html/search.py).
+ * Only index.json, the term shards of the query words and the document shards of the results shown are fetched.
+ * Every word must match; the last one also matches as a prefix, so results update while typing.
+ *
+ * Usage:
+ *   <input id="search" type="search">
+ *   <ol id="search-results"></ol>
+ *   <script src="/js/search.js" data-index="/search/" data-url="/repository/{key}/"></script>
+ * where data-url turns a document key (export path or OCFL object ID) into the URL of its page.
+ */
+(function () {
+    var script = document.currentScript;
+    var base = script.dataset.index || '/search/';
+    var urlTemplate = script.dataset.url || '{key}';
+    var maxResults = parseInt(script.dataset.results || '20', 10);
+    var cache = {};
+
+    function fetchJson(path) {
+        if (!cache[path]) {
+            cache[path] = fetch(base + path).then(function (response) {
+                return response.ok ? response.json() : {};
+            });
+        }
+        return cache[path];
+    }
+
+    // Same terms as feed2html.search.tokenize
+    function tokenize(text, manifest) {
+        var words = text.normalize('NFKD').replace(/\p{M}/gu, '').toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+        return words.map(function (word) {
+            return Array.from(word).slice(0, manifest.max_term_length).join('');
+        }).filter(function (word) {
+            return Array.from(word).length > 1 && manifest.stopwords.indexOf(word) < 0;
+        });
+    }
+
+    function decode(encoded, into) {
+        var number = 0;
+        for (var i = 0; i < encoded.length; i += 2) {
+            number += encoded[i];
+            into.set(number, Math.max(into.get(number) || 0, encoded[i + 1]));
+        }
+        return into;
+    }
+
+    // Document number -> weight of a word, or of every term it is a prefix of
+    function postings(word, prefix, manifest) {
+        var shard = Array.from(word).slice(0, manifest.prefix_length).join('');
+        if (manifest.shards.indexOf(shard) < 0) {
+            return Promise.resolve(new Map());
+        }
+        return fetchJson('terms/' + encodeURIComponent(shard) + '.json').then(function (terms) {
+            var found = new Map();
+            if (!prefix) {
+                return terms[word] ? decode(terms[word], found) : found;
+            }
+            Object.keys(terms).forEach(function (term) {
+                if (term.lastIndexOf(word, 0) === 0) {
+                    decode(terms[term], found);
+                }
+            });
+            return found;
+        });
+    }
+
+    function search(query, manifest) {
+        var words = tokenize(query, manifest);
+        if (!words.length) {
+            return Promise.resolve([]);
+        }
+        return Promise.all(words.map(function (word, i) {
+            return postings(word, i === words.length - 1, manifest);
+        })).then(function (lists) {
+            lists.sort(function (a, b) { return a.size - b.size; });
+            var scores = new Map(lists[0]);
+            lists.slice(1).forEach(function (list) {
+                scores.forEach(function (score, number) {
+                    if (list.has(number)) {
+                        scores.set(number, score + list.get(number));
+                    } else {
+                        scores.delete(number);
+                    }
+                });
+            });
+            var ranked = Array.from(scores.keys()).sort(function (a, b) {
+                return scores.get(b) - scores.get(a) || a - b;
+            }).slice(0, maxResults);
+            return Promise.all(ranked.map(function (number) {
+                var block = Math.floor(number / manifest.documents_per_shard);
+                return fetchJson('docs/' + block + '.json').then(function (documents) {
+                    return documents[number % manifest.documents_per_shard];
+                });
+            }));
+        });
+    }
+
+    function show(documents, list) {
+        list.textContent = '';
+        documents.forEach(function (doc) {
+            if (!doc) {
+                return;
+            }
+            var item = document.createElement('li');
+            var link = document.createElement('a');
+            link.href = urlTemplate.replace('{key}', doc[0]);
+            link.textContent = doc[1];
+            item.appendChild(link);
+            list.appendChild(item);
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        var input = document.getElementById(script.dataset.input || 'search');
+        var list = document.getElementById(script.dataset.output || 'search-results');
+        var latest = 0;
+        input.addEventListener('input', function () {
+            var query = input.value;
+            var request = ++latest;
+            fetchJson('index.json').then(function (manifest) {
+                return search(query, manifest);
+            }).then(function (documents) {
+                // Results of a query typed over meanwhile are dropped
+                if (request === latest) {
+                    show(documents, list);
+                }
+            });
+        });
+    });
+})();